@@ -1,10 +1,83 @@
 from django.contrib import admin
-from .models import Registers
+from django.core.exceptions import ValidationError
+from django.forms.models import BaseInlineFormSet
+
+from .currency import price_formatter
+from .functions import CallBill
+from .models import (DestinationRate, Holiday, Registers, RunningBill, SubscriberPlan, TariffPlan,
+                     TimeBand)
 
 
 class RegisterAdmin(admin.ModelAdmin):
     list_display = ['phone_origin', 'period_call', 'destination_call', 'duration_call',
                     'price_call', 'start_date_call', 'start_time_call']
+    # phone_origin and period_call read the phone bill of each record
+    list_select_related = ('phone_bill',)
+
+    def duration_call(self, obj):
+        return CallBill._format_duration(obj.duration_seconds)
+    duration_call.admin_order_field = 'duration_seconds'
+
+    def price_call(self, obj):
+        return price_formatter.format_cents(obj.price_cents)
+    price_call.admin_order_field = 'price_cents'
+
+
+class DestinationRateFormSet(BaseInlineFormSet):
+    """The rates of a plan, one of them the catch-all rate (empty prefix), so every
+    destination of a call has a rate
+    """
+
+    def clean(self):
+        super(DestinationRateFormSet, self).clean()
+        prefixes = {form.cleaned_data.get('prefix') for form in self.forms
+                    if form.cleaned_data and not form.cleaned_data.get('DELETE')}
+        if '' not in prefixes:
+            raise ValidationError("A rate with an empty prefix, for all the other "
+                                  "destinations, is required.")
+
+
+class DestinationRateInline(admin.TabularInline):
+    model = DestinationRate
+    formset = DestinationRateFormSet
+    extra = 0
+
+
+class HolidayInline(admin.TabularInline):
+    model = Holiday
+    extra = 0
+
+
+class TariffPlanAdmin(admin.ModelAdmin):
+    list_display = ['name', 'default', 'updated_at']
+    inlines = [DestinationRateInline, HolidayInline]
+
+
+class TimeBandInline(admin.TabularInline):
+    model = TimeBand
+    extra = 0
+
+
+class DestinationRateAdmin(admin.ModelAdmin):
+    list_display = ['plan', 'prefix', 'standing_charge_cents', 'minute_cents']
+    list_select_related = ('plan',)
+    inlines = [TimeBandInline]
+
+
+class SubscriberPlanAdmin(admin.ModelAdmin):
+    list_display = ['source_call', 'plan']
+    list_select_related = ('plan',)
+    search_fields = ['source_call']
+
+
+class RunningBillAdmin(admin.ModelAdmin):
+    list_display = ['source_call', 'period', 'calls', 'billable_minutes', 'total_cents',
+                    'last_end_call']
+    search_fields = ['source_call']
 
 
 admin.site.register(Registers, RegisterAdmin)
+admin.site.register(TariffPlan, TariffPlanAdmin)
+admin.site.register(DestinationRate, DestinationRateAdmin)
+admin.site.register(SubscriberPlan, SubscriberPlanAdmin)
+admin.site.register(RunningBill, RunningBillAdmin)
@@ -0,0 +1,244 @@
+"""
+    Columnar archive of the priced calls of the closed months, to serve their
+    bills without the database
+
+    It is a read cache of the bills, not an archival: the completed calls of an
+    archived month stay in the database, where the exports, the bill runs and the
+    running bills read them, and from where the archive is written again.
+
+    A month is a directory (``BILL_ARCHIVE['DIR']/YYYY-MM``) of NumPy arrays:
+
+    - ``calls.npy``: the completed calls of the month, fixed-width records
+      grouped by source_call, ordered by id_call
+    - ``index.npy``: the subscribers, sorted, with the offsets of their calls:
+      ``calls[start:stop]``
+
+    The arrays are memory-mapped, so a bill reads the pages of its subscriber only,
+    found by a binary search of the subscribers. The archive of a month is written
+    by the ``archive_month`` command.
+
+    The archive is the bill of its month only while it has all the calls of the
+    month: a call of an archived month completed, changed or deleted later
+    discards the archive, and the bills of the month are read from the database
+    until the month is archived again. The directory is shared by all the
+    processes that bill and must outlive them: a volume mounted by every server,
+    not the local disk of a container (the filesystem of a Heroku dyno is its
+    own and is lost on each restart).
+"""
+import os
+import shutil
+import threading
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+NUMBER = 'S11'
+CALL_DTYPE = np.dtype([
+    ('id_call', '<u4'),
+    ('source_call', NUMBER),
+    ('destination_call', NUMBER),
+    ('start_call', '<M8[us]'),
+    ('duration_seconds', '<i4'),
+    ('price_cents', '<i4'),
+])
+INDEX_DTYPE = np.dtype([
+    ('source_call', NUMBER),
+    ('start', '<i8'),
+    ('stop', '<i8'),
+])
+
+
+def archive_dir():
+    """The directory of the archives, None if the archive is not configured"""
+    return getattr(settings, 'BILL_ARCHIVE', {}).get('DIR')
+
+
+def month_path(directory, month, year):
+    return os.path.join(directory, '{:04d}-{:02d}'.format(year, month))
+
+
+class CallArchive:
+    """Class responsible for reading the calls of an archived month
+
+    Attributes:
+        **path (str):** The directory of the month
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = np.load(os.path.join(path, 'calls.npy'), mmap_mode='r')
+        self.index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.sources = self.index['source_call']
+
+    def __len__(self):
+        return len(self.calls)
+
+    def subscriber(self, source_call):
+        """The records of the calls of a subscriber, ordered by id_call
+
+        Return:
+            **numpy.ndarray:** A view of the memory-mapped calls, empty if none
+        """
+        key = (source_call or '').encode('ascii', 'replace')
+        index = int(np.searchsorted(self.sources, key))
+        if len(key) > CALL_DTYPE['source_call'].itemsize or index >= len(self.sources) \
+                or self.sources[index] != key:
+            return self.calls[:0]
+        return self.calls[self.index['start'][index]:self.index['stop'][index]]
+
+    def bill_calls(self, source_call):
+        """The calls of a subscriber as ``CallBill._get_calls`` reads them
+
+        Return:
+            **list:** (destination_call, call start, duration seconds, price cents) tuples
+        """
+        calls = self.subscriber(source_call)
+        return [
+            (destination.decode() or None, start.replace(tzinfo=dt_timezone.utc),
+             duration_seconds, price_cents)
+            for destination, start, duration_seconds, price_cents in zip(
+                calls['destination_call'].tolist(), calls['start_call'].tolist(),
+                calls['duration_seconds'].tolist(), calls['price_cents'].tolist()
+            )
+        ]
+
+
+_archives = {}
+_lock = threading.Lock()
+
+
+def get_archive(month, year):
+    """The archive of a month, None if it is not archived
+
+    The opened archives are kept by the process, and opened again when the month
+    is archived again.
+    """
+    directory = archive_dir()
+    if not directory:
+        return None
+    path = month_path(directory, month, year)
+    try:
+        stat = os.stat(os.path.join(path, 'calls.npy'))
+    except OSError:
+        return None
+
+    version = (stat.st_ino, stat.st_mtime_ns)
+    with _lock:
+        cached = _archives.get(path)
+        if cached is None or cached[0] != version:
+            cached = _archives[path] = (version, CallArchive(path))
+        return cached[1]
+
+
+def discard_archive(month, year, directory=None):
+    """Delete the archive of a month, whose calls changed since it was written
+
+    Args:
+        **directory (str):** The directory of the archives, default ``BILL_ARCHIVE['DIR']``
+
+    Return:
+        **bool:** True if the month was archived
+    """
+    directory = directory or archive_dir()
+    if not directory:
+        return False
+    path = month_path(directory, month, year)
+    stale = path + '.stale'
+    try:
+        # Renamed first, so no process opens an archive being deleted
+        os.rename(path, stale)
+    except OSError:
+        return False
+    shutil.rmtree(stale, ignore_errors=True)
+    with _lock:
+        _archives.pop(path, None)
+    return True
+
+
+def write_archive(directory, month, year, period_range, chunk_size=10000):
+    """Write the completed calls of a month to its archive, replacing the previous one
+
+    The calls are read with a server-side cursor and written to a memory-mapped
+    file, in chunks; the archive is moved into place once complete.
+
+    Args:
+        **directory (str):** The directory of the archives
+
+        **month (int), year (int):** The month
+
+        **period_range (tuple):** (first instant of the month, first of the next one)
+
+    Return:
+        **CallArchive:** The archive written
+    """
+    CompletedCall = apps.get_model('registercall', 'CompletedCall')
+    path = month_path(directory, month, year)
+    partial = path + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    try:
+        with transaction.atomic():
+            calls = CompletedCall.objects.filter(end_call__gte=period_range[0],
+                                                 end_call__lt=period_range[1])
+            total = calls.count()
+            archived = np.lib.format.open_memmap(os.path.join(partial, 'calls.npy'), mode='w+',
+                                                 dtype=CALL_DTYPE, shape=(total,))
+            rows = calls.order_by('source_call', 'id_call').values_list(
+                'id_call', 'source_call', 'destination_call', 'start_call', 'duration_seconds',
+                'price_cents'
+            ).iterator(chunk_size=chunk_size)
+
+            sources, starts, position, chunk = [], [], 0, []
+            for row in rows:
+                id_call, source_call, destination_call, start_call = row[:4]
+                source_call = source_call or ''
+                if not sources or sources[-1] != source_call:
+                    sources.append(source_call)
+                    starts.append(position + len(chunk))
+                chunk.append((id_call, source_call, destination_call or '',
+                              timezone.make_naive(start_call, dt_timezone.utc)) + row[4:])
+                if len(chunk) == chunk_size:
+                    position = _write_chunk(archived, position, chunk)
+            position = _write_chunk(archived, position, chunk)
+        if position != total:
+            raise ValueError("{} calls counted, {} read".format(total, position))
+        archived.flush()
+        del archived
+
+        # The database orders the subscribers by its collation, the index by their bytes
+        index = np.array(list(zip(sources, starts, starts[1:] + [position])), dtype=INDEX_DTYPE)
+        np.save(os.path.join(partial, 'index.npy'),
+                index[np.argsort(index['source_call'], kind='stable')])
+
+        previous = path + '.previous'
+        if os.path.exists(path):
+            os.rename(path, previous)
+        os.rename(partial, path)
+        shutil.rmtree(previous, ignore_errors=True)
+        # A call of the month committed while it was read discarded the previous archive
+        if calls.count() != total:
+            discard_archive(month, year, directory)
+            raise ValueError("The calls of {:02d}/{} changed while archived".format(month, year))
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return CallArchive(path)
+
+
+def _write_chunk(archived, position, chunk):
+    """Write the rows of the chunk at the position, emptying it
+
+    Return:
+        **int:** The position after the chunk
+    """
+    end = position + len(chunk)
+    if end > len(archived):
+        raise ValueError("More calls than the {} counted".format(len(archived)))
+    archived[position:end] = np.array(chunk, dtype=CALL_DTYPE)
+    chunk.clear()
+    return end
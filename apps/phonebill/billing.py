@@ -0,0 +1,194 @@
+"""
+    Month-end bill run: bills every subscriber with calls completed in a period,
+    in chunks of subscribers computed by a pool of processes
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+
+import django
+from django.db import IntegrityError, connection, connections, transaction
+
+from apps.registercall.models import CompletedCall
+
+from .functions import CallBill
+from .models import PhoneBill, Registers
+
+
+def _init_worker():
+    """Each process opens its own database connections"""
+    django.setup()
+    connections.close_all()
+
+
+def _returns_bulk_ids():
+    features = connection.features
+    return getattr(features, 'can_return_rows_from_bulk_insert',
+                   getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+def billed_subscribers(month, year, subscribers=None):
+    """The subscribers with a phone bill of the period, by a run or the API
+
+    Args:
+        **subscribers (list, optional):** Only the ones among these subscribers
+
+    Return:
+        **set:** The subscribers
+    """
+    phone_bills = PhoneBill.objects.filter(period='{:02d}/{}'.format(month, year))
+    if subscribers is not None:
+        phone_bills = phone_bills.filter(source_call__in=subscribers)
+    return set(phone_bills.values_list('source_call', flat=True))
+
+
+def bill_chunk(period, subscribers, batch_size=1000, attempts=3):
+    """Bill a chunk of subscribers, writing their bills in one transaction
+
+    The subscribers with a phone bill of the period already, e.g. created
+    through the API meanwhile, are skipped. A bill created while the chunk is
+    written fails the chunk on the unique subscriber period, which is written
+    again without it.
+
+    Args:
+        **period (str):** The reference period (mm/yyyy), already validated
+
+        **subscribers (list):** The subscribers of the chunk, sorted
+
+    Return:
+        **int:** Number of billed subscribers
+    """
+    bill = CallBill(None, period)
+    bill.validate_period()
+    period_start, period_end = bill._get_period_range()
+    period = '{:02d}/{}'.format(bill.month, bill.year)
+
+    billed = billed_subscribers(bill.month, bill.year, subscribers)
+    subscribers = [source_call for source_call in subscribers if source_call not in billed]
+    if not subscribers:
+        return 0
+
+    calls = CompletedCall.objects.filter(
+        source_call__in=subscribers,
+        end_call__gte=period_start,
+        end_call__lt=period_end
+    ).order_by('source_call', 'id_call').values_list(
+        'source_call', 'destination_call', 'start_call', 'duration_seconds', 'price_cents'
+    )
+    bills = [(source_call, CallBill.format_calls(call[1:] for call in subscriber_calls))
+             for source_call, subscriber_calls in groupby(calls, key=lambda call: call[0])]
+
+    for attempt in range(attempts):
+        try:
+            _write_bills(period, bills, batch_size)
+            return len(bills)
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+        billed = billed_subscribers(bill.month, bill.year,
+                                    [source_call for source_call, _ in bills])
+        bills = [(source_call, lines) for source_call, lines in bills if source_call not in billed]
+
+
+def _write_bills(period, bills, batch_size):
+    """Write the phone bills of the period and their records in one transaction"""
+    with transaction.atomic():
+        phone_bills = [PhoneBill(source_call=source_call, period=period)
+                       for source_call, _ in bills]
+        if _returns_bulk_ids():
+            PhoneBill.objects.bulk_create(phone_bills, batch_size=batch_size)
+        else:
+            for phone_bill in phone_bills:
+                phone_bill.save()
+
+        Registers.objects.bulk_create(
+            [Registers(phone_bill=phone_bill, **line)
+             for phone_bill, (_, lines) in zip(phone_bills, bills) for line in lines],
+            batch_size=batch_size
+        )
+
+
+class BillingRun:
+    """Class responsible for the month-end bill run of all the subscribers
+
+    The subscribers are split in chunks. Each chunk is billed in one transaction,
+    so a crashed run is resumed from the subscribers without a phone bill of the
+    period yet.
+
+    Attributes
+        **period (str):** The reference period (mm/yyyy)
+
+        **chunk_size (int):** Number of subscribers of each chunk
+
+        **workers (int):** Number of processes, the chunks are billed in this
+        process if lower than 2
+    """
+
+    def __init__(self, period, chunk_size=1000, workers=1):
+        self.period = period
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.bill = CallBill(None, period)
+
+    def validate_params(self):
+        """Validate the parameters
+
+        Return
+            **bool:** True if is valid, False otherwise.
+        """
+        if not self.bill.validate_period() or self.chunk_size < 1:
+            return False
+        self.period = '{:02d}/{}'.format(self.bill.month, self.bill.year)
+        return True
+
+    def _get_subscribers(self):
+        """The subscribers with calls completed in the period that are not billed yet
+
+        Return:
+            **list:** Sorted subscribers
+        """
+        period_start, period_end = self.bill._get_period_range()
+        subscribers = CompletedCall.objects.filter(
+            end_call__gte=period_start,
+            end_call__lt=period_end
+        ).order_by('source_call').values_list('source_call', flat=True).distinct()
+
+        billed = billed_subscribers(self.bill.month, self.bill.year)
+        return [source_call for source_call in subscribers.iterator()
+                if source_call and source_call not in billed]
+
+    def chunks(self):
+        """The chunks of subscribers not billed yet"""
+        subscribers = self._get_subscribers()
+        return [subscribers[index:index + self.chunk_size]
+                for index in range(0, len(subscribers), self.chunk_size)]
+
+    def run(self, report=None):
+        """Bill the chunks not billed yet
+
+        Args:
+            **report (callable, optional):** Called with the number of subscribers
+            billed so far and the total, after each chunk
+
+        Return:
+            **int:** Number of billed subscribers
+        """
+        chunks = self.chunks()
+        total = sum(len(chunk) for chunk in chunks)
+        billed = 0
+
+        if self.workers < 2:
+            for chunk in chunks:
+                billed += bill_chunk(self.period, chunk)
+                if report:
+                    report(billed, total)
+            return billed
+
+        # The processes must not share the connections of this one
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+            futures = [pool.submit(bill_chunk, self.period, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                billed += future.result()
+                if report:
+                    report(billed, total)
+        return billed
@@ -0,0 +1,214 @@
+"""
+    Cache of the computed bills, keyed by subscriber and period.
+
+    The backend is chosen by the ``BILL_CACHE`` setting. The cached bill of a
+    subscriber period is invalidated when a call ending in that period is completed
+    (see ``CompletedCall``), in the cache of the process completing it: a cache
+    not shared by the processes keeps the bills a short time only
+
+    An invalidation changes the generation of the subscriber period. A bill is
+    cached with the generation read before it was computed, and is not served
+    once the generation changed: a call completed while the bill was computed
+    does not leave the bill without it in the cache.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class BillCache:
+    """Base class of the bill cache backends, keeping the hit/miss/eviction counters
+
+    Subclasses implement ``_get``, ``_set``, ``_generation``, ``_delete`` (which
+    changes the generation) and ``_clear``.
+    """
+
+    def __init__(self, **options):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @staticmethod
+    def key(source_call, month, year):
+        return 'bill:{}:{:02d}/{}'.format(source_call, month, year)
+
+    def get(self, source_call, month, year):
+        """The cached bill, None if it is not cached"""
+        bill = self._get(self.key(source_call, month, year))
+        if bill is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [dict(line) for line in bill]
+
+    def generation(self, source_call, month, year):
+        """The generation of the subscriber period, read before computing its bill"""
+        return self._generation(self.key(source_call, month, year))
+
+    def set(self, source_call, month, year, bill, generation=None):
+        """Cache the bill, computed from the database as of the generation (default:
+        the current one); a bill of a previous generation is not served
+        """
+        self._set(self.key(source_call, month, year), [dict(line) for line in bill],
+                  generation)
+
+    def invalidate(self, source_call, month, year):
+        self._delete(self.key(source_call, month, year))
+        self.invalidations += 1
+
+    def clear(self):
+        self._clear()
+
+    def stats(self):
+        return {
+            'backend': type(self).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class LocMemBillCache(BillCache):
+    """In-process cache, evicting the least recently used bill
+
+    The other processes (workers, ingest, commands) do not invalidate it: a bill
+    is kept for ``timeout`` seconds at most.
+
+    The generations are the ticks of a clock of the invalidations, kept for the
+    ``max_entries`` periods invalidated last; the periods before have the
+    generation of the last one dropped.
+
+    Options:
+        **max_entries (int):** Maximum number of cached bills
+
+        **timeout (int):** Seconds to keep a bill, None to keep it until it is invalidated
+    """
+
+    def __init__(self, max_entries=1024, timeout=60, **options):
+        super(LocMemBillCache, self).__init__(**options)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._bills = OrderedDict()
+        self._invalidated = OrderedDict()
+        self._clock = self._floor = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._bills.get(key)
+            if entry is None:
+                return None
+            expires, bill = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._bills[key]
+                return None
+            self._bills.move_to_end(key)
+            return bill
+
+    def _generation(self, key):
+        with self._lock:
+            return self._invalidated.get(key, self._floor)
+
+    def _set(self, key, bill, generation):
+        expires = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._lock:
+            if generation is not None and generation != self._invalidated.get(key, self._floor):
+                return
+            self._bills[key] = (expires, bill)
+            self._bills.move_to_end(key)
+            while len(self._bills) > self.max_entries:
+                self._bills.popitem(last=False)
+                self.evictions += 1
+
+    def _delete(self, key):
+        with self._lock:
+            self._bills.pop(key, None)
+            self._clock += 1
+            self._invalidated[key] = self._clock
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_entries:
+                _, dropped = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, dropped)
+
+    def _clear(self):
+        with self._lock:
+            self._bills.clear()
+            self._invalidated.clear()
+            self._clock += 1
+            self._floor = self._clock
+
+    def stats(self):
+        stats = super(LocMemBillCache, self).stats()
+        stats.update({'entries': len(self._bills), 'max_entries': self.max_entries})
+        return stats
+
+
+class DjangoBillCache(BillCache):
+    """Cache shared by the processes, through a Django cache (e.g. file or database based)
+
+    The evictions are made by the Django cache itself and are not counted. A bill
+    is cached with its generation, a random token kept in the cache next to it
+    and replaced by an invalidation; a bill is served if the token has not changed.
+
+    Options:
+        **alias (str):** The alias of the cache in the ``CACHES`` setting
+
+        **timeout (int):** Seconds to keep a bill, None to keep it until it is invalidated
+    """
+
+    def __init__(self, alias='default', timeout=None, **options):
+        super(DjangoBillCache, self).__init__(**options)
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def _generation_key(key):
+        return key + ':generation'
+
+    def _get(self, key):
+        cached = self.cache.get_many([key, self._generation_key(key)])
+        entry = cached.get(key)
+        if entry is None or entry[0] != cached.get(self._generation_key(key)):
+            return None
+        return entry[1]
+
+    def _generation(self, key):
+        generation = self.cache.get(self._generation_key(key))
+        if generation is None:
+            # Evicted or never invalidated: a new one, no cached bill has it
+            self.cache.add(self._generation_key(key), uuid.uuid4().hex, None)
+            generation = self.cache.get(self._generation_key(key))
+        return generation
+
+    def _set(self, key, bill, generation):
+        if generation is None:
+            generation = self._generation(key)
+        self.cache.set(key, (generation, bill), self.timeout)
+
+    def _delete(self, key):
+        self.cache.set(self._generation_key(key), uuid.uuid4().hex, None)
+        self.cache.delete(key)
+
+    def _clear(self):
+        self.cache.clear()
+
+
+_bill_cache = None
+
+
+def get_bill_cache():
+    """The bill cache of the process, built from the ``BILL_CACHE`` setting"""
+    global _bill_cache
+    if _bill_cache is None:
+        config = getattr(settings, 'BILL_CACHE', {})
+        backend = import_string(config.get('BACKEND', 'apps.phonebill.cache.LocMemBillCache'))
+        _bill_cache = backend(**config.get('OPTIONS', {}))
+    return _bill_cache
@@ -0,0 +1,95 @@
+"""
+    Price formatting. ``babel.numbers.format_currency`` parses the pattern and
+    looks up the locale data on every call; the formatter here does it once and
+    then formats integer cents with plain string operations, keeping the output
+    byte-identical to Babel
+"""
+from decimal import ROUND_HALF_EVEN, Decimal
+from functools import lru_cache
+
+from babel.numbers import (format_currency, get_currency_symbol, get_decimal_symbol,
+                           get_group_symbol, parse_pattern)
+
+PRICE_CURRENCY = 'R$'
+PRICE_PATTERN = '¤¤ ###,###,##0.00'
+PRICE_LOCALE = 'pt'
+
+
+class CurrencyFormatter:
+    """Class responsible for formatting prices in cents with a pattern compiled once
+
+    Attributes
+        **currency (str):** The currency code, placed at the ``¤¤`` of the pattern
+
+        **pattern (str):** The number pattern, with two decimal places
+
+        **locale (str):** The locale of the decimal and group symbols
+
+        **maxsize (int):** Number of formatted prices kept in memory
+    """
+
+    def __init__(self, currency, pattern, locale, maxsize=4096):
+        self.currency = currency
+        self.pattern = pattern
+        self.locale = locale
+
+        number_pattern = parse_pattern(pattern)
+        if tuple(number_pattern.frac_prec) != (2, 2):
+            raise ValueError("The pattern must have two decimal places: {}".format(pattern))
+
+        self.prefix = self._symbols(number_pattern.prefix[0])
+        self.suffix = self._symbols(number_pattern.suffix[0])
+        self.decimal = get_decimal_symbol(locale)
+        self.group = get_group_symbol(locale)
+        self.primary, self.secondary = number_pattern.grouping
+        self.min_digits = number_pattern.int_prec[0]
+
+        self.format_cents = lru_cache(maxsize=maxsize)(self._format_cents)
+
+    def _symbols(self, affix):
+        return affix.replace('¤¤', self.currency) \
+            .replace('¤', get_currency_symbol(self.currency, self.locale))
+
+    def _group(self, digits):
+        if len(digits) <= self.primary:
+            return digits
+        groups = [digits[-self.primary:]]
+        digits = digits[:-self.primary]
+        while len(digits) > self.secondary:
+            groups.append(digits[-self.secondary:])
+            digits = digits[:-self.secondary]
+        groups.append(digits)
+        return self.group.join(reversed(groups))
+
+    def _format_cents(self, cents):
+        """Format a price in cents: e.g. 54 -> R$ 0,54
+
+        Args:
+            **cents (int):** The price, in cents
+
+        Return:
+            **str:** The formatted price
+        """
+        cents = int(cents)
+        if cents < 0:
+            # Not a call price, left to Babel
+            return format_currency(Decimal(cents).scaleb(-2), self.currency, self.pattern,
+                                   locale=self.locale)
+        units, cents = divmod(cents, 100)
+        return '{}{}{}{:02d}{}'.format(self.prefix, self._group(str(units).zfill(self.min_digits)),
+                                       self.decimal, cents, self.suffix)
+
+    def format(self, price):
+        """Format a price, rounded to cents as Babel does
+
+        Args:
+            **price (float):** The price
+
+        Return:
+            **str:** The formatted price
+        """
+        cents = (Decimal(str(price)) * 100).to_integral_value(ROUND_HALF_EVEN)
+        return self.format_cents(int(cents))
+
+
+price_formatter = CurrencyFormatter(PRICE_CURRENCY, PRICE_PATTERN, PRICE_LOCALE)
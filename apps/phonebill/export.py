@@ -0,0 +1,116 @@
+"""
+    Export of the bill lines of all the subscribers of a period as CSV, optionally
+    gzip compressed, for the ledger of the finance
+
+    The completed calls are read with a server-side cursor (``QuerySet.iterator``)
+    and written in chunks as they are read, so the memory does not grow with the
+    number of lines, either in a streaming response or in a file.
+"""
+import csv
+import io
+import zlib
+from itertools import islice
+
+from apps.registercall.models import CompletedCall
+
+from .functions import CallBill
+
+HEADER = ('id_call', 'source_call', 'destination_call', 'start_date_call', 'start_time_call',
+          'duration_seconds', 'price_cents')
+
+
+class BillExport:
+    """Class responsible for exporting the bill lines of a period
+
+    Attributes:
+        **period (str, optional):** The reference period (mm/yyyy) of a closed month.
+        If the reference period is not informed the last month is exported
+
+        **compress (bool):** Gzip compress the CSV
+
+        **chunk_size (int):** Lines read from the cursor and written at a time
+    """
+
+    def __init__(self, period=None, compress=False, chunk_size=2000):
+        self.period = period
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.lines = 0
+        self._bill = CallBill(None, period)
+
+    def validate_params(self):
+        """Validate the period, the same way as the one of a bill
+
+        Return:
+            **bool:** True if is valid, False otherwise.
+        """
+        if not self._bill.validate_period() or self.chunk_size < 1:
+            return False
+        self.period = '{:02d}/{}'.format(self._bill.month, self._bill.year)
+        return True
+
+    @property
+    def filename(self):
+        month, year = self.period.split('/')
+        return 'bills-{}-{}.csv{}'.format(year, month, '.gz' if self.compress else '')
+
+    @property
+    def content_type(self):
+        return 'application/gzip' if self.compress else 'text/csv; charset=utf-8'
+
+    def _calls(self):
+        """The completed calls of the period, by subscriber, in the order of the
+        (source_call, end_call) index
+        """
+        period_start, period_end = self._bill._get_period_range()
+        return CompletedCall.objects.filter(
+            end_call__gte=period_start,
+            end_call__lt=period_end
+        ).order_by('source_call', 'end_call', 'id_call').values_list(
+            'id_call', 'source_call', 'destination_call', 'start_call', 'duration_seconds',
+            'price_cents'
+        ).iterator(chunk_size=self.chunk_size)
+
+    def _rows(self):
+        for id_call, source, destination, start, duration_seconds, price_cents in self._calls():
+            self.lines += 1
+            yield (id_call, source, destination, start.date(), start.time(), duration_seconds,
+                   price_cents)
+
+    def csv_chunks(self):
+        """The CSV, with its header, in chunks of ``chunk_size`` lines
+
+        Return:
+            **generator:** UTF-8 encoded chunks
+        """
+        self.lines = 0
+        rows = self._rows()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(HEADER)
+        while True:
+            writer.writerows(islice(rows, self.chunk_size))
+            data = buffer.getvalue()
+            if not data:
+                return
+            buffer.seek(0)
+            buffer.truncate()
+            yield data.encode('utf-8')
+
+    def chunks(self):
+        """The export, gzip compressed if ``compress``
+
+        Return:
+            **generator:** Chunks of bytes
+        """
+        if not self.compress:
+            yield from self.csv_chunks()
+            return
+
+        # wbits 31: a gzip stream, so the file can be read with gunzip
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in self.csv_chunks():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
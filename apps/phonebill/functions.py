@@ -1,12 +1,16 @@
-from babel.numbers import format_currency
-from datetime import timedelta, time, date, datetime
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from django.utils import timezone
 
-from apps.registercall.choices import CallTypes
-from apps.registercall.models import RegisterCall
+from apps.registercall.models import CompletedCall
+from systemcall.metrics import span
 
-from .rates import PriceRates
+from . import tariff
+from .archive import get_archive
+from .cache import get_bill_cache
+from .currency import price_formatter
+from .plans import call_span, get_tariffs
+from .tariff import call_epochs
 
 
 class CallBill:
@@ -32,7 +36,14 @@ class CallBill:
         """
         if not self.source_call:
             return False
+        return self.validate_period()
 
+    def validate_period(self):
+        """Validate the reference period, setting ``month`` and ``year``
+
+        Return
+            **bool:** True if is valid, False otherwise.
+        """
         if not self.period:
             self.period = (timezone.now() - relativedelta(months=1))
             self.month, self.year = self.period.month, self.period.year
@@ -55,8 +66,17 @@ class CallBill:
                 return False
         return True
 
+    def _get_period_range(self):
+        """The period as a half-open range of timestamps, so the filters can use the indexes
+
+        Return
+            **tuple:** (first instant of the period, first instant of the next period)
+        """
+        start = timezone.make_aware(datetime(self.year, self.month, 1))
+        return start, start + relativedelta(months=1)
+
     @staticmethod
-    def _get_price(start, end):
+    def _get_price(start, end, source_call=None, destination_call=None):
         """Calculate the call price according the start/end arguments
 
         The are two tarrif times:
@@ -72,24 +92,25 @@ class CallBill:
 
             Standing charge: R$ 0,36 * Call charge/minute: R$ 0,00
 
+        The rates are the ones of the tariff plan of the subscriber (see ``plans``),
+        the rules above are the ones of the standard plan.
+
         Args:
             **start (datetime):** Call start date/time
 
             **end (datetime):** Call end date/time
 
+            **source_call (str, optional):** The subscriber, for its tariff plan
+
+            **destination_call (str, optional):** The destination, for its prefix rate
+
         Return:
-            **float:** Call price
+            **str:** Formatted call price
         """
         if not (isinstance(start, datetime) or isinstance(end, datetime)):
             return "R$ 0.00"
-        minutes = 0
-        while start < end:
-            start = start + timedelta(minutes=1)
-            if start < end and time(6, 0, 0) < start.time() < time(22, 0, 0):
-                minutes += 1
-
-        price = (minutes * PriceRates.MINUTE) + PriceRates.FLAT_RATE
-        return format_currency(price, 'R$', '¤¤ ###,###,##0.00', locale='pt')
+        priced = get_tariffs().price(source_call, destination_call, *call_span(start, end))
+        return price_formatter.format_cents(priced.cents)
 
     @staticmethod
     def _get_duration(start, end):
@@ -105,11 +126,64 @@ class CallBill:
         """
         if not (isinstance(start, datetime) or isinstance(end, datetime)):
             return "0h0m0s"
-        diff = (end - start).total_seconds()
-        minutes, seconds = divmod(diff, 60)
-        hours, minutes = divmod(minutes, 60)
+        starts, ends = call_epochs(start, end)
+        return CallBill._format_duration(tariff.durations(starts, ends))
+
+    @staticmethod
+    def _format_duration(seconds):
+        hours, minutes, seconds = tariff.split_durations(seconds)
         return "{}h{}m{}s".format(int(hours), int(minutes), int(seconds))
 
+    def _get_calls(self):
+        """Get the subscriber calls completed in the period, already priced, from the
+        archive of the period if it is archived (see ``archive``)
+
+        Return:
+            **iterable:** (destination_call, call start, duration seconds, price cents) tuples
+        """
+        archive = get_archive(self.month, self.year)
+        if archive is not None:
+            return archive.bill_calls(self.source_call)
+
+        period_start, period_end = self._get_period_range()
+
+        return CompletedCall.objects.filter(
+            source_call=self.source_call,
+            end_call__gte=period_start,
+            end_call__lt=period_end
+        ).order_by('id_call').values_list('destination_call', 'start_call',
+                                          'duration_seconds', 'price_cents')
+
+    def _get_bill(self):
+        """Read and format the bill of the period from the completed calls
+
+        Return:
+            **list:** The records of the bill, empty if there is no call in the period
+        """
+        return self.format_calls(self._get_calls())
+
+    @classmethod
+    def format_calls(cls, calls):
+        """Make the records of a bill from the completed calls
+
+        The prices and durations are kept as integers, they are formatted by
+        the serializers (see ``PriceField`` and ``DurationField``)
+
+        Args:
+            **calls (iterable):** (destination_call, call start, duration seconds,
+            price cents) tuples
+
+        Return:
+            **list:** The records of the bill
+        """
+        return [{
+            'destination_call': destination,
+            'duration_seconds': int(duration_seconds),
+            'price_cents': price_cents,
+            'start_date_call': start.date(),
+            'start_time_call': start.time(),
+        } for destination, start, duration_seconds, price_cents in calls]
+
     def calculate_bill(self):
         """Calculate the bill for each call in period according the price rules
 
@@ -121,63 +195,33 @@ class CallBill:
                     'destination_call': The phone number  that received the call
                     'start_date_call': The date of when the event occured
                     'start_time_call': The time of when the event occured
-                    'durantion_call': Durantion of the call
-                    'price_call': Price of the call
+                    'duration_seconds': Duration of the call, in seconds
+                    'price_cents': Price of the call, in cents
                 }
         """
-        self.validate_params()
-
-        # First step: get all the phone calls from the subscriber
-        subscriber_calls = RegisterCall.objects.filter(
-            source_call=self.source_call
-        ).values_list('id_call', flat=True)
-
-        # Second step: get all the calls in the period, filtering by type=2 (end)
-        calls_in_period = RegisterCall.objects.filter(
-            timestamp_call__year=self.year,
-            timestamp_call__month=self.month,
-            type_call=CallTypes.END,
-            id_call__in=subscriber_calls
-        ).values_list('id_call', flat=True)
-
-        if not calls_in_period:
-            period_not_found = [{
-                'error': 'The close of this call corresponds to the following month'
-            }]
-
+        period_not_found = [{
+            'error': 'The close of this call corresponds to the following month'
+        }]
+        if not self.validate_params():
             return period_not_found
 
-        # Finaly, get the calls that should be priced
-        calls = RegisterCall.objects.filter(id_call__in=calls_in_period)\
-            .order_by('id_call', 'timestamp_call')
-
-        # Grouping the same call_ids in one registry
-        group_call = {}
-        for call in calls:
-            group_call.setdefault(call.id_call, {})
-            if call.destination_call:
-                group_call[call.id_call]['destination_call'] = call.destination_call
-
-            if call.type_call == CallTypes.START:
-                group_call[call.id_call]['call_start'] = call.timestamp_call
+        bill_cache = get_bill_cache()
+        with span('bill.cache'):
+            # Read first: a call completed while the bill is computed changes it
+            generation = bill_cache.generation(self.source_call, self.month, self.year)
+            bill_data = bill_cache.get(self.source_call, self.month, self.year)
+        if bill_data is None:
+            # The calls are priced when they are completed, the bill only reads them. The
+            # bill is cached and persisted, it is not read from the lagging replicas
+            with span('bill.query'):
+                calls = list(self._get_calls())
+            with span('bill.formatting'):
+                bill_data = self.format_calls(calls)
+            if bill_data:
+                bill_cache.set(self.source_call, self.month, self.year, bill_data, generation)
             else:
-                group_call[call.id_call]['call_end'] = call.timestamp_call
-
-        # Formating the data, and calculating the price and duration of the calls
-        bill_data = []
-        for bill in group_call.values():
-            start = bill.get('call_start')
-            end = bill.get('call_end')
-            if not (start or end):
-                continue
-
-            bill_data.append({
-                'destination_call': bill.get('destination_call'),
-                'duration_call': self._get_duration(start, end),
-                'price_call': self._get_price(start, end),
-                'start_date_call': start.date(),
-                'start_time_call': start.time(),
-            })
+                # A period without calls may get them later, it is not cached
+                bill_data = period_not_found
 
         self.result = bill_data
 
@@ -0,0 +1,43 @@
+import os
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.phonebill.archive import archive_dir, write_archive
+from apps.phonebill.functions import CallBill
+
+
+class Command(BaseCommand):
+    help = ("Write the priced calls of a closed month to its columnar archive, from which "
+            "the bills of the month are read. A read cache: the calls stay in the database")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', required=True, help="The closed month (MM/YYYY)")
+        parser.add_argument('--archive-dir', help="The directory of the archives "
+                                                  "(default: BILL_ARCHIVE_DIR)")
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help="Calls read from the database and written at a time")
+
+    def handle(self, *args, **options):
+        directory = options['archive_dir'] or archive_dir()
+        if not directory or not os.path.isdir(directory):
+            raise CommandError("Not a directory: {}. Set --archive-dir or BILL_ARCHIVE_DIR"
+                               .format(directory))
+
+        bill = CallBill(None, options['period'])
+        if not bill.validate_period() or options['chunk_size'] < 1 or \
+                date(bill.year, bill.month, 1) >= timezone.localdate().replace(day=1):
+            raise CommandError("The period must be MM/YYYY of a closed month "
+                               "and the chunk size must be positive")
+
+        period_range = bill._get_period_range()
+        try:
+            archive = write_archive(directory, bill.month, bill.year, period_range,
+                                    options['chunk_size'])
+        except ValueError as error:
+            raise CommandError("{}, archive the month again".format(error))
+        self.stdout.write("{:02d}/{}: {} calls of {} subscribers archived to {}".format(
+            bill.month, bill.year, len(archive), len(archive.index), archive.path
+        ))
+        self.stdout.write(self.style.SUCCESS("{:02d}/{} archived".format(bill.month, bill.year)))
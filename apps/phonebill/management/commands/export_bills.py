@@ -0,0 +1,46 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.phonebill.export import BillExport
+
+
+class Command(BaseCommand):
+    help = ("Export the bill lines of all the subscribers of a period as CSV, "
+            "optionally gzip compressed")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', help="The reference period (MM/YYYY), the last month "
+                                             "by default")
+        parser.add_argument('--gzip', action='store_true', help="Gzip compress the CSV")
+        parser.add_argument('--output', help="The file written, '-' for the standard output "
+                                             "(default: bills-YYYY-MM.csv[.gz])")
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="Lines read from the database and written at a time")
+
+    def handle(self, *args, **options):
+        export = BillExport(options['period'], options['gzip'], options['chunk_size'])
+        if not export.validate_params():
+            raise CommandError("The period must be MM/YYYY of a closed month "
+                               "and the chunk size must be positive")
+
+        output = options['output'] or export.filename
+        started = time.monotonic()
+        if output == '-':
+            for chunk in export.chunks():
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        with open(output, 'wb') as export_file:
+            for chunk in export.chunks():
+                export_file.write(chunk)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            "{}: {} lines written to {} in {:.1f}s ({:.0f} lines/s)".format(
+                export.period, export.lines, output, elapsed,
+                export.lines / elapsed if elapsed else 0
+            )
+        ))
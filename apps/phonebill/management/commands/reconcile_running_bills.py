@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from apps.phonebill.models import RunningBill
+from apps.registercall.models import CompletedCall
+
+FIELDS = ('calls', 'billable_minutes', 'total_cents', 'last_end_call')
+
+
+class Command(BaseCommand):
+    help = ("Check the running bills of a period against a full recompute from the "
+            "completed calls, and fix the ones that differ with --fix")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', help="The period (MM/YYYY), the current month by default")
+        parser.add_argument('--fix', action='store_true',
+                            help="Write the recomputed totals of the running bills that differ")
+
+    @staticmethod
+    def _recompute(period):
+        """The totals of the completed calls of the period, by subscriber"""
+        start = timezone.make_aware(datetime.strptime(period, '%m/%Y'))
+        calls = CompletedCall.objects.filter(end_call__gte=start,
+                                             end_call__lt=start + relativedelta(months=1))
+        return calls, {
+            row['source_call']: tuple(row[field] for field in FIELDS)
+            for row in calls.values('source_call').annotate(
+                calls=Count('id_call'), billable_minutes=Sum('billable_minutes'),
+                total_cents=Sum('price_cents'), last_end_call=Max('end_call')
+            ).order_by()
+        }
+
+    @staticmethod
+    def _fix(period, calls, source_call, totals):
+        if totals is None:
+            RunningBill.objects.filter(source_call=source_call, period=period).delete()
+            return
+        last_id_call = calls.filter(source_call=source_call).order_by(
+            '-end_call', 'id_call').values_list('id_call', flat=True).first()
+        RunningBill.objects.update_or_create(
+            source_call=source_call, period=period,
+            defaults=dict(zip(FIELDS, totals), last_id_call=last_id_call)
+        )
+
+    def handle(self, *args, **options):
+        period = options['period'] or RunningBill.period_of(timezone.now())
+        try:
+            period = RunningBill.period_of(datetime.strptime(period, '%m/%Y'))
+        except ValueError:
+            raise CommandError("Invalid period: {}. Must be MM/YYYY".format(period))
+
+        with transaction.atomic():
+            calls, expected = self._recompute(period)
+            # A running bill whose calls were all removed is the same as none
+            running = {
+                bill.source_call: tuple(getattr(bill, field) for field in FIELDS)
+                for bill in RunningBill.objects.filter(period=period, calls__gt=0).iterator()
+            }
+
+            differ = 0
+            for source_call in sorted(set(expected) | set(running)):
+                totals = expected.get(source_call)
+                if running.get(source_call) == totals:
+                    continue
+                differ += 1
+                self.stdout.write("{}: running {} != recomputed {}".format(
+                    source_call, running.get(source_call), totals
+                ))
+                if options['fix']:
+                    self._fix(period, calls, source_call, totals)
+
+        if differ and not options['fix']:
+            raise CommandError("{}: {} of {} running bills differ from the completed calls"
+                               .format(period, differ, len(expected)))
+        self.stdout.write(self.style.SUCCESS("{}: {} running bills checked, {} fixed".format(
+            period, len(expected), differ
+        )))
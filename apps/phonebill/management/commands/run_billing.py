@@ -0,0 +1,40 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.phonebill.billing import BillingRun
+
+
+class Command(BaseCommand):
+    help = ("Bill every subscriber with calls completed in the period, in parallel. "
+            "An interrupted run is resumed by running it again")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', required=True, help="The reference period (MM/YYYY)")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Number of processes (default: number of CPUs)")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of subscribers billed in each transaction")
+
+    def handle(self, *args, **options):
+        run = BillingRun(options['period'], options['chunk_size'], options['workers'])
+        if not run.validate_params():
+            raise CommandError("The period must be MM/YYYY of a closed month "
+                               "and the chunk size must be positive")
+
+        started = time.monotonic()
+
+        def report(billed, total):
+            elapsed = time.monotonic() - started
+            self.stdout.write("{}/{} subscribers billed ({:.0f} subscribers/s)".format(
+                billed, total, billed / elapsed if elapsed else 0
+            ))
+
+        billed = run.run(report)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            "{}: {} subscribers billed in {:.1f}s ({:.0f} subscribers/s)".format(
+                run.period, billed, elapsed, billed / elapsed if elapsed else 0
+            )
+        ))
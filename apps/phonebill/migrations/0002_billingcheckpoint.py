@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phonebill', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=7)),
+                ('first_source_call', models.CharField(max_length=11)),
+                ('last_source_call', models.CharField(max_length=11)),
+                ('subscribers', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['period', 'first_source_call'],
+            },
+        ),
+    ]
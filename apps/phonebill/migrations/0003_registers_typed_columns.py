@@ -0,0 +1,97 @@
+import re
+
+from django.db import migrations, models
+
+DURATION = re.compile(r'^(\d+)h(\d+)m(\d+)s$')
+
+
+def parse_duration(value):
+    match = DURATION.match((value or '').strip())
+    if not match:
+        return 0
+    hours, minutes, seconds = (int(part) for part in match.groups())
+    return (hours * 60 + minutes) * 60 + seconds
+
+
+def parse_price(value):
+    # "R$ 1.234,56": the prices always have two decimal places
+    digits = re.sub(r'\D', '', value or '')
+    return int(digits) if digits else 0
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h{}m{}s'.format(hours, minutes, seconds)
+
+
+def format_price(cents):
+    reais, cents = divmod(cents, 100)
+    return 'R$ {},{:02d}'.format('{:,}'.format(reais).replace(',', '.'), cents)
+
+
+def to_typed_columns(apps, schema_editor):
+    Registers = apps.get_model('phonebill', 'Registers')
+    registers = []
+    for register in Registers.objects.only('duration_call', 'price_call').iterator():
+        register.duration_seconds = parse_duration(register.duration_call)
+        register.price_cents = parse_price(register.price_call)
+        registers.append(register)
+        if len(registers) == 1000:
+            Registers.objects.bulk_update(registers, ['duration_seconds', 'price_cents'])
+            registers = []
+    Registers.objects.bulk_update(registers, ['duration_seconds', 'price_cents'])
+
+
+def to_formatted_columns(apps, schema_editor):
+    Registers = apps.get_model('phonebill', 'Registers')
+    registers = []
+    for register in Registers.objects.only('duration_seconds', 'price_cents').iterator():
+        register.duration_call = format_duration(register.duration_seconds)
+        register.price_call = format_price(register.price_cents)
+        registers.append(register)
+        if len(registers) == 1000:
+            Registers.objects.bulk_update(registers, ['duration_call', 'price_call'])
+            registers = []
+    Registers.objects.bulk_update(registers, ['duration_call', 'price_call'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phonebill', '0002_billingcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registers',
+            name='duration_seconds',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='registers',
+            name='price_cents',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='registers',
+            name='duration_call',
+            field=models.CharField(blank=True, max_length=11, null=True),
+        ),
+        migrations.AlterField(
+            model_name='registers',
+            name='price_call',
+            field=models.CharField(blank=True, max_length=11, null=True),
+        ),
+        migrations.RunPython(to_typed_columns, to_formatted_columns),
+        migrations.RemoveField(
+            model_name='registers',
+            name='duration_call',
+        ),
+        migrations.RemoveField(
+            model_name='registers',
+            name='price_call',
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:42
+
+import datetime
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_standard_plan(apps, schema_editor):
+    """The default plan, with the rates of ``PriceRates``"""
+    TariffPlan = apps.get_model('phonebill', 'TariffPlan')
+    DestinationRate = apps.get_model('phonebill', 'DestinationRate')
+    TimeBand = apps.get_model('phonebill', 'TimeBand')
+
+    plan = TariffPlan.objects.create(name='Standard', default=True)
+    rate = DestinationRate.objects.create(plan=plan, prefix='', standing_charge_cents=36,
+                                          minute_cents=0)
+    TimeBand.objects.bulk_create([
+        TimeBand(rate=rate, day_type=day_type, start=datetime.time(6, 0),
+                 end=datetime.time(22, 0), minute_cents=9)
+        for day_type in ('weekday', 'weekend', 'holiday')
+    ])
+
+
+def delete_standard_plan(apps, schema_editor):
+    apps.get_model('phonebill', 'TariffPlan').objects.filter(name='Standard').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phonebill', '0003_registers_typed_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DestinationRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(blank=True, default='', max_length=11, validators=[django.core.validators.RegexValidator('^\\d*$', 'Only digits.')])),
+                ('standing_charge_cents', models.PositiveIntegerField()),
+                ('minute_cents', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['plan', 'prefix'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TariffPlan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=60, unique=True)),
+                ('default', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TimeBand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_type', models.CharField(choices=[('weekday', 'Weekday'), ('weekend', 'Weekend'), ('holiday', 'Holiday')], max_length=7)),
+                ('start', models.TimeField()),
+                ('end', models.TimeField()),
+                ('minute_cents', models.PositiveIntegerField()),
+                ('rate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bands', to='phonebill.DestinationRate')),
+            ],
+            options={
+                'ordering': ['rate', 'day_type', 'start'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SubscriberPlan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_call', models.CharField(max_length=11, unique=True)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='subscribers', to='phonebill.TariffPlan')),
+            ],
+            options={
+                'ordering': ['source_call'],
+            },
+        ),
+        migrations.AddField(
+            model_name='destinationrate',
+            name='plan',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates', to='phonebill.TariffPlan'),
+        ),
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('name', models.CharField(blank=True, max_length=60)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holidays', to='phonebill.TariffPlan')),
+            ],
+            options={
+                'ordering': ['plan', 'date'],
+                'unique_together': {('plan', 'date')},
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='destinationrate',
+            unique_together={('plan', 'prefix')},
+        ),
+        migrations.RunPython(create_standard_plan, delete_standard_plan),
+    ]
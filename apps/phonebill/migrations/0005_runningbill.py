@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:46
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def fill_running_bills(apps, schema_editor):
+    """The running bills of the calls completed before the migration"""
+    CompletedCall = apps.get_model('registercall', 'CompletedCall')
+    RunningBill = apps.get_model('phonebill', 'RunningBill')
+
+    totals = {}
+    for id_call, source_call, end_call, minutes, cents in CompletedCall.objects.order_by(
+            'end_call', 'id_call').values_list('id_call', 'source_call', 'end_call',
+                                               'billable_minutes', 'price_cents').iterator():
+        period = timezone.localtime(end_call).strftime('%m/%Y')
+        running = totals.get((source_call, period))
+        if running is None:
+            running = totals[source_call, period] = RunningBill(source_call=source_call,
+                                                                period=period)
+        running.calls += 1
+        running.billable_minutes += minutes
+        running.total_cents += cents
+        running.last_id_call, running.last_end_call = id_call, end_call
+    RunningBill.objects.bulk_create(totals.values(), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phonebill', '0004_tariff_plans'),
+        ('registercall', '0005_opencall'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunningBill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_call', models.CharField(max_length=11)),
+                ('period', models.CharField(max_length=7)),
+                ('calls', models.PositiveIntegerField(default=0)),
+                ('billable_minutes', models.PositiveIntegerField(default=0)),
+                ('total_cents', models.PositiveIntegerField(default=0)),
+                ('last_id_call', models.PositiveIntegerField(blank=True, null=True)),
+                ('last_end_call', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('source_call', 'period')},
+            },
+        ),
+        migrations.RunPython(fill_running_bills, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+"""
+    One phone bill per subscriber and period: the periods of the bills created
+    through the API are stored as informed (m/YYYY or mm/YYYY), they are written
+    as mm/YYYY. Of the bills of a subscriber period created more than once the
+    last one is kept, the previous ones are deleted with their records.
+
+    The checkpoints of the bill runs are dropped: a run is resumed from the
+    subscribers without a phone bill of the period.
+"""
+from django.db import migrations, models
+
+
+def unique_periods(apps, schema_editor):
+    PhoneBill = apps.get_model('phonebill', 'PhoneBill')
+    Registers = apps.get_model('phonebill', 'Registers')
+
+    latest, previous = {}, []
+    for pk, source_call, period in PhoneBill.objects.order_by('id').values_list(
+            'id', 'source_call', 'period').iterator():
+        month, _, year = (period or '').partition('/')
+        if month.isdigit():
+            normalized = '{:02d}/{}'.format(int(month), year)
+            if normalized != period:
+                PhoneBill.objects.filter(pk=pk).update(period=normalized)
+            period = normalized
+        if (source_call, period) in latest and period:
+            previous.append(latest[source_call, period])
+        latest[source_call, period] = pk
+
+    for start in range(0, len(previous), 1000):
+        chunk = previous[start:start + 1000]
+        Registers.objects.filter(phone_bill_id__in=chunk).delete()
+        PhoneBill.objects.filter(pk__in=chunk).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phonebill', '0005_runningbill'),
+    ]
+
+    operations = [
+        migrations.RunPython(unique_periods, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='phonebill',
+            constraint=models.UniqueConstraint(fields=('source_call', 'period'),
+                                               name='phonebill_source_call_period'),
+        ),
+        migrations.DeleteModel(
+            name='BillingCheckpoint',
+        ),
+    ]
@@ -1,4 +1,13 @@
-from django.db import models
+from datetime import datetime, time
+
+from dateutil.relativedelta import relativedelta
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.validators import RegexValidator
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
 
 class PhoneBill(models.Model):
@@ -8,6 +17,8 @@ class PhoneBill(models.Model):
     the number chosen for the account and ``period`` (optional), if the period
     is not informed, the account comes with the last month closed
 
+    A subscriber has one phone bill of a period, which is stored as mm/YYYY.
+
     Attributes:
         **period (str):** The period to generate the account (mm / YYYY)
 
@@ -17,6 +28,12 @@ class PhoneBill(models.Model):
     period = models.CharField(max_length=7, blank=True, null=True)
     source_call = models.CharField(max_length=11)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source_call', 'period'],
+                                    name='phonebill_source_call_period'),
+        ]
+
     def __str__(self):
         return "Source Call: {} | Period: {}".format(self.source_call, self.period)
 
@@ -31,9 +48,9 @@ class Registers(models.Model):
 
         **destination_call (str):** Call destination number
 
-        **duration_call (str):** Duration of the call
+        **duration_seconds (int):** Duration of the call, in seconds
 
-        **price_call (str):** Price of the call
+        **price_cents (int):** Price of the call, in cents
         (Calculated by a fixed rate and the duration of the call in minutes)
 
         **start_date_call (date):** Call record date
@@ -43,8 +60,8 @@ class Registers(models.Model):
 
     phone_bill = models.ForeignKey(PhoneBill, related_name='bill', on_delete=models.PROTECT)
     destination_call = models.CharField(max_length=11)
-    duration_call = models.CharField(max_length=11)
-    price_call = models.CharField(max_length=11)
+    duration_seconds = models.PositiveIntegerField()
+    price_cents = models.PositiveIntegerField()
     start_date_call = models.DateField(max_length=11)
     start_time_call = models.TimeField()
 
@@ -52,9 +69,10 @@ class Registers(models.Model):
         ordering = ['phone_bill']
 
     def __str__(self):
+        # The phone bill is shown by its id, so the str does not query it
         field_values = []
-        for field in self._meta.get_fields():
-            field_values.append(str(field.name) + ": " + str(getattr(self, field.name, '')))
+        for field in self._meta.concrete_fields:
+            field_values.append(str(field.name) + ": " + str(field.value_from_object(self)))
         return ' | '.join(field_values)
 
     def phone_origin(self):
@@ -62,3 +80,400 @@ class Registers(models.Model):
 
     def period_call(self):
         return self.phone_bill.period
+
+
+# Adds the totals of the new calls, the latest call end is kept
+UPSERT_RUNNING_BILLS = """
+    INSERT INTO {table} (source_call, period, calls, billable_minutes, total_cents,
+                         last_id_call, last_end_call)
+    VALUES {values}
+    ON CONFLICT (source_call, period) DO UPDATE SET
+        calls = {table}.calls + EXCLUDED.calls,
+        billable_minutes = {table}.billable_minutes + EXCLUDED.billable_minutes,
+        total_cents = {table}.total_cents + EXCLUDED.total_cents,
+        last_id_call = CASE WHEN {table}.last_end_call IS NULL
+                                 OR EXCLUDED.last_end_call > {table}.last_end_call
+                            THEN EXCLUDED.last_id_call ELSE {table}.last_id_call END,
+        last_end_call = CASE WHEN {table}.last_end_call IS NULL
+                                  OR EXCLUDED.last_end_call > {table}.last_end_call
+                             THEN EXCLUDED.last_end_call ELSE {table}.last_end_call END
+"""
+
+
+class DayTypes:
+    """The kinds of day of the time bands of a tariff plan"""
+
+    WEEKDAY = 'weekday'
+    WEEKEND = 'weekend'
+    HOLIDAY = 'holiday'
+
+    CHOICES = (
+        (WEEKDAY, 'Weekday'),
+        (WEEKEND, 'Weekend'),
+        (HOLIDAY, 'Holiday'),
+    )
+
+
+class TariffPlan(models.Model):
+    """TariffPlan Model
+
+    The rates of the calls of a subscriber, compiled into an in-memory structure
+    by ``apps.phonebill.plans`` and reloaded when the plan changes.
+
+    Attributes:
+        **name (str):** Unique name of the plan
+
+        **default (bool):** The plan of the subscribers without a ``SubscriberPlan``
+
+        **updated_at (datetime):** Last change of the plan or of its rates, bands,
+        holidays or subscribers
+    """
+
+    name = models.CharField(max_length=60, unique=True)
+    default = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        from .plans import invalidate_tariffs
+        super(TariffPlan, self).save(*args, **kwargs)
+        invalidate_tariffs()
+
+
+class TariffPlanItemQuerySet(models.QuerySet):
+    """The items of the tariff plans, updated touching their plans"""
+
+    def update(self, **kwargs):
+        with transaction.atomic():
+            pks = list(self.values_list('pk', flat=True))
+            plan_ids = set(self.values_list(self.model.plan_lookup, flat=True))
+            updated = super(TariffPlanItemQuerySet, self).update(**kwargs)
+            plan_ids.update(self.model.objects.filter(pk__in=pks).values_list(
+                self.model.plan_lookup, flat=True))
+            TariffPlanItem.touch_plans(plan_ids)
+        return updated
+
+    update.alters_data = True
+
+
+class TariffPlanItem(models.Model):
+    """Base of the models of a tariff plan: a change touches the ``updated_at`` of
+    the plan, so the other processes reload their compiled plans
+
+    The deletes, of the queryset and the admin too, touch the plans on the
+    ``post_delete`` signal.
+    """
+
+    # The lookup of the plan of the item
+    plan_lookup = 'plan_id'
+
+    objects = TariffPlanItemQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def _plan_ids(self):
+        return [self.plan_id]
+
+    @staticmethod
+    def touch_plans(plan_ids):
+        TariffPlan.objects.filter(pk__in=plan_ids).update(updated_at=timezone.now())
+        from .plans import invalidate_tariffs
+        invalidate_tariffs()
+
+    def save(self, *args, **kwargs):
+        plan_ids = set(self._plan_ids())
+        if self.pk is not None:
+            previous = type(self).objects.filter(pk=self.pk).first()
+            if previous is not None:
+                plan_ids.update(previous._plan_ids())
+        super(TariffPlanItem, self).save(*args, **kwargs)
+        self.touch_plans(plan_ids)
+
+
+class DestinationRate(TariffPlanItem):
+    """DestinationRate Model
+
+    The rates of a plan for the destinations starting with a prefix, the longest
+    matching prefix is applied. The empty prefix matches every destination.
+
+    Attributes:
+        **plan (fk):** The tariff plan
+
+        **prefix (str):** Digits of the start of the destination numbers
+
+        **standing_charge_cents (int):** Fixed charge of each call, in cents
+
+        **minute_cents (int):** Charge per minute outside the time bands, in cents
+    """
+
+    plan = models.ForeignKey(TariffPlan, related_name='rates', on_delete=models.CASCADE)
+    prefix = models.CharField(max_length=11, blank=True, default='',
+                              validators=[RegexValidator(r'^\d*$', "Only digits.")])
+    standing_charge_cents = models.PositiveIntegerField()
+    minute_cents = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['plan', 'prefix']
+        unique_together = (('plan', 'prefix'),)
+
+    def __str__(self):
+        return "{} | {}".format(self.plan_id, self.prefix or '*')
+
+
+class TimeBand(TariffPlanItem):
+    """TimeBand Model
+
+    The charge per minute of a destination rate between two times of a kind of
+    day. A minute tick exactly on the limit of two bands is charged the lowest
+    of their rates.
+
+    Attributes:
+        **rate (fk):** The destination rate
+
+        **day_type (str):** weekday, weekend or holiday
+
+        **start (time):** Start of the band
+
+        **end (time):** End of the band (excluding), 00:00 is the end of the day
+
+        **minute_cents (int):** Charge per minute, in cents
+    """
+
+    rate = models.ForeignKey(DestinationRate, related_name='bands', on_delete=models.CASCADE)
+    day_type = models.CharField(max_length=7, choices=DayTypes.CHOICES)
+    start = models.TimeField()
+    end = models.TimeField()
+    minute_cents = models.PositiveIntegerField()
+
+    class Meta:
+        ordering = ['rate', 'day_type', 'start']
+
+    def __str__(self):
+        return "{} | {} {}-{}".format(self.rate, self.day_type, self.start, self.end)
+
+    plan_lookup = 'rate__plan_id'
+
+    def _plan_ids(self):
+        return [DestinationRate.objects.filter(pk=self.rate_id).values_list(
+            'plan_id', flat=True).first()]
+
+    def clean(self):
+        super(TimeBand, self).clean()
+        if self.end != time(0) and self.end <= self.start:
+            raise ValidationError({'end': ["Must be after the start (00:00 is the end "
+                                           "of the day)."]})
+
+
+class Holiday(TariffPlanItem):
+    """Holiday Model
+
+    A date billed with the holiday time bands of a plan.
+
+    Attributes:
+        **plan (fk):** The tariff plan
+
+        **date (date):** The holiday
+
+        **name (str):** Name of the holiday
+    """
+
+    plan = models.ForeignKey(TariffPlan, related_name='holidays', on_delete=models.CASCADE)
+    date = models.DateField()
+    name = models.CharField(max_length=60, blank=True)
+
+    class Meta:
+        ordering = ['plan', 'date']
+        unique_together = (('plan', 'date'),)
+
+    def __str__(self):
+        return "{} | {}".format(self.date, self.name)
+
+
+class SubscriberPlan(TariffPlanItem):
+    """SubscriberPlan Model
+
+    The tariff plan of a subscriber, instead of the default plan.
+
+    Attributes:
+        **source_call (str):** The subscriber phone number
+
+        **plan (fk):** The tariff plan
+    """
+
+    source_call = models.CharField(max_length=11, unique=True)
+    plan = models.ForeignKey(TariffPlan, related_name='subscribers', on_delete=models.PROTECT)
+
+    class Meta:
+        ordering = ['source_call']
+
+    def __str__(self):
+        return "{} | {}".format(self.source_call, self.plan_id)
+
+
+class RunningBill(models.Model):
+    """RunningBill Model
+
+    The totals of the calls of a subscriber period so far, updated when each
+    call is completed, changed or removed (see ``CompletedCall``), so the bill of
+    the current month is read with an unique lookup. ``reconcile_running_bills``
+    checks them against the completed calls.
+
+    Attributes:
+        **source_call (str):** The subscriber phone number
+
+        **period (str):** The period where the calls end (mm/YYYY)
+
+        **calls (int):** Number of completed calls
+
+        **billable_minutes (int):** Minutes charged at a non-zero rate
+
+        **total_cents (int):** Total price of the calls, in cents
+
+        **last_id_call (int):** The id_call of the latest call end processed
+
+        **last_end_call (datetime):** The timestamp of the latest call end processed
+    """
+
+    source_call = models.CharField(max_length=11)
+    period = models.CharField(max_length=7)
+    calls = models.PositiveIntegerField(default=0)
+    billable_minutes = models.PositiveIntegerField(default=0)
+    total_cents = models.PositiveIntegerField(default=0)
+    last_id_call = models.PositiveIntegerField(null=True, blank=True)
+    last_end_call = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('source_call', 'period'),)
+
+    def __str__(self):
+        return "Source Call: {} | Period: {}".format(self.source_call, self.period)
+
+    @staticmethod
+    def period_of(end_call):
+        """The period (mm/YYYY) of a call end timestamp"""
+        if timezone.is_aware(end_call):
+            end_call = timezone.localtime(end_call)
+        return end_call.strftime('%m/%Y')
+
+    @classmethod
+    def totals(cls, calls):
+        """The totals of the completed calls by subscriber period
+
+        Args:
+            **calls (iterable):** CompletedCall instances
+
+        Return:
+            **dict:** [calls, billable minutes, cents, last end, last id_call]
+            by (source_call, period)
+        """
+        totals = {}
+        for call in calls:
+            total = totals.setdefault((call.source_call, cls.period_of(call.end_call)),
+                                      [0, 0, 0, None, None])
+            total[0] += 1
+            total[1] += call.billable_minutes
+            total[2] += call.price_cents
+            if total[3] is None or call.end_call > total[3]:
+                total[3], total[4] = call.end_call, call.id_call
+        return totals
+
+    @classmethod
+    def _upsert_supported(cls):
+        return connection.vendor == 'postgresql' or (
+            connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 24)
+        )
+
+    @classmethod
+    def add(cls, calls):
+        """Add the calls just completed to the totals of their subscriber periods,
+        in one statement where the database has an upsert
+        """
+        totals = cls.totals(calls)
+        if not totals:
+            return
+        if not cls._upsert_supported():
+            for key, total in totals.items():
+                cls._add_one(key, total)
+            return
+
+        table = connection.ops.quote_name(cls._meta.db_table)
+        end_field = cls._meta.get_field('last_end_call')
+        rows = [(source_call, period, count, minutes, cents, last_id,
+                 end_field.get_db_prep_value(last_end, connection))
+                for (source_call, period), (count, minutes, cents, last_end, last_id)
+                in totals.items()]
+        batch_size = connection.ops.bulk_batch_size(['source_call'] * len(rows[0]), rows)
+        with connection.cursor() as cursor:
+            for index in range(0, len(rows), batch_size):
+                batch = rows[index:index + batch_size]
+                cursor.execute(UPSERT_RUNNING_BILLS.format(
+                    table=table, values=', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(batch))
+                ), [value for row in batch for value in row])
+
+    @classmethod
+    def _add_one(cls, key, total):
+        count, minutes, cents, last_end, last_id = total
+        with transaction.atomic():
+            running, _ = cls.objects.select_for_update().get_or_create(
+                source_call=key[0], period=key[1]
+            )
+            running.calls += count
+            running.billable_minutes += minutes
+            running.total_cents += cents
+            if running.last_end_call is None or last_end > running.last_end_call:
+                running.last_end_call, running.last_id_call = last_end, last_id
+            running.save()
+
+    @classmethod
+    def remove(cls, calls):
+        """Remove the calls changed or deleted from the totals of their subscriber periods
+
+        A running bill whose latest call end is removed gets the latest of the other
+        completed calls of the period.
+        """
+        calls = list(calls)
+        removed = [call.id_call for call in calls]
+        for (source_call, period), (count, minutes, cents, _, _) in cls.totals(calls).items():
+            running = cls.objects.filter(source_call=source_call, period=period)
+            running.update(
+                calls=models.F('calls') - count,
+                billable_minutes=models.F('billable_minutes') - minutes,
+                total_cents=models.F('total_cents') - cents
+            )
+            running = running.filter(last_id_call__in=removed)
+            if running.exists():
+                last_id, last_end = cls._latest_call(source_call, period, removed)
+                running.update(last_id_call=last_id, last_end_call=last_end)
+
+    @staticmethod
+    def _latest_call(source_call, period, excluded):
+        """The (id_call, call end) of the latest completed call of a subscriber period,
+        out of the excluded id_calls, (None, None) if there is none
+        """
+        completed_call = apps.get_model('registercall', 'CompletedCall')
+        start = timezone.make_aware(datetime.strptime(period, '%m/%Y'))
+        latest = completed_call.objects.filter(
+            source_call=source_call, end_call__gte=start,
+            end_call__lt=start + relativedelta(months=1)
+        ).exclude(id_call__in=excluded).order_by('-end_call', 'id_call').values_list(
+            'id_call', 'end_call'
+        ).first()
+        return latest or (None, None)
+
+
+@receiver(post_delete)
+def plan_deleted(sender, instance, **kwargs):
+    """Reload the compiled plans when a plan or one of its items is deleted, by the
+    instance, the queryset or the cascade of the plan
+    """
+    if isinstance(instance, TariffPlanItem):
+        TariffPlanItem.touch_plans(instance._plan_ids())
+    elif isinstance(instance, TariffPlan):
+        from .plans import invalidate_tariffs
+        invalidate_tariffs()
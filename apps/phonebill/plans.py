@@ -0,0 +1,558 @@
+"""
+    Tariff plans compiled into immutable in-memory structures, so pricing a call
+    does not touch the database: the time bands of each kind of day are sorted
+    boundaries, the destination rates are a prefix trie and the subscribers are
+    mapped to their plan.
+
+    Pricing a call costs O(bands + prefix length + holidays of the call), whatever
+    its duration: the ticks of the whole weeks are counted in closed form. A batch
+    of calls is priced in vectorized NumPy passes over the calls of each
+    destination rate (see ``CompiledPlan.price_calls``). The compiled plans of the
+    process are rebuilt when a plan is changed (see ``TariffPlanItem``), and at
+    most every ``TARIFF_PLANS['CHECK_INTERVAL']`` seconds a query checks for the
+    changes made by the other processes.
+"""
+import threading
+import time as timer
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import time, timedelta
+from types import MappingProxyType
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+
+from .models import DayTypes, DestinationRate, Holiday, SubscriberPlan, TariffPlan, TimeBand
+from .rates import PriceRates
+from .tariff import EPOCH, MICROSECONDS
+
+MINUTE = 60 * MICROSECONDS
+DAY = 24 * 60 * MINUTE
+WEEK = 7
+
+# The band of the standard plan
+STANDARD_START = time(6, 0, 0)
+STANDARD_END = time(22, 0, 0)
+
+DAY_TYPES = (DayTypes.WEEKDAY, DayTypes.WEEKEND, DayTypes.HOLIDAY)
+EPOCH_ORDINAL = EPOCH.date().toordinal()
+EPOCH_WEEKDAY = EPOCH.weekday()
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# The charge per minute between the boundaries (microseconds of the day) of a day:
+# rates[i] applies before bounds[i], the last one until the end of the day
+DaySchedule = namedtuple('DaySchedule', ('bounds', 'rates'))
+PricedCall = namedtuple('PricedCall', ('minutes', 'cents'))
+PricedCalls = namedtuple('PricedCalls', ('minutes', 'cents'))
+
+
+def _time_to_microseconds(value):
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * MICROSECONDS \
+        + value.microsecond
+
+
+def call_span(start, end):
+    """Wall clock epoch microseconds of a call start and end, keeping the duration
+    of ``end - start`` (see ``tariff.call_epochs``)
+
+    Return:
+        **tuple:** (start, end) epoch microseconds
+    """
+    start_microseconds = (start.replace(tzinfo=None) - EPOCH) // ONE_MICROSECOND
+    return start_microseconds, start_microseconds + (end - start) // ONE_MICROSECOND
+
+
+def _weekday_type(day):
+    """The index in ``DAY_TYPES`` of a day counted from the epoch, ignoring the holidays"""
+    return 1 if (day + EPOCH_WEEKDAY) % WEEK >= 5 else 0
+
+
+class CompiledRate(namedtuple('CompiledRate', ('prefix', 'standing_charge_cents',
+                                               'schedules'))):
+    """The rates of the destinations of a prefix
+
+    Attributes:
+        **prefix (str):** Digits of the start of the destination numbers
+
+        **standing_charge_cents (int):** Fixed charge of each call
+
+        **schedules (tuple):** DaySchedule of the weekdays, weekends and holidays
+    """
+
+    __slots__ = ()
+
+
+class PrefixTrie:
+    """Immutable trie of the destination rates, by the digits of their prefixes
+
+    Each node is a (rate, children) pair, the children keyed by digit.
+    """
+
+    __slots__ = ('_root',)
+
+    def __init__(self, rates):
+        root = [None, {}]
+        for rate in rates:
+            node = root
+            for digit in rate.prefix:
+                node = node[1].setdefault(digit, [None, {}])
+            node[0] = rate
+        self._root = self._freeze(root)
+
+    @classmethod
+    def _freeze(cls, node):
+        return node[0], MappingProxyType({digit: cls._freeze(child)
+                                          for digit, child in node[1].items()})
+
+    def lookup(self, number):
+        """The rate of the longest prefix of the number, None if no prefix matches"""
+        rate, children = self._root
+        for digit in number or '':
+            node = children.get(digit)
+            if node is None:
+                break
+            if node[0] is not None:
+                rate = node[0]
+            children = node[1]
+        return rate
+
+
+class CompiledPlan:
+    """Class responsible for pricing the calls of a tariff plan
+
+    A minute is charged for each completed 60 seconds cycle, counted from the
+    call start, that ends before the call end, at the rate of the band where
+    the cycle ends. A cycle ending exactly on the limit of two bands is charged
+    the lowest of their rates.
+
+    Attributes:
+        **name (str):** Name of the plan
+
+        **rates (PrefixTrie):** The destination rates
+
+        **holidays (frozenset):** Ordinals of the holidays
+    """
+
+    __slots__ = ('name', 'rates', 'holidays', '_holiday_days')
+
+    def __init__(self, name, rates, holidays=()):
+        self.name = name
+        self.rates = PrefixTrie(rates)
+        self.holidays = frozenset(holidays)
+        # The holidays as days counted from the epoch, sorted
+        self._holiday_days = tuple(sorted(ordinal - EPOCH_ORDINAL for ordinal in self.holidays))
+
+    def _day_type(self, day, holidays=True):
+        """The index in ``DAY_TYPES`` of a day counted from the epoch"""
+        if holidays and EPOCH_ORDINAL + day in self.holidays:
+            return 2
+        return _weekday_type(day)
+
+    def _rate(self, destination_call):
+        rate = self.rates.lookup(destination_call)
+        if rate is None:
+            raise ValueError("No rate for the destination {} in the plan {}".format(
+                destination_call, self.name))
+        return rate
+
+    def price(self, destination_call, start, end):
+        """Price a call
+
+        The first and last days of the call are walked band by band; the whole days
+        between them are counted in whole weeks, whose ticks are the same every week,
+        and the days a holiday changes are walked again.
+
+        Args:
+            **destination_call (str):** The phone number receiving the call
+
+            **start (int):** Call start, wall clock epoch microseconds
+
+            **end (int):** Call end, wall clock epoch microseconds
+
+        Return:
+            **PricedCall:** minutes charged (at a non-zero rate) and price in cents
+        """
+        rate = self._rate(destination_call)
+        ticks = (end - start - 1) // MINUTE if end > start else 0
+        if not ticks:
+            return PricedCall(0, rate.standing_charge_cents)
+
+        last = start + ticks * MINUTE
+        first_day, last_day = start // DAY, last // DAY
+        if last_day - first_day <= 2 * WEEK:
+            minutes, cents = self._price_days(rate, start, last, first_day, last_day)
+            return PricedCall(minutes, rate.standing_charge_cents + cents)
+
+        days = (first_day + 1, last_day - 1)
+        weeks, rest = divmod(days[1] - days[0] + 1, WEEK)
+        week = self._price_days(rate, start, last, days[0], days[0] + WEEK - 1, holidays=False)
+        totals = [
+            self._price_days(rate, start, last, first_day, first_day),
+            self._price_days(rate, start, last, last_day, last_day),
+            (weeks * week[0], weeks * week[1]),
+            self._price_days(rate, start, last, days[1] - rest + 1, days[1], holidays=False),
+        ]
+        for day in self._holiday_changes(*days):
+            changed = self._price_days(rate, start, last, day, day)
+            regular = self._price_days(rate, start, last, day, day, holidays=False)
+            totals.append((changed[0] - regular[0], changed[1] - regular[1]))
+        return PricedCall(sum(total[0] for total in totals),
+                          rate.standing_charge_cents + sum(total[1] for total in totals))
+
+    def _holiday_changes(self, first_day, last_day):
+        """The days between first_day and last_day that are holidays or follow one,
+        whose first tick is on the limit with the day before
+        """
+        holidays = self._holiday_days[bisect_left(self._holiday_days, first_day - 1):
+                                      bisect_right(self._holiday_days, last_day)]
+        return sorted({day for holiday in holidays for day in (holiday, holiday + 1)
+                       if first_day <= day <= last_day})
+
+    def _price_days(self, rate, start, last, first_day, last_day, holidays=True):
+        """The ticks of a call, from ``start`` to ``last``, in the days first_day to
+        last_day (inclusive), each tick on the limit of two bands at the lowest of their
+        rates; ``holidays`` False prices the holidays as the other days of the week
+
+        Return:
+            **tuple:** (minutes, cents)
+        """
+        count = (last - start) // MINUTE
+
+        def ticks_until(position):
+            # Ticks start + k * MINUTE (1 <= k <= count) lower or equal to position
+            return min(max((position - start) // MINUTE, 0), count)
+
+        minutes = cents = 0
+        previous = rate.schedules[self._day_type(first_day - 1, holidays)].rates[-1]
+        for day in range(first_day, last_day + 1):
+            lower = day * DAY
+            schedule = rate.schedules[self._day_type(day, holidays)]
+            for index, minute_cents in enumerate(schedule.rates):
+                upper = day * DAY + (schedule.bounds[index] if index < len(schedule.bounds)
+                                     else DAY)
+                # The tick on the lower limit, if any, at the lowest adjacent rate
+                boundary = ticks_until(lower) - ticks_until(lower - 1)
+                lowest = min(previous, minute_cents)
+                inside = ticks_until(upper - 1) - ticks_until(lower)
+                minutes += (boundary if lowest else 0) + (inside if minute_cents else 0)
+                cents += boundary * lowest + inside * minute_cents
+                previous, lower = minute_cents, upper
+        return minutes, cents
+
+    def price_calls(self, destinations, starts, ends):
+        """Price a batch of calls, in vectorized passes over the calls of each
+        destination rate (see ``price``)
+
+        The calls that span a holiday are priced one by one.
+
+        Args:
+            **destinations (list):** The phone numbers receiving the calls
+
+            **starts (array):** Call starts, wall clock epoch microseconds
+
+            **ends (array):** Call ends, wall clock epoch microseconds
+
+        Return:
+            **PricedCalls:** minutes charged and prices in cents, integer arrays
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        minutes = np.zeros(len(starts), dtype=np.int64)
+        cents = np.zeros(len(starts), dtype=np.int64)
+
+        rates, groups = {}, {}
+        for index, destination_call in enumerate(destinations):
+            rate = rates.get(destination_call)
+            if rate is None:
+                rate = rates[destination_call] = self._rate(destination_call)
+            groups.setdefault(id(rate), (rate, []))[1].append(index)
+
+        for rate, indexes in groups.values():
+            indexes = np.array(indexes, dtype=np.int64)
+            group_starts, group_ends = starts[indexes], ends[indexes]
+            ticks = np.where(group_ends > group_starts,
+                             (group_ends - group_starts - 1) // MINUTE, 0)
+            lasts = group_starts + ticks * MINUTE
+            one_by_one = self._spans_holiday(group_starts // DAY, lasts // DAY)
+            if one_by_one.any():
+                for index in indexes[one_by_one].tolist():
+                    priced = self.price(destinations[index], int(starts[index]), int(ends[index]))
+                    minutes[index], cents[index] = priced
+            group = indexes[~one_by_one]
+            group_minutes, group_cents = _price_spans(rate, group_starts[~one_by_one],
+                                                      lasts[~one_by_one])
+            minutes[group] = group_minutes
+            cents[group] = group_cents + rate.standing_charge_cents
+        return PricedCalls(minutes, cents)
+
+    def _spans_holiday(self, first_days, last_days):
+        """Whether a holiday, or the day before, is one of the days of each call"""
+        if not self._holiday_days:
+            return np.zeros(len(first_days), dtype=bool)
+        holidays = np.array(self._holiday_days, dtype=np.int64)
+        return np.searchsorted(holidays, last_days, side='right') \
+            > np.searchsorted(holidays, first_days - 1, side='left')
+
+
+def _price_spans(rate, starts, lasts):
+    """The ticks of the calls, from their start to their last tick, without holidays
+
+    The ticks up to a position are the ticks of the whole days since the day of
+    the start, whole weeks and the days left, plus the ticks of its own day: the
+    ticks of the calls are the difference of the ticks up to the last and up to
+    the start. The ticks of a day depend on the kind of the day and of the day
+    before (its first tick is on their limit), and on the offset of the ticks in
+    the minute.
+
+    Return:
+        **tuple:** (minutes, cents) integer arrays
+    """
+    offsets = starts % MINUTE
+    first_days = starts // DAY
+    # The (kind of the day, kind of the day before) of each weekday, Monday first
+    kinds = [(_weekday_type(day), _weekday_type(day - 1))
+             for day in range(-EPOCH_WEEKDAY, WEEK - EPOCH_WEEKDAY)]
+    whole_days = {kind: _price_day(rate, kind, offsets, DAY - 1) for kind in set(kinds)}
+
+    # The ticks of the whole days since Monday, twice over for the weeks wrapping around
+    cumulative = np.zeros((2 * WEEK + 1, len(starts), 2), dtype=np.int64)
+    for weekday in range(2 * WEEK):
+        cumulative[weekday + 1] = cumulative[weekday] + whole_days[kinds[weekday % WEEK]]
+    columns = np.arange(len(starts))
+
+    def ticks_until(positions):
+        days = positions // DAY
+        weeks, rest = np.divmod(days - first_days, WEEK)
+        weekdays = (first_days + EPOCH_WEEKDAY) % WEEK
+        total = weeks[:, None] * cumulative[WEEK, columns] \
+            + cumulative[weekdays + rest, columns] - cumulative[weekdays, columns]
+        day_weekdays = (days + EPOCH_WEEKDAY) % WEEK
+        for kind in set(kinds):
+            selected = np.isin(day_weekdays, [weekday for weekday in range(WEEK)
+                                              if kinds[weekday] == kind])
+            total[selected] += _price_day(rate, kind, offsets[selected],
+                                          positions[selected] % DAY)
+        return total
+
+    total = ticks_until(lasts) - ticks_until(starts)
+    return total[:, 0], total[:, 1]
+
+
+def _price_day(rate, kind, offsets, limits):
+    """The ticks of a day, at the offsets of the minute, up to the limits (microseconds
+    of the day, inclusive)
+
+    Args:
+        **kind (tuple):** The indexes in ``DAY_TYPES`` of the day and of the day before
+
+    Return:
+        **ndarray:** (minutes, cents) of each offset
+    """
+    def ticks_until(position):
+        # Ticks offset + j * MINUTE (j >= 0) lower or equal to position (>= -1)
+        return (position - offsets) // MINUTE + 1
+
+    schedule = rate.schedules[kind[0]]
+    previous = rate.schedules[kind[1]].rates[-1]
+    total = np.zeros((len(offsets), 2), dtype=np.int64)
+    lower = 0
+    for index, minute_cents in enumerate(schedule.rates):
+        upper = schedule.bounds[index] if index < len(schedule.bounds) else DAY
+        boundary = np.maximum(ticks_until(np.minimum(lower, limits)) - ticks_until(lower - 1), 0)
+        lowest = min(previous, minute_cents)
+        inside = np.maximum(ticks_until(np.minimum(upper - 1, limits)) - ticks_until(lower), 0)
+        total[:, 0] += (boundary if lowest else 0) + (inside if minute_cents else 0)
+        total[:, 1] += boundary * lowest + inside * minute_cents
+        previous, lower = minute_cents, upper
+    return total
+
+
+class CompiledTariffs:
+    """The compiled plans, and the plan of each subscriber
+
+    Attributes:
+        **default (CompiledPlan):** The plan of the subscribers without a plan
+
+        **subscribers (mapping):** The plans of the subscribers, by source_call
+
+        **stamp (tuple):** The version of the plans it was compiled from
+    """
+
+    __slots__ = ('default', 'subscribers', 'stamp')
+
+    def __init__(self, default, subscribers=None, stamp=None):
+        self.default = default
+        self.subscribers = MappingProxyType(dict(subscribers or {}))
+        self.stamp = stamp
+
+    def plan(self, source_call):
+        return self.subscribers.get(source_call, self.default)
+
+    def rate(self, source_call, destination_call):
+        """The rate of the plan of the subscriber for the destination, None if no rate
+        of the plan covers it
+        """
+        return self.plan(source_call).rates.lookup(destination_call)
+
+    def price(self, source_call, destination_call, start, end):
+        """Price a call with the plan of the subscriber (see ``CompiledPlan.price``)"""
+        return self.plan(source_call).price(destination_call, start, end)
+
+    def price_calls(self, sources, destinations, starts, ends):
+        """Price a batch of calls with the plans of their subscribers (see
+        ``CompiledPlan.price_calls``)
+
+        Return:
+            **PricedCalls:** minutes charged and prices in cents, integer arrays
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        minutes = np.zeros(len(starts), dtype=np.int64)
+        cents = np.zeros(len(starts), dtype=np.int64)
+        groups = {}
+        for index, source_call in enumerate(sources):
+            plan = self.plan(source_call)
+            groups.setdefault(id(plan), (plan, []))[1].append(index)
+
+        for plan, indexes in groups.values():
+            priced = plan.price_calls([destinations[index] for index in indexes],
+                                      starts[indexes], ends[indexes])
+            minutes[indexes], cents[indexes] = priced
+        return PricedCalls(minutes, cents)
+
+
+def _schedule(bands):
+    """The DaySchedule of the (start, end, minute_cents) bands of a day, ``end`` 0
+    being the end of the day, ``default`` the charge outside the bands
+    """
+    bands, default = bands
+    bounds, rates, position = [], [], 0
+    for start, end, minute_cents in sorted(bands):
+        end = end or DAY
+        if start < position:
+            raise ValueError("Overlapping time bands")
+        if start > position:
+            bounds.append(start)
+            rates.append(default)
+        if end < DAY:
+            bounds.append(end)
+        rates.append(minute_cents)
+        position = end
+    if position < DAY:
+        rates.append(default)
+    return DaySchedule(tuple(bounds), tuple(rates))
+
+
+def compile_rate(prefix, standing_charge_cents, minute_cents, bands):
+    """Compile a destination rate
+
+    Args:
+        **prefix (str):** Digits of the start of the destination numbers
+
+        **standing_charge_cents (int):** Fixed charge of each call
+
+        **minute_cents (int):** Charge per minute outside the bands
+
+        **bands (iterable):** (day type, start time, end time, minute_cents) of the bands
+
+    Return:
+        **CompiledRate:** The rate
+    """
+    by_day = {day_type: [] for day_type in DAY_TYPES}
+    for day_type, start, end, band_cents in bands:
+        by_day[day_type].append((_time_to_microseconds(start), _time_to_microseconds(end),
+                                 band_cents))
+    return CompiledRate(prefix, standing_charge_cents, tuple(
+        _schedule((by_day[day_type], minute_cents)) for day_type in DAY_TYPES
+    ))
+
+
+def standard_plan():
+    """The plan of ``PriceRates``: standing charge plus a charge per minute between
+    06:00 and 22:00 every day, used when no plan is the default one
+    """
+    bands = [(day_type, STANDARD_START, STANDARD_END, int(round(PriceRates.MINUTE * 100)))
+             for day_type in DAY_TYPES]
+    return CompiledPlan('Standard', [
+        compile_rate('', int(round(PriceRates.FLAT_RATE * 100)), 0, bands)
+    ])
+
+
+def _stamp():
+    """The version of the plans: their last change and their number"""
+    stamp = TariffPlan.objects.aggregate(updated_at=Max('updated_at'), plans=Count('id'))
+    return stamp['updated_at'], stamp['plans']
+
+
+def compile_tariffs():
+    """Read and compile all the tariff plans
+
+    Return:
+        **CompiledTariffs:** The compiled plans
+    """
+    with transaction.atomic():
+        stamp = _stamp()
+        bands = {}
+        for band in TimeBand.objects.values_list('rate_id', 'day_type', 'start', 'end',
+                                                 'minute_cents'):
+            bands.setdefault(band[0], []).append(band[1:])
+        rates = {}
+        for rate in DestinationRate.objects.values_list('id', 'plan_id', 'prefix',
+                                                        'standing_charge_cents',
+                                                        'minute_cents'):
+            rates.setdefault(rate[1], []).append(
+                compile_rate(rate[2], rate[3], rate[4], bands.get(rate[0], ()))
+            )
+        holidays = {}
+        for plan_id, day in Holiday.objects.values_list('plan_id', 'date'):
+            holidays.setdefault(plan_id, []).append(day.toordinal())
+
+        plans, default = {}, None
+        for plan in TariffPlan.objects.all():
+            plans[plan.pk] = CompiledPlan(plan.name, rates.get(plan.pk, ()),
+                                          holidays.get(plan.pk, ()))
+            if plan.default:
+                default = plans[plan.pk]
+
+        subscribers = {source_call: plans[plan_id] for source_call, plan_id
+                       in SubscriberPlan.objects.values_list('source_call', 'plan_id')
+                       .iterator()}
+    return CompiledTariffs(default or standard_plan(), subscribers, stamp)
+
+
+_tariffs = None
+_checked_at = 0
+_lock = threading.Lock()
+
+
+def invalidate_tariffs():
+    """Compile the plans again on the next use, and once the current transaction
+    is committed, as the plans are read by the other transactions
+    """
+    global _tariffs
+    _tariffs = None
+    transaction.on_commit(_invalidate)
+
+
+def _invalidate():
+    global _tariffs
+    _tariffs = None
+
+
+def get_tariffs():
+    """The compiled tariff plans of the process, compiled on the first use and
+    checked for changes every ``TARIFF_PLANS['CHECK_INTERVAL']`` seconds
+    """
+    global _tariffs, _checked_at
+    interval = getattr(settings, 'TARIFF_PLANS', {}).get('CHECK_INTERVAL', 60)
+    tariffs, now = _tariffs, timer.monotonic()
+    if tariffs is not None and now - _checked_at < interval:
+        return tariffs
+
+    with _lock:
+        if _tariffs is None or _stamp() != _tariffs.stamp:
+            _tariffs = compile_tariffs()
+        _checked_at = now
+        return _tariffs
@@ -1,18 +1,145 @@
+import re
+
 from rest_framework import serializers
-from .models import PhoneBill, Registers
+from .currency import price_formatter
+from .functions import CallBill
+from .models import PhoneBill, Registers, RunningBill
+
+
+class PriceField(serializers.IntegerField):
+    """A price in cents, shown formatted (R$ 0,54)
+
+    Accepts the cents or the formatted price
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('min_value', 0)
+        super(PriceField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and not data.strip().isdigit():
+            # The formatted prices always have two decimal places; the sign is kept
+            # (-R$ 5,00), so a negative price fails the minimum value
+            negative = '-' in data
+            data = re.sub(r'\D', '', data)
+            if not data:
+                self.fail('invalid')
+            if negative:
+                data = '-' + data
+        return super(PriceField, self).to_internal_value(data)
+
+    def to_representation(self, value):
+        return price_formatter.format_cents(value)
+
+
+class DurationField(serializers.IntegerField):
+    """A duration in seconds, shown formatted (0h7m43s)
+
+    Accepts the seconds or the formatted duration
+    """
+
+    duration = re.compile(r'^(\d+)h(\d+)m(\d+)s$')
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('min_value', 0)
+        super(DurationField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and not data.strip().isdigit():
+            match = self.duration.match(data.strip())
+            if not match:
+                self.fail('invalid')
+            hours, minutes, seconds = (int(part) for part in match.groups())
+            data = (hours * 60 + minutes) * 60 + seconds
+        return super(DurationField, self).to_internal_value(data)
+
+    def to_representation(self, value):
+        return CallBill._format_duration(value)
 
 
 class RegistersSerializer(serializers.ModelSerializer):
+
+    duration_call = DurationField(source='duration_seconds')
+    price_call = PriceField(source='price_cents')
+
     class Meta:
         model = Registers
         fields = ('destination_call', 'duration_call', 'price_call',
                   'start_date_call', 'start_time_call', 'phone_bill')
 
 
+class BillRegistersSerializer(RegistersSerializer):
+    """A record of the phone bill, nested in the bill"""
+
+    class Meta(RegistersSerializer.Meta):
+        fields = ('destination_call', 'duration_call', 'price_call',
+                  'start_date_call', 'start_time_call')
+
+
+class BillLinesSerializer(serializers.ListSerializer):
+    """Writes all the lines of a phone bill with batched inserts"""
+
+    batch_size = 500
+
+    def create(self, validated_data):
+        return Registers.objects.bulk_create(
+            [Registers(**line) for line in validated_data], batch_size=self.batch_size
+        )
+
+
+class BillLineSerializer(serializers.ModelSerializer):
+    """A line of the phone bill, as computed by ``CallBill``, validated before the bill exists
+
+    The ``phone_bill`` is given on save: ``serializer.save(phone_bill=bill)``
+    """
+
+    class Meta:
+        model = Registers
+        fields = ('destination_call', 'duration_seconds', 'price_cents',
+                  'start_date_call', 'start_time_call')
+        list_serializer_class = BillLinesSerializer
+
+
 class PhoneBillSerializer(serializers.ModelSerializer):
+    """The phone bill with its records, which must be prefetched (see ``PhoneBillViewSet``)"""
 
-    bill = serializers.StringRelatedField(many=True)
+    bill = BillRegistersSerializer(many=True, read_only=True)
 
     class Meta:
         model = PhoneBill
         fields = ('id', 'period', 'source_call', 'bill')
+
+    def validate_period(self, value):
+        """The period is stored as mm/YYYY, one phone bill per subscriber period"""
+        month, _, year = (value or '').partition('/')
+        if month.isdigit():
+            return '{:02d}/{}'.format(int(month), year)
+        return value
+
+
+class PhoneBillSummarySerializer(serializers.Serializer):
+    """The totals of a phone bill, read from an aggregate query"""
+
+    id = serializers.IntegerField()
+    period = serializers.CharField()
+    source_call = serializers.CharField()
+    calls = serializers.IntegerField()
+    total_minutes = serializers.SerializerMethodField()
+    total_seconds = serializers.IntegerField()
+    total_duration = DurationField(source='total_seconds')
+    total_cents = serializers.IntegerField()
+    total_price = PriceField(source='total_cents')
+
+    def get_total_minutes(self, summary):
+        return summary['total_seconds'] // 60
+
+
+class RunningBillSerializer(serializers.ModelSerializer):
+    """The totals so far of the bill of a subscriber period"""
+
+    total_price = PriceField(source='total_cents', read_only=True)
+
+    class Meta:
+        model = RunningBill
+        fields = ('source_call', 'period', 'calls', 'billable_minutes', 'total_cents',
+                  'total_price', 'last_id_call', 'last_end_call')
@@ -0,0 +1,58 @@
+"""
+    Time arithmetic of the calls: the wall clock epochs of the call starts and
+    ends, and their durations over arrays of epoch seconds. The calls are priced
+    by the tariff plans compiled by ``plans``.
+"""
+from datetime import datetime
+
+import numpy as np
+
+MICROSECONDS = 10 ** 6
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _to_microseconds(seconds):
+    return np.rint(np.asarray(seconds, dtype=np.float64) * MICROSECONDS).astype(np.int64)
+
+
+def epoch_seconds(value):
+    """Epoch seconds of the wall clock date/time, ignoring the time zone
+
+    Args:
+        **value (datetime):** Date/time
+
+    Return:
+        **float:** Seconds since 1970-01-01 00:00:00
+    """
+    return (value.replace(tzinfo=None) - EPOCH).total_seconds()
+
+
+def call_epochs(start, end):
+    """Epoch seconds of a call start and end, keeping the duration of ``end - start``
+
+    Return:
+        **tuple:** (start, end) epoch seconds
+    """
+    start_epoch = epoch_seconds(start)
+    return start_epoch, start_epoch + (end - start).total_seconds()
+
+
+def durations(starts, ends):
+    """Call durations in seconds
+
+    Return:
+        **ndarray:** Seconds between each call start and end
+    """
+    return (_to_microseconds(ends) - _to_microseconds(starts)) / MICROSECONDS
+
+
+def split_durations(seconds):
+    """Split the durations into hours, minutes and seconds
+
+    Return:
+        **tuple:** (hours, minutes, seconds) integer arrays
+    """
+    minutes, seconds = np.divmod(np.asarray(seconds, dtype=np.float64), 60)
+    hours, minutes = np.divmod(minutes, 60)
+    return hours.astype(np.int64), minutes.astype(np.int64), seconds.astype(np.int64)
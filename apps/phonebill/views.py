@@ -1,40 +1,83 @@
+from datetime import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Prefetch, Sum
+from django.db.models.functions import Coalesce
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from .models import PhoneBill, Registers
-from .serializer import PhoneBillSerializer, RegistersSerializer
+from systemcall.pagination import KeysetPagination, NDJSONStreamMixin
+from systemcall.routers import use_replica
+from .models import PhoneBill, Registers, RunningBill
+from .serializer import (BillLineSerializer, PhoneBillSerializer, PhoneBillSummarySerializer,
+                         RegistersSerializer, RunningBillSerializer)
+from .cache import get_bill_cache
+from .export import BillExport
 from .functions import CallBill
 
 
-class RegisterViewSet(ModelViewSet):
+class RegistersPagination(KeysetPagination):
+    ordering = ('id',)
+
+
+class RegisterViewSet(NDJSONStreamMixin, ModelViewSet):
     queryset = Registers.objects.all()
     serializer_class = RegistersSerializer
+    pagination_class = RegistersPagination
+
+    @use_replica()
+    def list(self, request, *args, **kwargs):
+        return super(RegisterViewSet, self).list(request, *args, **kwargs)
+
+
+class CanExportBills(BasePermission):
+    """The export has the bills of all the subscribers, for the users allowed to view them"""
+
+    def has_permission(self, request, view):
+        return request.user.has_perm('phonebill.view_phonebill')
 
 
 class PhoneBillViewSet(ModelViewSet):
-    queryset = PhoneBill.objects.all()
+    queryset = PhoneBill.objects.prefetch_related(
+        Prefetch('bill', queryset=Registers.objects.order_by('id'))
+    )
     serializer_class = PhoneBillSerializer
 
-    def create_registers(self, last_id, registers):
-        """
-        Create records for current phone bill.
+    @use_replica()
+    def list(self, request, *args, **kwargs):
+        return super(PhoneBillViewSet, self).list(request, *args, **kwargs)
 
-        :param last_id: last id of PhoneBill
-        :param registers: Call list of the number and period (optional) chosen
-        :return: Returns the object of the telephone bill
+    @use_replica()
+    def retrieve(self, request, *args, **kwargs):
+        return super(PhoneBillViewSet, self).retrieve(request, *args, **kwargs)
+
+    def create_registers(self, serializer, registers):
         """
+        Create the phone bill and its records in one transaction.
 
-        phone_bill = PhoneBill.objects.get(id=last_id)
+        All the records are validated before anything is written, and then
+        inserted in batches.
 
-        for register in registers:
-            register.update({'phone_bill': phone_bill.id})
+        :param serializer: Valid PhoneBillSerializer
+        :param registers: Call list of the number and period (optional) chosen
+        :return: Returns the errors of the records, None if they were created
+        """
+        lines = BillLineSerializer(data=registers, many=True)
+        if not lines.is_valid():
+            return lines.errors
 
-            serializer = RegistersSerializer(data=register)
-            if serializer.is_valid():
-                serializer.save()
-            else:
-                return Response(serializer.errors)
-        return phone_bill
+        try:
+            with transaction.atomic():
+                phone_bill = serializer.save()
+                lines.save(phone_bill=phone_bill)
+        except IntegrityError:
+            # The subscriber period is billed already, by the bill run or another request
+            return {'period': ["The phone bill of this source_call and period already exists."]}
+        return None
 
     def create(self, request, *args, **kwargs):
         """
@@ -52,15 +95,14 @@ class PhoneBillViewSet(ModelViewSet):
         for reg in registers:
             if "destination_call" in reg:
                 serializer = PhoneBillSerializer(data=request.data)
-                if serializer.is_valid():
-                    device = serializer.save()
-                    last_id = device.id
-                else:
+                if not serializer.is_valid():
                     return Response(serializer.errors,
                                     status=status.HTTP_400_BAD_REQUEST)
 
-                # Creates a record for each index in the list and links to the id of the phone bill
-                self.create_registers(last_id, registers)
+                # Creates the phone bill and a record for each index in the list
+                errors = self.create_registers(serializer, registers)
+                if errors:
+                    return Response(errors, status=status.HTTP_400_BAD_REQUEST)
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
             elif "error" in reg:
                 return Response({'period_end': "We did not find call records finalized "
@@ -68,3 +110,67 @@ class PhoneBillViewSet(ModelViewSet):
             else:
                 return Response({'invalid_fields': "The souce_call field is required "
                                                    "and the period field must be MM/YYYY"})
+
+    @action(detail=True, methods=['get'])
+    def summary(self, request, pk=None):
+        """
+            Total cost, duration and number of calls of the phone bill, in one aggregate query
+        """
+        if not str(pk).isdigit():
+            raise Http404
+        summary = self.get_queryset().filter(pk=pk).annotate(
+            calls=Count('bill'),
+            total_seconds=Coalesce(Sum('bill__duration_seconds'), 0),
+            total_cents=Coalesce(Sum('bill__price_cents'), 0)
+        ).values('id', 'period', 'source_call', 'calls', 'total_seconds', 'total_cents').first()
+        if summary is None:
+            raise Http404
+        return Response(PhoneBillSummarySerializer(summary).data)
+
+    @action(detail=False, methods=['get'], url_path='open')
+    def open_bill(self, request):
+        """
+            Totals so far of the bill of the current month (or of ``period``), read from
+            the running bill of the subscriber, updated as the calls are completed
+        """
+        source_call = request.query_params.get('source_call')
+        try:
+            period = RunningBill.period_of(datetime.strptime(request.query_params['period'],
+                                                             '%m/%Y'))
+        except KeyError:
+            period = RunningBill.period_of(timezone.now())
+        except ValueError:
+            period = None
+        if not source_call or not period:
+            return Response({'invalid_fields': "The souce_call field is required "
+                                               "and the period field must be MM/YYYY"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        running = RunningBill.objects.filter(source_call=source_call, period=period).first()
+        return Response(RunningBillSerializer(
+            running or RunningBill(source_call=source_call, period=period)
+        ).data)
+
+    @action(detail=False, methods=['get'], permission_classes=(CanExportBills,))
+    def export(self, request):
+        """
+            All the bill lines of a closed period (``period``, the last month by default) as
+            CSV, gzip compressed with ``compress=gzip``, streamed as they are read
+        """
+        export = BillExport(request.query_params.get('period'),
+                            compress=request.query_params.get('compress') == 'gzip')
+        if not export.validate_params():
+            return Response({'invalid_fields': "The period field must be MM/YYYY "
+                                               "of a closed month"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(export.chunks(), content_type=export.content_type)
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(export.filename)
+        return response
+
+    @action(detail=False, methods=['get'])
+    def cache(self, request):
+        """
+            Hit/miss/eviction counters of the bill cache of this process
+        """
+        return Response(get_bill_cache().stats())
@@ -1,9 +1,20 @@
 from django.contrib import admin
-from .models import RegisterCall
+from .models import CompletedCall, OpenCall, RegisterCall
 
 
 class RegisterCallAdmin(admin.ModelAdmin):
     list_display = ['type_call', 'timestamp_call', 'id_call', 'source_call', 'destination_call']
 
 
+class CompletedCallAdmin(admin.ModelAdmin):
+    list_display = ['id_call', 'source_call', 'destination_call', 'start_call', 'end_call',
+                    'duration_seconds', 'price_cents']
+
+
+class OpenCallAdmin(admin.ModelAdmin):
+    list_display = ['id_call', 'source_call', 'destination_call', 'start_call']
+
+
 admin.site.register(RegisterCall, RegisterCallAdmin)
+admin.site.register(CompletedCall, CompletedCallAdmin)
+admin.site.register(OpenCall, OpenCallAdmin)
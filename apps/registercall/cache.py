@@ -0,0 +1,75 @@
+"""
+    In-process cache of the open calls (see ``OpenCall``), sized by the
+    ``OPEN_CALL_CACHE`` setting.
+
+    A process only knows the calls it opened and closed itself, so the cache is
+    meant for deployments where one process writes the call records; it is
+    disabled by default. A stale entry is still caught by the database, as a
+    duplicated call end record violates the (type_call, id_call) unique.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+
+class OpenCallCache:
+    """Least recently used open calls, disabled if ``max_entries`` is 0
+
+    Options:
+        **max_entries (int):** Maximum number of cached open calls
+    """
+
+    def __init__(self, max_entries=0):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._calls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, id_call):
+        """The (source_call, destination_call, start_call) of the open call, None if not cached"""
+        if not self.max_entries:
+            return None
+        with self._lock:
+            call = self._calls.get(id_call)
+            if call is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._calls.move_to_end(id_call)
+            return call
+
+    def set(self, id_call, call):
+        """Cache an open call once the current transaction is committed"""
+        if not self.max_entries:
+            return
+
+        def cache():
+            with self._lock:
+                self._calls[id_call] = call
+                self._calls.move_to_end(id_call)
+                while len(self._calls) > self.max_entries:
+                    self._calls.popitem(last=False)
+
+        transaction.on_commit(cache)
+
+    def delete(self, id_calls):
+        with self._lock:
+            for id_call in id_calls:
+                self._calls.pop(id_call, None)
+
+    def clear(self):
+        with self._lock:
+            self._calls.clear()
+
+
+_open_call_cache = None
+
+
+def get_open_call_cache():
+    """The open call cache of the process, built from the ``OPEN_CALL_CACHE`` setting"""
+    global _open_call_cache
+    if _open_call_cache is None:
+        _open_call_cache = OpenCallCache(**getattr(settings, 'OPEN_CALL_CACHE', {}))
+    return _open_call_cache
@@ -0,0 +1,201 @@
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from .choices import CallTypes
+from .models import CompletedCall, OpenCall, RegisterCall
+from .serializer import RegisterCallBatchSerializer
+
+
+class CallBatch:
+    """Class responsible for validating and inserting a batch of call records
+
+    The records are validated as a set: the call start/end pairs are matched inside
+    the batch and the remaining checks run against the database with one query.
+    An invalid record does not fail the whole batch.
+
+    Attributes
+        **records (list):** The call records (dicts) as received by the API
+    """
+
+    batch_size = 500
+
+    def __init__(self, records):
+        self.records = records
+        self.calls, self.errors = [], []
+        self.starts = {}
+
+    def _validate_fields(self):
+        """Validate each record fields, without touching the database
+
+        Return
+            **list:** (index, RegisterCall) of the records with valid fields
+        """
+        calls = []
+        for index, record in enumerate(self.records):
+            serializer = RegisterCallBatchSerializer(data=record)
+            if not serializer.is_valid():
+                self.errors.append({'index': index, 'errors': serializer.errors})
+                continue
+            calls.append((index, RegisterCall(**serializer.validated_data)))
+        return calls
+
+    def _get_existing(self, calls):
+        """Fetch, in one query, the stored records that may conflict with the batch,
+        keeping the call start records in ``starts`` to price the completed calls
+
+        Return
+            **tuple:** ({(type_call, id_call): timestamp_call}, {(type_call, timestamp_call)})
+        """
+        id_calls = {call.id_call for _, call in calls}
+        timestamps = {call.timestamp_call for _, call in calls}
+
+        existing = RegisterCall.objects.filter(
+            Q(id_call__in=id_calls) | Q(timestamp_call__in=timestamps)
+        ).values_list('type_call', 'id_call', 'timestamp_call', 'source_call',
+                      'destination_call')
+
+        by_id, by_timestamp = {}, set()
+        for type_call, id_call, timestamp_call, source_call, destination_call in existing:
+            by_id[(type_call, id_call)] = timestamp_call
+            by_timestamp.add((type_call, timestamp_call))
+            if type_call == CallTypes.START:
+                self.starts[id_call] = (source_call, destination_call, timestamp_call)
+        return by_id, by_timestamp
+
+    @staticmethod
+    def _validate_call(call, by_id, by_timestamp):
+        """Validate a record against the stored records and the previous ones of the batch,
+        with the same rules of ``RegisterCall.clean``
+
+        Return
+            **dict:** The errors of the record, empty if it is valid
+        """
+        error = {}
+
+        if call.type_call == CallTypes.START and not (call.source_call or call.destination_call):
+            error.update({
+                "source_call": ["This field is required."],
+                "destination_call": ["This field is required."],
+            })
+        elif call.type_call == CallTypes.START:
+            error.update(RegisterCall._rate_error(call.source_call, call.destination_call))
+
+        if not call.id_call:
+            error.update({
+                "id_call": ["This field is required."]
+            })
+        elif (call.type_call, call.id_call) in by_id:
+            if call.type_call == CallTypes.END:
+                error.update({
+                    "id_call": ["Already exists a type END for this id_call: {}"
+                                .format(call.id_call)]
+                })
+            else:
+                error.update({
+                    "non_field_errors": ["The fields type_call, id_call must make a unique set."]
+                })
+        elif call.type_call == CallTypes.END:
+            call.source_call = call.destination_call = None
+            start_call = by_id.get((CallTypes.START, call.id_call))
+            if start_call is None:
+                error.update({
+                    "id_call": ["Does not exist a call start entry with this call id: {}"
+                                .format(call.id_call)]
+                })
+            elif call.timestamp_call < start_call:
+                error.update({
+                    "timestamp_call": ["Invalid timestamp_call. Must be grater then {}"
+                                       .format(start_call)]
+                })
+
+        if (call.type_call, call.timestamp_call) in by_timestamp:
+            error.setdefault("non_field_errors", []).append(
+                "The fields type_call, timestamp_call must make a unique set."
+            )
+
+        return error
+
+    def validate(self):
+        """Validate all the records of the batch
+
+        Return
+            **bool:** True if at least one record is valid, False otherwise.
+        """
+        calls = self._validate_fields()
+        by_id, by_timestamp = self._get_existing(calls)
+
+        # The start records go first, so an end can be paired with a start of the batch
+        calls.sort(key=lambda item: (item[1].type_call != CallTypes.START, item[0]))
+        for index, call in calls:
+            error = self._validate_call(call, by_id, by_timestamp)
+            if error:
+                self.errors.append({'index': index, 'errors': error})
+                continue
+
+            by_id[(call.type_call, call.id_call)] = call.timestamp_call
+            by_timestamp.add((call.type_call, call.timestamp_call))
+            if call.type_call == CallTypes.START:
+                self.starts[call.id_call] = (call.source_call, call.destination_call,
+                                             call.timestamp_call)
+            self.calls.append((index, call))
+
+        self.calls.sort(key=lambda item: item[0])
+        self.errors.sort(key=lambda item: item['index'])
+        return bool(self.calls)
+
+    def _save_each(self):
+        """Save the records one by one, reporting the ones that fail
+
+        Used when a concurrent insert conflicts with the bulk insert
+        """
+        calls, self.calls = self.calls, []
+        for index, call in calls:
+            try:
+                with transaction.atomic():
+                    call.save()
+            except ValidationError as error:
+                self.errors.append({'index': index, 'errors': error.message_dict})
+            except IntegrityError as error:
+                self.errors.append({'index': index, 'errors': {'non_field_errors': [str(error)]}})
+            else:
+                self.calls.append((index, call))
+        self.errors.sort(key=lambda item: item['index'])
+
+    def _save_open_calls(self):
+        """Open the calls started and close the calls ended by the batch"""
+        ends = {call.id_call for _, call in self.calls if call.type_call == CallTypes.END}
+        OpenCall.objects.bulk_create(
+            [OpenCall.from_start(call) for _, call in self.calls
+             if call.type_call == CallTypes.START and call.id_call not in ends],
+            batch_size=self.batch_size
+        )
+        if ends:
+            OpenCall.close(ends)
+
+    def save(self):
+        """Validate and insert the valid records in batches
+
+        Return
+            **dict:** The number of created records and the errors of each invalid record
+            ::
+
+                {
+                    'created': 2,
+                    'errors': [{'index': 1, 'errors': {'id_call': ['...']}}]
+                }
+        """
+        if self.validate():
+            try:
+                with transaction.atomic():
+                    RegisterCall.objects.bulk_create([call for _, call in self.calls],
+                                                     batch_size=self.batch_size)
+                    CompletedCall.bulk_complete(
+                        (call.id_call,) + self.starts[call.id_call] + (call.timestamp_call,)
+                        for _, call in self.calls if call.type_call == CallTypes.END
+                    )
+                    self._save_open_calls()
+            except IntegrityError:
+                self._save_each()
+
+        return {'created': len(self.calls), 'errors': self.errors}
@@ -0,0 +1,525 @@
+"""
+    Asynchronous ingestion of the call records: an ASGI application that accepts
+    the records into a bounded in-process queue and writes them to the database
+    in batches, from a background flusher (see ``systemcall.asgi``).
+
+    A request is acknowledged (202) once its records are queued and written and
+    fsync'ed to the journal, required unless ``INGEST['ALLOW_NO_JOURNAL']``. A
+    full queue is answered with 429, as are the requests received while the
+    records left in the journal are queued again on start up. The records are
+    validated by ``CallBatch`` when they are written; the rejected ones are logged.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, connection
+from rest_framework.authtoken.models import Token
+
+from .functions import CallBatch
+
+logger = logging.getLogger(__name__)
+
+INGEST_PATH = '/registercall/ingest/'
+STATS_PATH = '/registercall/ingest/stats/'
+
+
+class QueueFull(Exception):
+    """There is no room in the queue for the records"""
+
+
+class Journal:
+    """Append-only NDJSON files of the accepted records, to recover them after a crash
+
+    The records are written to numbered segment files. A segment is removed once
+    all its records are written to the database, and the segments left by a crash
+    are replayed on start up (the records already written are rejected as
+    duplicates by the validation). The appends of concurrent requests are written
+    with one fsync.
+
+    Attributes
+        **directory (str):** The directory of the segment files, used by one process
+
+        **segment_size (int):** Number of records of each segment
+    """
+
+    def __init__(self, directory, segment_size=100000):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.pending = Counter()
+        self._replay = sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                              if name.endswith('.ndjson'))
+        self._segment = (self._replay[-1] if self._replay else 0) + 1
+        self._file = open(self._path(self._segment), 'ab')
+        self._file_segment = self._segment
+        self._replaying = None
+        self._written = 0
+        self._appends = []
+        self._writer = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{:012d}.ndjson'.format(segment))
+
+    def replay(self):
+        """The records of the segments left by the previous process
+
+        Return
+            **iterator:** (segment, record) tuples
+        """
+        for segment in self._replay:
+            # The segment is not removed by ``release`` until it is read to the end
+            self._replaying = segment
+            with open(self._path(segment), 'rb') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # The partial line of a crash, never acknowledged
+                        continue
+                    self.pending[segment] += 1
+                    yield segment, record
+            self._replaying = None
+            if self.pending[segment] <= 0:
+                self._remove(segment)
+        self._replay = []
+
+    async def append(self, records):
+        """Write the records, returning once they are on disk
+
+        Return
+            **int:** The segment of the records
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._appends.append((records, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write())
+        return await future
+
+    def _write_sync(self, data, segment):
+        if segment != self._file_segment:
+            # The current segment is kept if the next one can not be opened
+            next_file = open(self._path(segment), 'ab')
+            self._file.close()
+            self._file, self._file_segment = next_file, segment
+        position = self._file.tell()
+        try:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            # The partial lines would be read with the next records
+            self._file.truncate(position)
+            raise
+
+    async def _write(self):
+        loop = asyncio.get_event_loop()
+        while self._appends:
+            appends, self._appends = self._appends, []
+            data = b''.join(json.dumps(record).encode('utf-8') + b'\n'
+                            for records, _ in appends for record in records)
+
+            rotate = self._written >= self.segment_size
+            segment = self._segment + 1 if rotate else self._segment
+            try:
+                await loop.run_in_executor(self._executor, self._write_sync, data, segment)
+            except Exception as error:
+                # The requests are refused, the next appends try again
+                for _, future in appends:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            if rotate:
+                previous, self._segment, self._written = self._segment, segment, 0
+                if previous in self.pending and self.pending[previous] <= 0:
+                    self._remove(previous)
+
+            for records, future in appends:
+                self._written += len(records)
+                self.pending[self._segment] += len(records)
+                future.set_result(self._segment)
+
+    def release(self, segment, count):
+        """Mark records of a segment as written to the database, removing the finished segment"""
+        self.pending[segment] -= count
+        if self.pending[segment] <= 0 and segment not in (self._segment, self._replaying):
+            self._remove(segment)
+
+    def _remove(self, segment):
+        self.pending.pop(segment, None)
+        try:
+            os.remove(self._path(segment))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self._file.close()
+        self._executor.shutdown()
+
+
+class IngestBuffer:
+    """Class responsible for queueing the accepted records and writing them in batches
+
+    A batch is written when it has ``batch_size`` records or when its first record
+    waited ``flush_interval`` seconds. The batches are written one at a time, in the
+    order the records were accepted; a batch that fails (e.g. the database is down)
+    is retried until it is written.
+
+    Attributes
+        **queue_size (int):** Maximum number of records accepted and not written yet
+
+        **batch_size (int):** Maximum number of records of each insert
+
+        **flush_interval (float):** Maximum seconds a record waits for its batch
+
+        **journal (Journal, optional):** Where the records are kept until written
+    """
+
+    retry_delay = 1
+
+    def __init__(self, queue_size=100000, batch_size=5000, flush_interval=0.05, journal=None):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = journal
+
+        self.accepted = self.created = self.rejected = self.batches = 0
+        self._records = deque()
+        self._reserved = 0
+        self._stopping = False
+        self._ready = self._full = self._room = self._flusher = self._replayer = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def from_settings(cls):
+        """The buffer of the ``INGEST`` setting, refusing to run without a journal
+        unless ``ALLOW_NO_JOURNAL`` accepts to lose the records not written yet
+        """
+        config = getattr(settings, 'INGEST', {})
+        journal = config.get('JOURNAL')
+        if not journal and not config.get('ALLOW_NO_JOURNAL'):
+            raise ImproperlyConfigured(
+                "INGEST['JOURNAL'] is required: without a journal the accepted records "
+                "are lost if the process dies. Set ALLOW_NO_JOURNAL to run without one."
+            )
+        return cls(queue_size=config.get('QUEUE_SIZE', 100000),
+                   batch_size=config.get('BATCH_SIZE', 5000),
+                   flush_interval=config.get('FLUSH_INTERVAL_MS', 50) / 1000,
+                   journal=Journal(journal) if journal else None)
+
+    @property
+    def started(self):
+        return self._flusher is not None
+
+    def start(self):
+        """Start the flusher, and the queueing of the records left in the journal"""
+        self._ready, self._full, self._room = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        self._flusher = asyncio.ensure_future(self._flush())
+        if self.journal:
+            self._replayer = asyncio.ensure_future(self._replay())
+
+    @property
+    def replaying(self):
+        return self._replayer is not None and not self._replayer.done()
+
+    async def _replay(self):
+        """Queue the records left in the journal in batches, each waiting for room in
+        the queue, so a long outage does not load them all in memory
+        """
+        size = max(1, min(self.batch_size, self.queue_size))
+        batch = []
+        for segment, record in self.journal.replay():
+            batch.append((segment, record))
+            if len(batch) == size:
+                await self._wait_room(len(batch))
+                self._enqueue(batch)
+                batch = []
+        if batch:
+            await self._wait_room(len(batch))
+            self._enqueue(batch)
+
+    async def _wait_room(self, count):
+        while len(self._records) + self._reserved + count > self.queue_size:
+            self._room.clear()
+            await self._room.wait()
+
+    async def stop(self):
+        """Write the queued records, and the records left in the journal, and stop
+        the flusher
+        """
+        if not self.started:
+            return
+        if self._replayer is not None:
+            await self._replayer
+        self._stopping = True
+        self._ready.set()
+        self._full.set()
+        await self._flusher
+        self._executor.shutdown()
+        if self.journal:
+            self.journal.close()
+
+    def _enqueue(self, records):
+        self._records.extend(records)
+        if self._records:
+            self._ready.set()
+        if len(self._records) >= self.batch_size:
+            self._full.set()
+
+    async def put(self, records):
+        """Accept the records, returning once they are queued (and written to the journal)
+
+        Raises:
+            **QueueFull:** There is no room in the queue for the records
+        """
+        if len(self._records) + self._reserved + len(records) > self.queue_size:
+            raise QueueFull()
+        if self.replaying:
+            # The records left in the journal are written first, in their order
+            raise QueueFull()
+
+        if not self.journal:
+            self._accept(None, records)
+            return
+
+        # The records written to the journal are queued even if the request is cancelled
+        self._reserved += len(records)
+        await asyncio.shield(asyncio.ensure_future(self._append(records)))
+
+    async def _append(self, records):
+        try:
+            segment = await self.journal.append(records)
+        finally:
+            self._reserved -= len(records)
+        self._accept(segment, records)
+
+    def _accept(self, segment, records):
+        self._enqueue((segment, record) for record in records)
+        self.accepted += len(records)
+
+    async def _flush(self):
+        while not (self._stopping and not self._records):
+            if not self._records:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            if len(self._records) < self.batch_size and not self._stopping:
+                # Gives the batch the time to fill up
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = [self._records.popleft()
+                     for _ in range(min(self.batch_size, len(self._records)))]
+            self._room.set()
+            await self._write(batch)
+
+    @staticmethod
+    def _save(records):
+        try:
+            return CallBatch(records).save()
+        except Exception:
+            # The next attempt opens a new connection
+            connection.close()
+            raise
+
+    async def _write(self, batch):
+        loop = asyncio.get_event_loop()
+        records = [record for _, record in batch]
+        while True:
+            try:
+                result = await loop.run_in_executor(self._executor, self._save, records)
+                break
+            except Exception:
+                logger.exception("Could not write %s call records, retrying", len(records))
+                await asyncio.sleep(self.retry_delay)
+
+        self.batches += 1
+        self.created += result['created']
+        self.rejected += len(result['errors'])
+        for error in result['errors']:
+            logger.warning("Call record rejected: %s %s", json.dumps(records[error['index']]),
+                           json.dumps(error['errors']))
+
+        if self.journal:
+            for segment, count in Counter(segment for segment, _ in batch).items():
+                self.journal.release(segment, count)
+
+    def stats(self):
+        return {
+            'queued': len(self._records),
+            'replaying': self.replaying,
+            'queue_size': self.queue_size,
+            'accepted': self.accepted,
+            'created': self.created,
+            'rejected': self.rejected,
+            'batches': self.batches,
+        }
+
+
+class IngestApp:
+    """ASGI application of the ingestion endpoint, the other requests go to ``fallback``
+
+    ``POST /registercall/ingest/`` takes a call record, a JSON array of records or
+    NDJSON (Content-Type: application/x-ndjson), with the token of a user allowed
+    to add call records. ``GET /registercall/ingest/stats/`` returns the counters.
+
+    Attributes
+        **fallback (ASGI application, optional):** Serves the other requests
+
+        **buffer (IngestBuffer, optional):** Built from the ``INGEST`` setting if not informed
+    """
+
+    max_body = 16 * 1024 * 1024
+    # Seconds a checked token is trusted without reading the database again, and
+    # seconds an unknown key is refused without reading it again
+    token_ttl = 60
+    unknown_token_ttl = 5
+    # Maximum number of checked tokens kept, the least recently used are dropped
+    max_tokens = 1024
+
+    def __init__(self, fallback=None, buffer=None):
+        self.fallback = fallback
+        self.buffer = buffer or IngestBuffer.from_settings()
+        self._tokens = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http' and scope['path'] in (INGEST_PATH, STATS_PATH):
+            return await self._http(scope, receive, send)
+        if self.fallback is not None:
+            return await self.fallback(scope, receive, send)
+        return await self._respond(send, 404, {'detail': "Not found."})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.buffer.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.buffer.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _respond(send, status, data, headers=()):
+        body = json.dumps(data).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    @staticmethod
+    def _can_add_calls(key):
+        close_old_connections()
+        try:
+            user = Token.objects.select_related('user').get(key=key).user
+        except Token.DoesNotExist:
+            return None
+        finally:
+            close_old_connections()
+        return user.is_active and user.has_perm('registercall.add_registercall')
+
+    async def _authorize(self, headers):
+        """The status of a refused request, None if it is authorized"""
+        header = headers.get(b'authorization', b'').decode('latin-1').split()
+        if len(header) != 2 or header[0].lower() != 'token':
+            return 401
+
+        key = header[1]
+        allowed, expires = self._tokens.get(key, (None, 0))
+        if expires < time.monotonic():
+            allowed = await asyncio.get_event_loop().run_in_executor(
+                None, self._can_add_calls, key
+            )
+            ttl = self.unknown_token_ttl if allowed is None else self.token_ttl
+            self._tokens[key] = (allowed, time.monotonic() + ttl)
+        self._tokens.move_to_end(key)
+        while len(self._tokens) > self.max_tokens:
+            self._tokens.popitem(last=False)
+        if allowed is None:
+            return 401
+        return None if allowed else 403
+
+    @staticmethod
+    async def _read_body(receive, limit):
+        body, more_body = b'', True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > limit:
+                return None
+        return body
+
+    @staticmethod
+    def _parse(body, content_type):
+        """The records of the body, None if it is not a record or a list of records"""
+        try:
+            if content_type.startswith('application/x-ndjson'):
+                records = [json.loads(line) for line in body.decode('utf-8').splitlines()
+                           if line.strip()]
+            else:
+                records = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return None
+        if isinstance(records, dict):
+            records = [records]
+        if not isinstance(records, list) or not all(isinstance(record, dict)
+                                                    for record in records):
+            return None
+        return records
+
+    async def _http(self, scope, receive, send):
+        if not self.buffer.started:
+            # Served without the lifespan protocol
+            self.buffer.start()
+
+        headers = dict(scope['headers'])
+        refused = await self._authorize(headers)
+        if refused:
+            return await self._respond(send, refused, {
+                'detail': "Authentication credentials were not provided." if refused == 401
+                else "You do not have permission to perform this action."
+            })
+
+        if scope['path'] == STATS_PATH:
+            return await self._respond(send, 200, self.buffer.stats())
+        if scope['method'] != 'POST':
+            return await self._respond(send, 405, {'detail': "Method not allowed."},
+                                       [(b'allow', b'POST')])
+
+        body = await self._read_body(receive, self.max_body)
+        if body is None:
+            return await self._respond(send, 413, {'detail': "Request entity too large."})
+        records = self._parse(body, headers.get(b'content-type', b'').decode('latin-1'))
+        if records is None:
+            return await self._respond(send, 400, {
+                'non_field_errors': ["Expected a call record or a list of call records."]
+            })
+
+        try:
+            await self.buffer.put(records)
+        except QueueFull:
+            return await self._respond(send, 429, {'detail': "The ingestion queue is full."},
+                                       [(b'retry-after', b'1')])
+        except Exception:
+            logger.exception("Could not write the ingestion journal")
+            return await self._respond(send, 503, {'detail': "The records were not accepted."})
+        return await self._respond(send, 202, {'accepted': len(records)})
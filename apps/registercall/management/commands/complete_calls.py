@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.registercall.models import CompletedCall, OpenCall
+
+
+class Command(BaseCommand):
+    help = ("Price the call start/end record pairs that are not completed calls yet, "
+            "and open the calls started without an open call")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        pairs = CompletedCall.pending_pairs().iterator(chunk_size=CompletedCall.batch_size)
+        total = CompletedCall.bulk_complete(pairs)
+        opened = OpenCall.objects.bulk_create(
+            [OpenCall.from_start(call)
+             for call in OpenCall.pending().iterator(chunk_size=OpenCall.batch_size)],
+            batch_size=OpenCall.batch_size
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            "{} calls completed, {} calls opened in {:.1f}s".format(
+                total, len(opened), time.monotonic() - started
+            )
+        ))
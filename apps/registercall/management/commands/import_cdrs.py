@@ -0,0 +1,313 @@
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from apps.registercall.choices import CallTypes
+from apps.registercall.models import CompletedCall, OpenCall, RegisterCall
+
+COLUMNS = ('type_call', 'timestamp_call', 'id_call', 'source_call', 'destination_call')
+
+CREATE_STAGING = """
+    CREATE TEMPORARY TABLE registercall_staging (
+        line bigserial,
+        type_call text,
+        timestamp_call text,
+        id_call text,
+        source_call text,
+        destination_call text
+    ) ON COMMIT DROP
+"""
+
+COPY_STAGING = """
+    COPY registercall_staging ({}) FROM STDIN WITH (FORMAT csv)
+""".format(', '.join(COLUMNS))
+
+# A timestamp (ISO 8601, with an optional offset) is checked before the cast, so a
+# malformed one is NULL instead of aborting the import. The nested CASE keeps the
+# day check from running on a value that does not match the pattern
+TIMESTAMP_PATTERN = (r'^[1-9][0-9]{3}-(0[1-9]|1[0-2])-(0[1-9]|[12][0-9]|3[01])'
+                     r'[ T]([01][0-9]|2[0-3]):[0-5][0-9](:[0-5][0-9](\.[0-9]{1,6})?)?'
+                     r'(Z|[+-]([01][0-9]|2[0-3])(:?[0-5][0-9])?)?$')
+
+CREATE_TIMESTAMP_CAST = """
+    CREATE FUNCTION pg_temp.to_timestamptz_or_null(value text) RETURNS timestamptz AS $$
+        SELECT CASE WHEN value ~ '{pattern}' THEN
+            CASE WHEN substr(value, 9, 2)::integer <= extract(day FROM
+                     make_date(substr(value, 1, 4)::integer, substr(value, 6, 2)::integer, 1)
+                     + interval '1 month' - interval '1 day')
+                 THEN value::timestamptz
+            END
+        END
+    $$ LANGUAGE sql STABLE
+""".format(pattern=TIMESTAMP_PATTERN)
+
+# The positive values of the integer column, with or without leading zeros
+MAX_ID_CALL = 2 ** 31 - 1
+
+# Casts the staged records, dropping the malformed ones and keeping the first
+# record of each (type_call, id_call) of the file
+CREATE_TYPED = """
+    CREATE TEMPORARY TABLE registercall_typed ON COMMIT DROP AS
+    SELECT DISTINCT ON (type_call, id_call) *
+    FROM (
+        SELECT line,
+               CASE WHEN type_call IN ('{start}', '{end}') THEN type_call::smallint END
+                   AS type_call,
+               pg_temp.to_timestamptz_or_null(timestamp_call) AS timestamp_call,
+               CASE WHEN id_call ~ '^[0-9]{{1,18}}$' THEN
+                   CASE WHEN id_call::bigint <= {max_id_call} THEN id_call::integer END
+               END AS id_call,
+               CASE WHEN type_call = '{start}' THEN NULLIF(source_call, '') END
+                   AS source_call,
+               CASE WHEN type_call = '{start}' THEN NULLIF(destination_call, '') END
+                   AS destination_call
+        FROM registercall_staging
+        WHERE coalesce(length(source_call), 0) <= 11
+          AND coalesce(length(destination_call), 0) <= 11
+    ) AS typed
+    WHERE type_call IS NOT NULL AND timestamp_call IS NOT NULL AND id_call > 0
+    ORDER BY type_call, id_call, line
+""".format(start=CallTypes.START, end=CallTypes.END, max_id_call=MAX_ID_CALL)
+
+INDEX_TYPED = """
+    CREATE INDEX ON registercall_typed (type_call, timestamp_call, line)
+"""
+
+CREATE_IMPORTED_STARTS = """
+    CREATE TEMPORARY TABLE registercall_imported_starts (
+        id_call integer,
+        source_call varchar(11),
+        destination_call varchar(11),
+        start_call timestamptz
+    ) ON COMMIT DROP
+"""
+
+# Same rules of ``RegisterCall.clean`` and of the model unique constraints.
+# Keeps the new call start records, to open their calls
+INSERT_STARTS = """
+    WITH inserted AS (
+        INSERT INTO {table} ({columns})
+        SELECT t.type_call, t.timestamp_call, t.id_call, t.source_call, t.destination_call
+        FROM registercall_typed t
+        WHERE t.type_call = {start}
+          AND (t.source_call IS NOT NULL OR t.destination_call IS NOT NULL)
+          AND NOT EXISTS (SELECT 1 FROM {table} c
+                          WHERE c.type_call = t.type_call AND c.id_call = t.id_call)
+          AND NOT EXISTS (SELECT 1 FROM {table} c
+                          WHERE c.type_call = t.type_call AND c.timestamp_call = t.timestamp_call)
+          AND NOT EXISTS (SELECT 1 FROM registercall_typed d
+                          WHERE d.type_call = t.type_call AND d.timestamp_call = t.timestamp_call
+                            AND d.line < t.line)
+        ORDER BY t.line
+        RETURNING id_call, source_call, destination_call, timestamp_call
+    )
+    INSERT INTO registercall_imported_starts SELECT * FROM inserted
+"""
+
+CREATE_IMPORTED_ENDS = """
+    CREATE TEMPORARY TABLE registercall_imported_ends (id_call integer) ON COMMIT DROP
+"""
+
+# Keeps the id_call of the new call end records, to price their completed calls
+INSERT_ENDS = """
+    WITH inserted AS (
+        INSERT INTO {table} ({columns})
+        SELECT t.type_call, t.timestamp_call, t.id_call, NULL, NULL
+        FROM registercall_typed t
+        JOIN {table} s ON s.id_call = t.id_call AND s.type_call = {start}
+        WHERE t.type_call = {end}
+          AND t.timestamp_call >= s.timestamp_call
+          AND NOT EXISTS (SELECT 1 FROM {table} c
+                          WHERE c.type_call = t.type_call AND c.id_call = t.id_call)
+          AND NOT EXISTS (SELECT 1 FROM {table} c
+                          WHERE c.type_call = t.type_call AND c.timestamp_call = t.timestamp_call)
+          AND NOT EXISTS (SELECT 1 FROM registercall_typed d
+                          WHERE d.type_call = t.type_call AND d.timestamp_call = t.timestamp_call
+                            AND d.line < t.line)
+        ORDER BY t.line
+        RETURNING id_call
+    )
+    INSERT INTO registercall_imported_ends SELECT id_call FROM inserted
+"""
+
+# The new call starts without a call end are open, the ended calls are closed
+OPEN_CALLS = """
+    INSERT INTO {open_calls} (id_call, source_call, destination_call, start_call)
+    SELECT s.id_call, s.source_call, s.destination_call, s.start_call
+    FROM registercall_imported_starts s
+    WHERE NOT EXISTS (SELECT 1 FROM registercall_imported_ends e WHERE e.id_call = s.id_call)
+"""
+
+CLOSE_CALLS = """
+    DELETE FROM {open_calls} o USING registercall_imported_ends e WHERE o.id_call = e.id_call
+"""
+
+SELECT_IMPORTED_PAIRS = """
+    SELECT s.id_call, s.source_call, s.destination_call, s.timestamp_call, e.timestamp_call
+    FROM registercall_imported_ends i
+    JOIN {table} s ON s.id_call = i.id_call AND s.type_call = {start}
+    JOIN {table} e ON e.id_call = i.id_call AND e.type_call = {end}
+"""
+
+
+class CopySource:
+    """File-like object that converts the input records to CSV while COPY reads it
+
+    Only one input line is held in memory at a time, whatever the size of the input.
+
+    Attributes
+        **records (iterator):** The records, as dicts with the ``COLUMNS`` keys
+
+        **report (callable):** Called with the number of rows read, every ``every`` rows
+    """
+
+    def __init__(self, records, report, every):
+        self.records = records
+        self.report = report
+        self.every = every
+        self.rows = 0
+        self._buffer = ''
+        self._line = io.StringIO()
+        self._writer = csv.writer(self._line)
+
+    def _next_line(self):
+        record = next(self.records)
+        self._line.seek(0)
+        self._line.truncate()
+        self._writer.writerow(['' if record.get(column) is None else record.get(column)
+                               for column in COLUMNS])
+
+        self.rows += 1
+        if self.every and not self.rows % self.every:
+            self.report(self.rows)
+        return self._line.getvalue()
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self._buffer) < size:
+                self._buffer += self._next_line()
+        except StopIteration:
+            pass
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class Command(BaseCommand):
+    help = ("Import call detail records from CSV or NDJSON files (or stdin) "
+            "through the PostgreSQL COPY protocol")
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', default=['-'],
+                            help="Files to import, '-' for stdin (.gz files are accepted)")
+        parser.add_argument('--format', choices=('csv', 'ndjson'),
+                            help="Input format, guessed from the file extension if not informed")
+        parser.add_argument('--progress', type=int, default=100000,
+                            help="Report the progress every N rows (0 to disable)")
+
+    @staticmethod
+    def _open(path):
+        if path == '-':
+            return sys.stdin
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf-8', newline='')
+        return open(path, encoding='utf-8', newline='')
+
+    def _records(self, stream, file_format):
+        """Iterate over the input records, as dicts"""
+        if file_format == 'csv':
+            for record in csv.DictReader(stream):
+                yield record
+            return
+
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            # A malformed line is staged as an empty record, rejected with the invalid ones
+            yield record if isinstance(record, dict) else {}
+
+    def _report(self, started):
+        def report(rows):
+            elapsed = time.monotonic() - started
+            self.stdout.write("{} rows read ({:.0f} rows/s)".format(
+                rows, rows / elapsed if elapsed else 0
+            ))
+        return report
+
+    def _import(self, stream, file_format, progress):
+        """Stage the records with COPY and insert the valid ones with set-based SQL
+
+        Return
+            **tuple:** (rows read, starts created, ends created)
+        """
+        table = RegisterCall._meta.db_table
+        params = {'table': connection.ops.quote_name(table), 'columns': ', '.join(COLUMNS),
+                  'open_calls': connection.ops.quote_name(OpenCall._meta.db_table),
+                  'start': CallTypes.START, 'end': CallTypes.END}
+        source = CopySource(self._records(stream, file_format),
+                            self._report(time.monotonic()), progress)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING)
+            cursor.copy_expert(COPY_STAGING, source)
+
+            cursor.execute(CREATE_TIMESTAMP_CAST)
+            cursor.execute(CREATE_TYPED)
+            cursor.execute(INDEX_TYPED)
+            cursor.execute("ANALYZE registercall_typed")
+
+            cursor.execute(CREATE_IMPORTED_STARTS)
+            cursor.execute(INSERT_STARTS.format(**params))
+            starts = cursor.rowcount
+            cursor.execute(CREATE_IMPORTED_ENDS)
+            cursor.execute(INSERT_ENDS.format(**params))
+            ends = cursor.rowcount
+            cursor.execute(OPEN_CALLS.format(**params))
+            cursor.execute(CLOSE_CALLS.format(**params))
+
+            # The new calls are priced in batches, read through a server-side cursor
+            with connection.chunked_cursor() as pairs:
+                pairs.execute(SELECT_IMPORTED_PAIRS.format(**params))
+                CompletedCall.bulk_complete(pairs)
+
+        return source.rows, starts, ends
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("import_cdrs requires a PostgreSQL database")
+
+        for path in options['paths']:
+            name = path[:-len('.gz')] if path.endswith('.gz') else path
+            file_format = options['format'] or (
+                'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv'
+            )
+
+            started = time.monotonic()
+            stream = self._open(path)
+            try:
+                rows, starts, ends = self._import(stream, file_format, options['progress'])
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+            elapsed = time.monotonic() - started
+
+            self.stdout.write(self.style.SUCCESS(
+                "{}: {} rows read, {} starts and {} ends imported, {} rejected "
+                "in {:.1f}s ({:.0f} rows/s)".format(
+                    path, rows, starts, ends, rows - starts - ends,
+                    elapsed, rows / elapsed if elapsed else 0
+                )
+            ))
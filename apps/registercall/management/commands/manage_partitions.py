@@ -0,0 +1,75 @@
+import os
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.registercall import partitions
+
+
+class Command(BaseCommand):
+    help = ("Create the monthly partitions of the call records for the next months, "
+            "and detach, archive or drop the old ones (PostgreSQL)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3,
+                            help="Create the partitions up to N months after the current one")
+        parser.add_argument('--detach-before', metavar='MM/YYYY',
+                            help="Detach the partitions of the months before this one")
+        parser.add_argument('--archive-dir',
+                            help="Write the detached partitions to gzipped CSV files in this "
+                                 "directory and drop them")
+        parser.add_argument('--drop', action='store_true',
+                            help="Drop the detached partitions without archiving them")
+
+    @staticmethod
+    def _month(value):
+        try:
+            return datetime.strptime(value, '%m/%Y').date()
+        except ValueError:
+            raise CommandError("Invalid month: {}. Must be MM/YYYY".format(value))
+
+    def _create(self, ahead):
+        current = timezone.localdate().replace(day=1)
+        for offset in range(ahead + 1):
+            month = current + relativedelta(months=offset)
+            if partitions.create_partition(month):
+                self.stdout.write("{}: created".format(partitions.partition_name(month)))
+
+    def _detach(self, before):
+        for month, name in sorted(partitions.partitions().items()):
+            if month < before:
+                partitions.detach_partition(name)
+                self.stdout.write("{}: detached".format(name))
+
+    def _archive(self, archive_dir):
+        for _, name in sorted(partitions.detached_partitions().items()):
+            if archive_dir:
+                path = partitions.archive_partition(
+                    name, os.path.join(archive_dir, '{}.csv.gz'.format(name))
+                )
+                self.stdout.write("{}: archived to {}".format(name, path))
+            partitions.drop_partition(name)
+            self.stdout.write("{}: dropped".format(name))
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError("The call records are partitioned on PostgreSQL only "
+                               "(see the 0004_partition_registercall migration)")
+
+        before = options['detach_before'] and self._month(options['detach_before'])
+        if before and before > timezone.localdate().replace(day=1):
+            raise CommandError("The current month can not be detached")
+        if options['archive_dir'] and not os.path.isdir(options['archive_dir']):
+            raise CommandError("Not a directory: {}".format(options['archive_dir']))
+
+        self._create(options['ahead'])
+        if before:
+            self._detach(before)
+        if options['archive_dir'] or options['drop']:
+            self._archive(options['archive_dir'])
+
+        self.stdout.write(self.style.SUCCESS("{} monthly partitions attached".format(
+            len(partitions.partitions())
+        )))
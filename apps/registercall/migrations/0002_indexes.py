@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registercall', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='registercall',
+            index=models.Index(fields=['source_call', 'type_call', 'timestamp_call'], name='registercal_source__624c5b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='registercall',
+            index=models.Index(fields=['id_call', 'type_call'], name='registercal_id_call_57281f_idx'),
+        ),
+    ]
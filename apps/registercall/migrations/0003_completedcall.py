@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registercall', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletedCall',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('id_call', models.PositiveIntegerField(unique=True)),
+                ('source_call', models.CharField(blank=True, max_length=11, null=True)),
+                ('destination_call', models.CharField(blank=True, max_length=11, null=True)),
+                ('start_call', models.DateTimeField()),
+                ('end_call', models.DateTimeField()),
+                ('duration_seconds', models.IntegerField()),
+                ('billable_minutes', models.PositiveIntegerField()),
+                ('price_cents', models.PositiveIntegerField()),
+            ],
+            options={
+                'verbose_name': 'Completed Call',
+                'verbose_name_plural': 'Completed Calls',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='completedcall',
+            index=models.Index(fields=['source_call', 'end_call'], name='registercal_source__ba11a6_idx'),
+        ),
+    ]
@@ -0,0 +1,167 @@
+"""
+    Stores the call records in monthly range partitions of ``timestamp_call`` on
+    PostgreSQL (no-op on the other databases). The model and its state are unchanged.
+
+    The unique constraints must contain the partition key, so the primary key
+    becomes (id, timestamp_call) and the (type_call, id_call) unique is kept by
+    the ``registercall_callkey`` table, filled by a trigger of the records table.
+"""
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from django.db import migrations
+from django.utils import timezone
+
+TABLE = 'registercall_registercall'
+GUARD_TABLE = 'registercall_callkey'
+MONTHS_AHEAD = 3
+
+UNIQUE = (('type_call', 'timestamp_call', 'id_call', 'source_call', 'destination_call'),
+          ('type_call', 'timestamp_call'))
+INDEXES = (('registercal_source__624c5b_idx', ('source_call', 'type_call', 'timestamp_call')),
+           ('registercal_id_call_57281f_idx', ('id_call', 'type_call')))
+
+CREATE_GUARD = """
+    CREATE TABLE {guard} (
+        type_call smallint NOT NULL,
+        id_call integer NOT NULL,
+        PRIMARY KEY (type_call, id_call)
+    );
+
+    CREATE FUNCTION {guard}_claim() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM {guard} WHERE type_call = OLD.type_call AND id_call = OLD.id_call;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            -- Fails with an unique violation if the key is taken by another record
+            INSERT INTO {guard} (type_call, id_call) VALUES (NEW.type_call, NEW.id_call);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION {guard}_release() RETURNS trigger AS $$
+    BEGIN
+        TRUNCATE {guard};
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER {guard}_claim
+        AFTER INSERT OR DELETE OR UPDATE OF type_call, id_call ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE {guard}_claim();
+
+    CREATE TRIGGER {guard}_release
+        AFTER TRUNCATE ON {table}
+        FOR EACH STATEMENT EXECUTE PROCEDURE {guard}_release();
+"""
+
+DROP_GUARD = """
+    DROP TABLE {guard};
+    DROP FUNCTION {guard}_claim();
+    DROP FUNCTION {guard}_release();
+"""
+
+
+def add_constraints(schema_editor, primary_key):
+    quote = schema_editor.quote_name
+    schema_editor.execute("ALTER TABLE {} ADD PRIMARY KEY ({})".format(
+        quote(TABLE), ', '.join(quote(column) for column in primary_key)
+    ))
+    for columns in UNIQUE:
+        schema_editor.execute("ALTER TABLE {} ADD CONSTRAINT {} UNIQUE ({})".format(
+            quote(TABLE), quote(schema_editor._create_index_name(TABLE, columns, suffix='_uniq')),
+            ', '.join(quote(column) for column in columns)
+        ))
+    for name, columns in INDEXES:
+        schema_editor.execute("CREATE INDEX {} ON {} ({})".format(
+            quote(name), quote(TABLE), ', '.join(quote(column) for column in columns)
+        ))
+
+
+def months(first, last):
+    month = timezone.localtime(first).date().replace(day=1)
+    last = timezone.localtime(last).date().replace(day=1)
+    while month <= last:
+        yield month
+        month += relativedelta(months=1)
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.quote_name
+    params = {'table': quote(TABLE), 'old': quote(TABLE + '_old'),
+              'default': quote(TABLE + '_default'), 'guard': quote(GUARD_TABLE)}
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT min(timestamp_call), max(timestamp_call), "
+                       "pg_get_serial_sequence(%s, 'id') FROM {table}".format(**params), [TABLE])
+        first, last, sequence = cursor.fetchone()
+
+    now = timezone.now()
+    first = min(first or now, now)
+    last = max(last or now, now) + relativedelta(months=MONTHS_AHEAD)
+
+    schema_editor.execute("ALTER TABLE {table} RENAME TO {old}".format(**params))
+    schema_editor.execute("CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS "
+                          "INCLUDING CONSTRAINTS) PARTITION BY RANGE (timestamp_call)"
+                          .format(**params))
+    schema_editor.execute("ALTER SEQUENCE {} OWNED BY {table}.id".format(sequence, **params))
+    schema_editor.execute("CREATE TABLE {default} PARTITION OF {table} DEFAULT".format(**params))
+    for month in months(first, last):
+        start = timezone.make_aware(datetime(month.year, month.month, 1))
+        schema_editor.execute(
+            "CREATE TABLE {} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)".format(
+                quote('{}_y{:04d}m{:02d}'.format(TABLE, month.year, month.month)), **params
+            ), [start, start + relativedelta(months=1)]
+        )
+
+    schema_editor.execute("INSERT INTO {table} SELECT * FROM {old}".format(**params))
+    schema_editor.execute("DROP TABLE {old}".format(**params))
+    add_constraints(schema_editor, ('id', 'timestamp_call'))
+
+    schema_editor.execute(CREATE_GUARD.format(**params))
+    schema_editor.execute("INSERT INTO {guard} (type_call, id_call) "
+                          "SELECT type_call, id_call FROM {table}".format(**params))
+    schema_editor.execute("ANALYZE {table}".format(**params))
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.quote_name
+    params = {'table': quote(TABLE), 'plain': quote(TABLE + '_plain'),
+              'guard': quote(GUARD_TABLE)}
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        sequence, = cursor.fetchone()
+
+    schema_editor.execute("CREATE TABLE {plain} (LIKE {table} INCLUDING DEFAULTS "
+                          "INCLUDING CONSTRAINTS)".format(**params))
+    schema_editor.execute("INSERT INTO {plain} SELECT * FROM {table}".format(**params))
+    schema_editor.execute("ALTER SEQUENCE {} OWNED BY {plain}.id".format(sequence, **params))
+    schema_editor.execute("DROP TABLE {table}".format(**params))
+    schema_editor.execute(DROP_GUARD.format(**params))
+    schema_editor.execute("ALTER TABLE {plain} RENAME TO {table}".format(**params))
+
+    add_constraints(schema_editor, ('id',))
+    schema_editor.execute("ALTER TABLE {} ADD CONSTRAINT {} UNIQUE (type_call, id_call)".format(
+        params['table'],
+        quote(schema_editor._create_index_name(TABLE, ('type_call', 'id_call'), suffix='_uniq'))
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registercall', '0003_completedcall'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
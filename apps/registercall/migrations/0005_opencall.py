@@ -0,0 +1,50 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:33
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+START, END = 1, 2
+
+
+def open_calls(apps, schema_editor):
+    """The call start records without a call end record are open calls"""
+    RegisterCall = apps.get_model('registercall', 'RegisterCall')
+    OpenCall = apps.get_model('registercall', 'OpenCall')
+
+    starts = RegisterCall.objects.filter(type_call=START).annotate(
+        ended=Exists(RegisterCall.objects.filter(id_call=OuterRef('id_call'), type_call=END))
+    ).filter(ended=False).values_list('id_call', 'source_call', 'destination_call',
+                                      'timestamp_call')
+
+    open_calls = []
+    for id_call, source_call, destination_call, start_call in starts.iterator():
+        open_calls.append(OpenCall(id_call=id_call, source_call=source_call,
+                                   destination_call=destination_call, start_call=start_call))
+        if len(open_calls) == 2000:
+            OpenCall.objects.bulk_create(open_calls)
+            open_calls = []
+    OpenCall.objects.bulk_create(open_calls)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registercall', '0004_partition_registercall'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenCall',
+            fields=[
+                ('id_call', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('source_call', models.CharField(blank=True, max_length=11, null=True)),
+                ('destination_call', models.CharField(blank=True, max_length=11, null=True)),
+                ('start_call', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Open Call',
+                'verbose_name_plural': 'Open Calls',
+            },
+        ),
+        migrations.RunPython(open_calls, migrations.RunPython.noop),
+    ]
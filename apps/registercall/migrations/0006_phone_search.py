@@ -0,0 +1,120 @@
+"""
+    Indexes of the phone number search (see ``apps/registercall/filters.py``) on
+    PostgreSQL, no-op on the other databases:
+
+    - ``varchar_pattern_ops`` btree indexes, for the exact and prefix matches
+      (``LIKE '9999%'``), whatever the collation of the database
+    - ``pg_trgm`` trigram GIN indexes, for the substring matches (``LIKE '%9999%'``)
+
+    The indexes are built ``CONCURRENTLY``, so the ingestion keeps writing while
+    they are built, and the migration is not atomic. On the partitioned call
+    records table an index can not be built concurrently on the parent: each
+    index is created ``ON ONLY`` the parent, invalid, built concurrently on each
+    partition and attached to it, and the parent index becomes valid once all
+    the partitions have it. The partitions created later get the index with it.
+
+    ``CREATE EXTENSION pg_trgm`` needs the privileges of the owner of the
+    database (a superuser before PostgreSQL 13): where the user of the
+    migrations does not have them, a superuser creates the extension first.
+    An interrupted migration leaves invalid indexes, built again when it is run
+    again.
+"""
+from django.db import migrations
+
+TABLE = 'registercall_registercall'
+FIELDS = ('source_call', 'destination_call')
+
+
+def index_names(field):
+    return 'registercall_{}_like'.format(field), 'registercall_{}_trgm'.format(field)
+
+
+def index_definitions(schema_editor, field):
+    """The (index name, definition) of the indexes of a field"""
+    quote = schema_editor.quote_name
+    like, trigram = index_names(field)
+    return ((like, "({} varchar_pattern_ops)".format(quote(field))),
+            (trigram, "USING gin ({} gin_trgm_ops)".format(quote(field))))
+
+
+def fetch(schema_editor, sql, params):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def drop_invalid(schema_editor, name):
+    """Drop the index if a previous run left it invalid"""
+    invalid = fetch(schema_editor, "SELECT NOT indisvalid FROM pg_index "
+                                   "WHERE indexrelid = to_regclass(%s)", [name])
+    if invalid and invalid[0][0]:
+        schema_editor.execute("DROP INDEX CONCURRENTLY {}".format(schema_editor.quote_name(name)))
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.quote_name
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    partitioned = fetch(schema_editor, "SELECT relkind FROM pg_class "
+                                       "WHERE oid = to_regclass(%s)", [TABLE]) == [('p',)]
+    partitions = [name for name, in fetch(schema_editor, """
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname
+    """, [TABLE])] if partitioned else []
+
+    for field in FIELDS:
+        for name, definition in index_definitions(schema_editor, field):
+            if not partitioned:
+                drop_invalid(schema_editor, name)
+                schema_editor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}".format(
+                    quote(name), quote(TABLE), definition
+                ))
+                continue
+
+            schema_editor.execute("CREATE INDEX IF NOT EXISTS {} ON ONLY {} {}".format(
+                quote(name), quote(TABLE), definition
+            ))
+            for partition in partitions:
+                partition_index = '{}_{}'.format(partition, name[len('registercall_'):])
+                attached = fetch(schema_editor, """
+                    SELECT 1 FROM pg_inherits
+                    WHERE inhrelid = to_regclass(%s) AND inhparent = to_regclass(%s)
+                """, [partition_index, name])
+                if attached:
+                    continue
+                drop_invalid(schema_editor, partition_index)
+                schema_editor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}".format(
+                    quote(partition_index), quote(partition), definition
+                ))
+                schema_editor.execute("ALTER INDEX {} ATTACH PARTITION {}".format(
+                    quote(name), quote(partition_index)
+                ))
+    schema_editor.execute("ANALYZE {}".format(quote(TABLE)))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    quote = schema_editor.quote_name
+    for field in FIELDS:
+        for name in index_names(field):
+            # The indexes of the partitions are dropped with the index of the parent,
+            # which can not be dropped concurrently
+            schema_editor.execute("DROP INDEX IF EXISTS {}".format(quote(name)))
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('registercall', '0005_opencall'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,38 @@
+"""
+    Releases the (type_call, id_call) keys of the records of the partitions
+    detached before ``partitions.detach_partition`` released them, which kept
+    the keys table growing. PostgreSQL only, no-op on the other databases.
+"""
+from django.db import migrations
+
+TABLE = 'registercall_registercall'
+GUARD_TABLE = 'registercall_callkey'
+
+
+def release_keys(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [GUARD_TABLE])
+        if cursor.fetchone()[0] is None:
+            return
+
+    quote = schema_editor.quote_name
+    schema_editor.execute("""
+        DELETE FROM {guard} AS guard
+        WHERE NOT EXISTS (SELECT 1 FROM {table} AS record
+                          WHERE record.id_call = guard.id_call
+                            AND record.type_call = guard.type_call)
+    """.format(guard=quote(GUARD_TABLE), table=quote(TABLE)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registercall', '0006_phone_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(release_keys, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,49 @@
-from django.core.exceptions import ValidationError, MultipleObjectsReturned
-from django.db import models
+from datetime import timedelta
+from itertools import islice
 
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.db.models import Exists, OuterRef, Subquery
+from django.utils import timezone
+
+from apps.phonebill.archive import discard_archive
+from apps.phonebill.cache import get_bill_cache
+from apps.phonebill.models import RunningBill
+from apps.phonebill.plans import call_span, get_tariffs
+from systemcall.metrics import span
+from .cache import get_open_call_cache
 from .choices import CallTypes
 
+ONE_SECOND = timedelta(seconds=1)
+
+# Inserts the calls not completed yet, and tells which ones it inserted
+INSERT_COMPLETED_CALLS = """
+    INSERT INTO {table} ({columns})
+    VALUES {values}
+    ON CONFLICT (id_call) DO NOTHING
+    RETURNING id_call
+"""
+
+
+class RegisterCallQuerySet(models.QuerySet):
+    """The call records, deleted with the completed calls they were part of"""
+
+    def delete(self):
+        """Delete the records, their completed calls (out of the running bills too), and
+        open or close their calls, like ``RegisterCall.delete``
+        """
+        with transaction.atomic():
+            id_calls = sorted(set(self.values_list('id_call', flat=True)))
+            deleted = super(RegisterCallQuerySet, self).delete()
+            for index in range(0, len(id_calls), OpenCall.batch_size):
+                batch = id_calls[index:index + OpenCall.batch_size]
+                CompletedCall.discard(batch)
+                OpenCall.sync(batch)
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
 
 class RegisterCall(models.Model):
     """RegisterCall Model
@@ -33,6 +74,8 @@ class RegisterCall(models.Model):
     source_call = models.CharField(max_length=11, null=True, blank=True)
     destination_call = models.CharField(max_length=11, null=True, blank=True)
 
+    objects = RegisterCallQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Register Call'
         verbose_name_plural = 'Register Calls'
@@ -40,6 +83,11 @@ class RegisterCall(models.Model):
                             'destination_call'),
                            ('type_call', 'id_call'),
                            ('type_call', 'timestamp_call'))
+        indexes = [
+            # Billing access paths: the subscriber calls and the call end of each call
+            models.Index(fields=['source_call', 'type_call', 'timestamp_call']),
+            models.Index(fields=['id_call', 'type_call']),
+        ]
 
     def __str__(self):
         return str(self.source_call)
@@ -58,6 +106,8 @@ class RegisterCall(models.Model):
                 "source_call": ["This field is required."],
                 "destination_call": ["This field is required."],
             })
+        elif self.type_call == CallTypes.START:
+            error.update(self._rate_error(self.source_call, self.destination_call))
 
         if not self.id_call:
             error.update({
@@ -65,27 +115,424 @@ class RegisterCall(models.Model):
             })
         elif self.type_call == CallTypes.END:
             self.source_call = self.destination_call = None
-            try:
-                start_call = RegisterCall.objects.get(id_call=self.id_call)
-                if self.timestamp_call < start_call.timestamp_call:
-                    error.update({
-                        "timestamp_call": ["Invalid timestamp_call. Must be grater then {}"
-                                           .format(start_call.timestamp_call)]
-                    })
-            except RegisterCall.DoesNotExist:
-                error.update({
-                    "id_call": ["Does not exist a call start entry with this call id: {}"
-                                .format(self.id_call)]
-                })
-            except MultipleObjectsReturned:
+            open_call = self._open_call = OpenCall.lookup(self.id_call)
+            if open_call is None:
+                error.update(self._closed_call_error())
+            elif self.timestamp_call < open_call.start_call:
                 error.update({
-                    "id_call": ["Already exists a type END for this id_call: {}"
-                                .format(self.id_call)]
+                    "timestamp_call": ["Invalid timestamp_call. Must be grater then {}"
+                                       .format(open_call.start_call)]
                 })
 
         if error:
             raise ValidationError(error)
 
+    @staticmethod
+    def _rate_error(source_call, destination_call):
+        """The error of a call start record whose destination has no rate in the tariff
+        plan of the subscriber, so its call could not be priced
+        """
+        tariffs = get_tariffs()
+        if tariffs.rate(source_call, destination_call) is None:
+            return {
+                "destination_call": ["No rate of the tariff plan {} for this destination."
+                                     .format(tariffs.plan(source_call).name)]
+            }
+        return {}
+
+    def _closed_call_error(self):
+        """The error of a call end record without an open call: its call is already
+        ended or it has no call start record. Both are unique lookups.
+        """
+        if CompletedCall.objects.filter(id_call=self.id_call).exists():
+            return {
+                "id_call": ["Already exists a type END for this id_call: {}"
+                            .format(self.id_call)]
+            }
+
+        start_call = RegisterCall.objects.filter(id_call=self.id_call,
+                                                 type_call=CallTypes.START).first()
+        if start_call is None:
+            return {
+                "id_call": ["Does not exist a call start entry with this call id: {}"
+                            .format(self.id_call)]
+            }
+
+        # A call start record loaded without the API (e.g. loaddata) and not indexed yet
+        self._open_call = OpenCall.from_start(start_call)
+        if self.timestamp_call < start_call.timestamp_call:
+            return {
+                "timestamp_call": ["Invalid timestamp_call. Must be grater then {}"
+                                   .format(start_call.timestamp_call)]
+            }
+        return {}
+
     def save(self, *args, **kwargs):
-        self.full_clean()
-        super(RegisterCall, self).save(*args, **kwargs)
+        self.full_clean(validate_unique=False)
+        # The (type_call, id_call) of a call end record is checked by clean, with its open call
+        self.validate_unique(exclude=['id_call'] if self.type_call == CallTypes.END else None)
+
+        adding = self._state.adding
+        with transaction.atomic():
+            id_calls = {self.id_call}
+            if not adding:
+                id_calls.update(RegisterCall.objects.filter(pk=self.pk)
+                                .values_list('id_call', flat=True))
+
+            super(RegisterCall, self).save(*args, **kwargs)
+
+            if adding and self.type_call == CallTypes.START:
+                OpenCall.open(self)
+                return
+
+            # A call whose record moved to another id_call is not complete anymore
+            CompletedCall.discard(id_calls - {self.id_call})
+            # A new call start has no call end yet
+            CompletedCall.refresh(self, created=adding)
+            if adding:
+                OpenCall.close([self.id_call])
+            else:
+                OpenCall.sync(id_calls)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            CompletedCall.discard([self.id_call])
+            deleted = super(RegisterCall, self).delete(*args, **kwargs)
+            OpenCall.sync([self.id_call])
+            return deleted
+
+
+class OpenCall(models.Model):
+    """OpenCall Model
+
+    A call start record without its call end record yet. It is created with the
+    call start record and removed with the call end record, so a call end record
+    is validated with a primary key lookup.
+
+    Attributes:
+        **id_call (int):** Unique for each call record pair
+
+        **source_call (str):** The subscriber phone number that originated the call
+
+        **destination_call (str):** The phone number receiving the call
+
+        **start_call (datetime):** The timestamp of the call start record
+    """
+
+    id_call = models.PositiveIntegerField(primary_key=True)
+    source_call = models.CharField(max_length=11, null=True, blank=True)
+    destination_call = models.CharField(max_length=11, null=True, blank=True)
+    start_call = models.DateTimeField()
+
+    batch_size = 2000
+
+    class Meta:
+        verbose_name = 'Open Call'
+        verbose_name_plural = 'Open Calls'
+
+    def __str__(self):
+        return str(self.id_call)
+
+    @classmethod
+    def from_start(cls, call):
+        return cls(id_call=call.id_call, source_call=call.source_call,
+                   destination_call=call.destination_call, start_call=call.timestamp_call)
+
+    @classmethod
+    def lookup(cls, id_call):
+        """The open call of the id_call, from the open call cache or the database
+
+        Return:
+            **OpenCall:** None if the call is not open
+        """
+        open_call_cache = get_open_call_cache()
+        cached = open_call_cache.get(id_call)
+        if cached is not None:
+            return cls(id_call, *cached)
+
+        open_call = cls.objects.filter(pk=id_call).first()
+        if open_call is not None:
+            open_call_cache.set(id_call, (open_call.source_call, open_call.destination_call,
+                                          open_call.start_call))
+        return open_call
+
+    @classmethod
+    def open(cls, call):
+        """Open the call of a new call start record"""
+        open_call = cls.from_start(call)
+        open_call.save(force_insert=True)
+        get_open_call_cache().set(call.id_call, (open_call.source_call,
+                                                 open_call.destination_call,
+                                                 open_call.start_call))
+
+    @classmethod
+    def close(cls, id_calls):
+        """Close the calls of new call end records"""
+        get_open_call_cache().delete(id_calls)
+        cls.objects.filter(pk__in=id_calls).delete()
+
+    @classmethod
+    def sync(cls, id_calls):
+        """Open or close the calls from their call start/end records, after they are
+        changed or deleted
+        """
+        open_calls = [cls.from_start(call) for call in RegisterCall.objects.filter(
+            id_call__in=id_calls, type_call=CallTypes.START
+        ).exclude(id_call__in=RegisterCall.objects.filter(
+            id_call__in=id_calls, type_call=CallTypes.END
+        ).values('id_call'))]
+
+        cls.close(id_calls)
+        cls.objects.bulk_create(open_calls)
+
+    @classmethod
+    def pending(cls):
+        """The call start records without a call end record that are not open calls
+
+        Return:
+            **QuerySet:** RegisterCall instances
+        """
+        call_end = RegisterCall.objects.filter(id_call=OuterRef('id_call'),
+                                               type_call=CallTypes.END)
+        open_call = cls.objects.filter(id_call=OuterRef('id_call'))
+
+        return RegisterCall.objects.filter(
+            type_call=CallTypes.START
+        ).annotate(
+            ended=Exists(call_end),
+            opened=Exists(open_call)
+        ).filter(
+            ended=False,
+            opened=False
+        ).order_by('id_call')
+
+
+class CompletedCall(models.Model):
+    """CompletedCall Model
+
+    A priced call, kept in the same transaction that saves its call end record,
+    so a bill is read with a range scan instead of pairing the raw records.
+
+    Attributes:
+        **id_call (int):** Unique for each call record pair
+
+        **source_call (str):** The subscriber phone number that originated the call
+
+        **destination_call (str):** The phone number receiving the call
+
+        **start_call (datetime):** The timestamp of the call start record
+
+        **end_call (datetime):** The timestamp of the call end record
+
+        **duration_seconds (int):** Duration of the call, in seconds
+
+        **billable_minutes (int):** Minutes charged at a non-zero rate (see ``phonebill.plans``)
+
+        **price_cents (int):** Price of the call, in cents
+    """
+
+    id_call = models.PositiveIntegerField(unique=True)
+    source_call = models.CharField(max_length=11, null=True, blank=True)
+    destination_call = models.CharField(max_length=11, null=True, blank=True)
+    start_call = models.DateTimeField()
+    end_call = models.DateTimeField()
+    duration_seconds = models.IntegerField()
+    billable_minutes = models.PositiveIntegerField()
+    price_cents = models.PositiveIntegerField()
+
+    batch_size = 2000
+
+    class Meta:
+        verbose_name = 'Completed Call'
+        verbose_name_plural = 'Completed Calls'
+        indexes = [
+            models.Index(fields=['source_call', 'end_call']),
+        ]
+
+    def __str__(self):
+        return str(self.id_call)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Price the calls with the tariff plans of their subscribers, compiled in memory,
+        in vectorized passes over the calls of each plan and destination rate
+
+        Args:
+            **pairs (list):** (id_call, source_call, destination_call, start, end) tuples
+
+        Return:
+            **list:** CompletedCall instances, not saved
+        """
+        if not pairs:
+            return []
+
+        with span('calls.pricing'):
+            spans = [call_span(start, end) for _, _, _, start, end in pairs]
+            priced = get_tariffs().price_calls(
+                [pair[1] for pair in pairs], [pair[2] for pair in pairs],
+                [start for start, _ in spans], [end for _, end in spans]
+            )
+
+        return [
+            cls(id_call=id_call, source_call=source_call, destination_call=destination_call,
+                start_call=start, end_call=end, duration_seconds=(end - start) // ONE_SECOND,
+                billable_minutes=minutes, price_cents=cents)
+            for minutes, cents, (id_call, source_call, destination_call, start, end)
+            in zip(priced.minutes.tolist(), priced.cents.tolist(), pairs)
+        ]
+
+    @staticmethod
+    def invalidate_bills(calls):
+        """Invalidate the cached bills of the subscriber periods where the calls end,
+        and the archives of their months, once the current transaction is committed
+
+        Args:
+            **calls (iterable):** CompletedCall instances
+        """
+        periods = set()
+        for call in calls:
+            end = timezone.localtime(call.end_call) if timezone.is_aware(call.end_call) \
+                else call.end_call
+            periods.add((call.source_call, end.month, end.year))
+
+        def invalidate():
+            bill_cache = get_bill_cache()
+            for period in periods:
+                bill_cache.invalidate(*period)
+            # A late call of an archived month is billed from the database until
+            # the month is archived again
+            for month, year in {period[1:] for period in periods}:
+                discard_archive(month, year)
+
+        transaction.on_commit(invalidate)
+
+    @classmethod
+    def discard(cls, id_calls):
+        """Delete the completed calls of the id_calls, whose call start/end records were
+        changed or deleted, removing them from the running bills
+
+        Args:
+            **id_calls (iterable):** The id_call of the calls
+        """
+        completed = list(cls.objects.filter(id_call__in=list(id_calls)))
+        if not completed:
+            return
+        cls.invalidate_bills(completed)
+        RunningBill.remove(completed)
+        cls.objects.filter(pk__in=[call.pk for call in completed]).delete()
+
+    @classmethod
+    def bulk_complete(cls, pairs):
+        """Price and insert the calls in batches, skipping the ones already completed
+
+        Args:
+            **pairs (iterable):** (id_call, source_call, destination_call, start, end) tuples
+
+        Return:
+            **int:** Number of priced calls
+        """
+        pairs, total = iter(pairs), 0
+        while True:
+            batch = list(islice(pairs, cls.batch_size))
+            if not batch:
+                return total
+            with transaction.atomic(savepoint=False):
+                existing = set(cls.objects.filter(id_call__in=[pair[0] for pair in batch])
+                               .values_list('id_call', flat=True))
+                completed = cls._insert_new(cls.from_pairs(
+                    [pair for pair in batch if pair[0] not in existing]
+                ))
+                # The calls completed already are not added to the running bills again
+                RunningBill.add(completed)
+                cls.invalidate_bills(completed)
+            total += len(completed)
+
+    @classmethod
+    def _insert_new(cls, completed):
+        """Insert the calls, skipping the ones completed meanwhile by another transaction
+
+        On PostgreSQL the insert returns the calls it inserted; the other databases
+        (SQLite) lock the whole database for the writes of a transaction.
+
+        Return:
+            **list:** The calls inserted
+        """
+        if not completed:
+            return []
+        if connection.vendor != 'postgresql':
+            cls.objects.bulk_create(completed)
+            return completed
+
+        fields = [field for field in cls._meta.concrete_fields if field is not cls._meta.pk]
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        values = '({})'.format(', '.join(['%s'] * len(fields)))
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT_COMPLETED_CALLS.format(
+                table=connection.ops.quote_name(cls._meta.db_table), columns=columns,
+                values=', '.join([values] * len(completed))
+            ), [field.get_db_prep_save(getattr(call, field.attname), connection)
+                for call in completed for field in fields])
+            inserted = {id_call for id_call, in cursor.fetchall()}
+        return [call for call in completed if call.id_call in inserted]
+
+    @staticmethod
+    def pending_pairs():
+        """The call start/end record pairs that are not completed yet
+
+        Return:
+            **QuerySet:** (id_call, source_call, destination_call, start, end) tuples
+        """
+        call_end = RegisterCall.objects.filter(
+            id_call=OuterRef('id_call'),
+            type_call=CallTypes.END
+        ).values('timestamp_call')[:1]
+        completed = CompletedCall.objects.filter(id_call=OuterRef('id_call'))
+
+        return RegisterCall.objects.filter(
+            type_call=CallTypes.START
+        ).annotate(
+            call_end=Subquery(call_end),
+            completed=Exists(completed)
+        ).filter(
+            call_end__isnull=False,
+            completed=False
+        ).order_by('id_call').values_list('id_call', 'source_call', 'destination_call',
+                                          'timestamp_call', 'call_end')
+
+    @classmethod
+    def refresh(cls, call, created=False):
+        """Keep the completed call in line with its call start/end records
+
+        Args:
+            **call (RegisterCall):** The call start or end record just saved
+
+            **created (bool):** True if ``call`` is a new call end record
+        """
+        if call.type_call == CallTypes.END:
+            start = getattr(call, '_open_call', None) or OpenCall.from_start(
+                RegisterCall.objects.get(id_call=call.id_call, type_call=CallTypes.START)
+            )
+            end = call
+        else:
+            start = OpenCall.from_start(call)
+            end = RegisterCall.objects.filter(id_call=call.id_call,
+                                              type_call=CallTypes.END).first()
+            if end is None:
+                return
+
+        completed, = cls.from_pairs([(start.id_call, start.source_call, start.destination_call,
+                                      start.start_call, end.timestamp_call)])
+        if created:
+            completed.save(force_insert=True)
+            RunningBill.add([completed])
+            cls.invalidate_bills([completed])
+            return
+
+        # The bill where the call was before the change is invalidated too
+        previous = list(cls.objects.filter(id_call=completed.id_call))
+        RunningBill.remove(previous)
+        RunningBill.add([completed])
+        cls.invalidate_bills(previous + [completed])
+        fields = {field.name: getattr(completed, field.name)
+                  for field in cls._meta.concrete_fields if not field.primary_key}
+        cls.objects.update_or_create(id_call=completed.id_call, defaults=fields)
@@ -0,0 +1,170 @@
+"""
+    Monthly range partitions of the call records table, on PostgreSQL.
+
+    Each month of ``timestamp_call`` (in the project time zone, the same months of
+    the bills) is stored in its own partition; the records out of the created
+    months go to the default partition. The table is partitioned by the
+    ``0004_partition_registercall`` migration.
+"""
+import gzip
+import re
+from datetime import date, datetime
+
+from dateutil.relativedelta import relativedelta
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import RegisterCall
+
+TABLE = RegisterCall._meta.db_table
+DEFAULT_PARTITION = TABLE + '_default'
+PARTITION_NAME = re.compile(r'^{}_y(\d{{4}})m(\d{{2}})$'.format(TABLE))
+
+# Keeps the (type_call, id_call) unique over all the partitions, see the migration.
+# The keys of a partition are released when it is detached
+GUARD_TABLE = 'registercall_callkey'
+
+RELEASE_KEYS = """
+    DELETE FROM {guard} AS guard USING {name} AS record
+    WHERE guard.type_call = record.type_call AND guard.id_call = record.id_call
+"""
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def is_partitioned():
+    """True if the call records table is partitioned"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def partition_name(month):
+    return '{}_y{:04d}m{:02d}'.format(TABLE, month.year, month.month)
+
+
+def partition_month(name):
+    """The month of a partition, None if it is not a monthly partition"""
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def month_bounds(month):
+    """The month as a half-open range of timestamps, in the project time zone
+
+    Return
+        **tuple:** (first instant of the month, first instant of the next month)
+    """
+    start = timezone.make_aware(datetime(month.year, month.month, 1))
+    return start, start + relativedelta(months=1)
+
+
+def partitions():
+    """The attached monthly partitions
+
+    Return
+        **dict:** {month (date): partition name}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, [TABLE])
+        names = [name for name, in cursor.fetchall()]
+    return {partition_month(name): name for name in names if partition_month(name)}
+
+
+def detached_partitions():
+    """The monthly partitions detached from the table and not dropped yet
+
+    Return
+        **dict:** {month (date): table name}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT relname FROM pg_class
+            WHERE relkind = 'r' AND NOT relispartition AND relname LIKE %s
+        """, [TABLE + '\\_y%'])
+        names = [name for name, in cursor.fetchall()]
+    return {partition_month(name): name for name in names if partition_month(name)}
+
+
+def create_partition(month):
+    """Create the partition of a month, moving its records out of the default partition
+
+    Return
+        **bool:** True if it was created, False if it already exists
+    """
+    if month in partitions():
+        return False
+
+    start, end = month_bounds(month)
+    params = {'table': _quote(TABLE), 'name': _quote(partition_name(month)),
+              'default': _quote(DEFAULT_PARTITION),
+              'guard': _quote(GUARD_TABLE)}
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM {default}
+                           WHERE timestamp_call >= %s AND timestamp_call < %s)
+        """.format(**params), [start, end])
+        if not cursor.fetchone()[0]:
+            cursor.execute("CREATE TABLE {name} PARTITION OF {table} "
+                           "FOR VALUES FROM (%s) TO (%s)".format(**params), [start, end])
+            return True
+
+        # A month can not be attached while the default partition has records of it
+        cursor.execute("CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS "
+                       "INCLUDING CONSTRAINTS)".format(**params))
+        cursor.execute("""
+            WITH moved AS (
+                DELETE FROM {default}
+                WHERE timestamp_call >= %s AND timestamp_call < %s
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """.format(**params), [start, end])
+        cursor.execute("ALTER TABLE {table} ATTACH PARTITION {name} "
+                       "FOR VALUES FROM (%s) TO (%s)".format(**params), [start, end])
+        # The keys released by the delete from the default partition are taken again
+        cursor.execute("INSERT INTO {guard} (type_call, id_call) "
+                       "SELECT type_call, id_call FROM {name} "
+                       "ON CONFLICT DO NOTHING".format(**params))
+    return True
+
+
+def detach_partition(name):
+    """Detach a partition, leaving its records in a table of its own
+
+    The (type_call, id_call) of the detached records are released, so the keys
+    table holds the keys of the attached records only.
+    """
+    params = {'table': _quote(TABLE), 'name': _quote(name), 'guard': _quote(GUARD_TABLE)}
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE {table} DETACH PARTITION {name}".format(**params))
+        cursor.execute(RELEASE_KEYS.format(**params))
+
+
+def archive_partition(name, path):
+    """Write the records of a detached partition to a gzipped CSV file
+
+    Return
+        **str:** The path of the file
+    """
+    with connection.cursor() as cursor, gzip.open(path, 'wt', encoding='utf-8') as archive:
+        cursor.copy_expert("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)".format(_quote(name)),
+                           archive)
+    return path
+
+
+def drop_partition(name):
+    """Drop a partition, detaching it first (releasing its keys) if it is attached"""
+    if name in partitions().values():
+        detach_partition(name)
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE {}".format(_quote(name)))
@@ -7,3 +7,16 @@ class RegisterCallSerializer(ModelSerializer):
         model = RegisterCall
         fields = ('id', 'type_call', 'timestamp_call', 'id_call', 'source_call',
                   'destination_call')
+
+
+class RegisterCallBatchSerializer(ModelSerializer):
+    """Validates the fields of a record of a batch
+
+    The unique checks are left out, a batch is checked against the database as a set
+    (see ``CallBatch``)
+    """
+
+    class Meta:
+        model = RegisterCall
+        fields = ('type_call', 'timestamp_call', 'id_call', 'source_call', 'destination_call')
+        validators = []
@@ -1,20 +1,30 @@
+from rest_framework import status
 from rest_framework.authentication import TokenAuthentication
-from rest_framework.filters import SearchFilter
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated, DjangoModelPermissions
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
+from systemcall.pagination import KeysetPagination, NDJSONStreamMixin
+from .filters import PhoneSearchFilter
+from .functions import CallBatch
 from .models import RegisterCall
+from .parsers import NDJSONParser
 from .serializer import RegisterCallSerializer
 
 
-class RegisterCallViewSet(ModelViewSet):
+class RegisterCallPagination(KeysetPagination):
+    ordering = ('timestamp_call', 'id')
+
+
+class RegisterCallViewSet(NDJSONStreamMixin, ModelViewSet):
 
     serializer_class = RegisterCallSerializer
+    pagination_class = RegisterCallPagination
 
-    # choose querystring altomatic
-    # pip install django-filter, add in settings too
-    filter_backends = (SearchFilter,)
-    # for fk pass "nameClassForegn.field"
-    search_fields = ('type_call', 'source_call', 'destination_call')
+    # ?search=<number>&match=exact|prefix|contains, on the indexes of the numbers
+    filter_backends = (PhoneSearchFilter,)
+    search_fields = ('source_call', 'destination_call')
 
     # login required to authenticate
     # USER THIS PERMISSION
@@ -42,3 +52,20 @@ class RegisterCallViewSet(ModelViewSet):
             queryset = queryset.filter(source_call=source_call)
 
         return queryset
+
+    @action(detail=False, methods=['post'], parser_classes=(JSONParser, NDJSONParser))
+    def batch(self, request):
+        """
+            Create a batch of call records, sent as a JSON array or as NDJSON
+            (Content-Type: application/x-ndjson).
+
+            Each invalid record is reported by its index, the valid ones are created.
+        """
+        if not isinstance(request.data, list):
+            return Response({'non_field_errors': ["Expected a list of call records."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        result = CallBatch(request.data).save()
+        if not result['created'] and result['errors']:
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result, status=status.HTTP_201_CREATED)
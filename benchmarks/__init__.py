@@ -0,0 +1,3 @@
+"""
+    Micro-benchmarks, run from the project root: ``python -m benchmarks.<name>``
+"""
@@ -0,0 +1,56 @@
+"""
+    Formatting of the call prices: ``babel.numbers.format_currency`` against
+    the precompiled ``CurrencyFormatter``
+
+        python -m benchmarks.bench_currency [--calls 100000] [--repeat 5]
+"""
+import argparse
+import random
+import timeit
+
+from babel.numbers import format_currency
+
+from apps.phonebill.currency import (PRICE_CURRENCY, PRICE_LOCALE, PRICE_PATTERN,
+                                     CurrencyFormatter)
+
+
+def call_prices(calls, seed=0):
+    """Prices (cents) of a month of calls: R$ 0,36 plus R$ 0,09 per minute, up to 2 hours"""
+    rand = random.Random(seed)
+    return [36 + 9 * rand.randint(0, 120) for _ in range(calls)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    prices = call_prices(args.calls)
+    formatter = CurrencyFormatter(PRICE_CURRENCY, PRICE_PATTERN, PRICE_LOCALE)
+
+    def babel():
+        return [format_currency(cents / 100, PRICE_CURRENCY, PRICE_PATTERN, locale=PRICE_LOCALE)
+                for cents in prices]
+
+    def compiled():
+        return [formatter.format_cents(cents) for cents in prices]
+
+    def compiled_no_memo():
+        return [formatter._format_cents(cents) for cents in prices]
+
+    assert babel() == compiled(), "The formatted prices differ from Babel"
+
+    results = [(name, min(timeit.repeat(function, number=1, repeat=args.repeat)))
+               for name, function in (('babel.format_currency', babel),
+                                      ('CurrencyFormatter (no memo)', compiled_no_memo),
+                                      ('CurrencyFormatter', compiled))]
+    baseline = results[0][1]
+    print("{} prices, best of {}".format(args.calls, args.repeat))
+    for name, elapsed in results:
+        print("{:<32} {:8.1f} ms {:10.0f} prices/s {:7.1f}x".format(
+            name, elapsed * 1000, args.calls / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
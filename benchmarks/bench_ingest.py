@@ -0,0 +1,119 @@
+"""
+    Sustained rate of the asynchronous ingestion of call records, against a running
+    ingestion server backed by a local PostgreSQL
+
+        uvicorn systemcall.asgi:application --port 8001
+        python -m benchmarks.bench_ingest --url http://localhost:8001 --token <token> \\
+            [--calls 100000] [--batch 500] [--concurrency 8]
+
+    The token must be of a user allowed to add call records. The calls are sent
+    as NDJSON start/end pairs with new ids, starting from ``--first-id``.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from http.client import HTTPConnection
+from urllib.parse import urlparse
+
+INGEST_PATH = '/registercall/ingest/'
+STATS_PATH = '/registercall/ingest/stats/'
+
+
+def call_records(calls, first_id, started=datetime(2018, 7, 1)):
+    """Start and end records of calls with a unique id and unique timestamps"""
+    for index in range(calls):
+        start = started + timedelta(seconds=index)
+        yield {'id_call': first_id + index, 'type_call': 1, 'timestamp_call': start.isoformat(),
+               'source_call': '99988526423', 'destination_call': '9993468278'}
+        yield {'id_call': first_id + index, 'type_call': 2,
+               'timestamp_call': (start + timedelta(seconds=90)).isoformat()}
+
+
+class Client:
+    """One connection to the ingestion server"""
+
+    def __init__(self, url, token):
+        self.url = urlparse(url)
+        self.headers = {'Authorization': 'Token {}'.format(token)}
+
+    def request(self, method, path, body=None):
+        connection = HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+        try:
+            headers = dict(self.headers, **({'Content-Type': 'application/x-ndjson'}
+                                            if body is not None else {}))
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read().decode('utf-8'))
+        finally:
+            connection.close()
+
+    def stats(self):
+        return self.request('GET', STATS_PATH)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8001')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=500, help="Records per request")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--first-id', type=int, default=10000000)
+    args = parser.parse_args()
+
+    records = list(call_records(args.calls, args.first_id))
+    # Each request takes whole start/end pairs
+    args.batch += args.batch % 2
+    bodies = deque('\n'.join(json.dumps(record) for record in records[index:index + args.batch])
+                   for index in range(0, len(records), args.batch))
+
+    client = Client(args.url, args.token)
+    before = client.stats()
+    throttled = [0]
+    lock = threading.Lock()
+
+    def send():
+        while True:
+            with lock:
+                if not bodies:
+                    return
+                body = bodies.popleft()
+            status, data = client.request('POST', INGEST_PATH, body.encode('utf-8'))
+            while status == 429:
+                with lock:
+                    throttled[0] += 1
+                time.sleep(0.05)
+                status, data = client.request('POST', INGEST_PATH, body.encode('utf-8'))
+            if status != 202:
+                raise RuntimeError("{}: {}".format(status, data))
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=send) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    accepted = time.monotonic() - started
+
+    while True:
+        stats = client.stats()
+        if stats['created'] + stats['rejected'] >= before['created'] + before['rejected'] \
+                + len(records):
+            break
+        time.sleep(0.01)
+    written = time.monotonic() - started
+
+    print("{} records in requests of {}, {} concurrent clients".format(
+        len(records), args.batch, args.concurrency))
+    print("acknowledged in {:.2f}s ({:.0f} records/s), {} requests throttled (429)".format(
+        accepted, len(records) / accepted, throttled[0]))
+    print("written in {:.2f}s ({:.0f} records/s sustained), {} created, {} rejected".format(
+        written, len(records) / written, stats['created'] - before['created'],
+        stats['rejected'] - before['rejected']))
+
+
+if __name__ == '__main__':
+    main()
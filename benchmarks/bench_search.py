@@ -0,0 +1,150 @@
+"""
+    Latency of the phone number search of /registercall/ as the call records table
+    grows, on a throwaway test database of the configured one
+
+        python -m benchmarks.bench_search [--sizes 10000,100000,1000000] [--queries 50]
+
+    The table is filled with seeded synthetic calls (see ``benchmarks.cdr``) up to
+    each size, then the exact, prefix and substring searches of destination numbers
+    taken from the calls are timed through the API. With the indexes of the search
+    the latency stays about the same at every size: the suite exits with 1 if the
+    median of a search grows more than ``--max-growth`` times from the first size.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date
+from itertools import islice
+
+from dateutil.relativedelta import relativedelta
+
+from benchmarks.cdr import CDRGenerator
+
+MATCHES = ('exact', 'prefix', 'contains')
+
+
+def search_terms(calls, queries, seed):
+    """The searches of each match, from the destination numbers of the calls
+
+    Return:
+        **dict:** The search terms, by match
+    """
+    rand = random.Random(seed)
+    destinations = [destination for _, _, destination, _, _ in
+                    rand.sample(calls, min(queries, len(calls)))]
+    return {
+        'exact': destinations,
+        'prefix': [destination[:8] for destination in destinations],
+        'contains': [destination[3:9] for destination in destinations],
+    }
+
+
+def fill(calls, batch_size=5000):
+    """Insert the start and end records of the calls"""
+    from django.utils import timezone
+
+    from apps.registercall.choices import CallTypes
+    from apps.registercall.models import RegisterCall
+
+    def records():
+        for id_call, source_call, destination_call, start, end in calls:
+            yield RegisterCall(type_call=CallTypes.START, id_call=id_call,
+                               timestamp_call=timezone.make_aware(start),
+                               source_call=source_call, destination_call=destination_call)
+            yield RegisterCall(type_call=CallTypes.END, id_call=id_call,
+                               timestamp_call=timezone.make_aware(end))
+
+    records = records()
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        RegisterCall.objects.bulk_create(batch)
+
+
+def run(sizes, queries, subscribers, seed):
+    """Grow the table to each size and time the searches
+
+    Return:
+        **list:** (size, match, median ms, p95 ms) of each size and match
+    """
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import (setup_databases, setup_test_environment,
+                                   teardown_databases, teardown_test_environment)
+    from rest_framework.test import APIClient
+
+    setup_test_environment(debug=False)
+    databases = setup_databases(verbosity=0, interactive=False)
+    results = []
+    try:
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('benchmark'))
+        records, first_id, period = 0, 1, date(2018, 1, 1)
+        for size in sizes:
+            # Each step fills a new month, with its own (type_call, timestamp_call)
+            calls = list(CDRGenerator(subscribers, max(1, (size - records) // 2 // subscribers),
+                                      period=period, first_id=first_id,
+                                      seed=seed + first_id).calls())
+            fill(calls)
+            records += 2 * len(calls)
+            first_id += len(calls)
+            period += relativedelta(months=1)
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("ANALYZE registercall_registercall")
+
+            for match, terms in search_terms(calls, queries, seed).items():
+                timings = []
+                for term in terms:
+                    started = time.perf_counter()
+                    response = client.get('/registercall/', {'search': term, 'match': match})
+                    timings.append((time.perf_counter() - started) * 1000)
+                    if response.status_code != 200 or not response.data['results']:
+                        raise RuntimeError("Search {} {} failed ({}): {}".format(
+                            match, term, response.status_code, response.data))
+                timings.sort()
+                median = statistics.median(timings)
+                p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+                results.append((records, match, median, p95))
+                print("{:>10} records {:<9} median {:8.2f} ms  p95 {:8.2f} ms".format(
+                    records, match, median, p95))
+    finally:
+        teardown_databases(databases, verbosity=0)
+        teardown_test_environment()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help="Call records in the table at each step, comma separated")
+    parser.add_argument('--queries', type=int, default=50, help="Searches of each match")
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-growth', type=float, default=3.0,
+                        help="Accepted growth of a median latency from the first size")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'systemcall.settings')
+    import django
+    django.setup()
+
+    results = run(sizes, args.queries, args.subscribers, args.seed)
+    first = {match: median for _, match, median, _ in results[:len(MATCHES)]}
+    growing = [(match, median / first[match]) for _, match, median, _ in results[-len(MATCHES):]
+               if median > first[match] * args.max_growth]
+    for match, growth in growing:
+        print("GROWTH {}: the median latency grew {:.1f} times".format(match, growth),
+              file=sys.stderr)
+    if growing:
+        sys.exit(1)
+    print("The median latencies grew less than {} times".format(args.max_growth))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+    Seeded synthetic call detail records (CDRs): the same arguments always make
+    the same calls, so the benchmark results can be compared between runs.
+
+        python -m benchmarks.cdr --subscribers 100 --calls 50 > calls.ndjson
+"""
+import argparse
+import json
+import math
+import random
+import sys
+from datetime import date, datetime, timedelta
+
+from dateutil.relativedelta import relativedelta
+
+DURATIONS = ('exponential', 'lognormal', 'uniform')
+
+
+class CDRGenerator:
+    """Class responsible for generating the calls of a month of subscribers
+
+    Each call starts at an unique instant of the month and its end record is
+    unique too, as required by the (type_call, timestamp_call) unique of the
+    call records. The calls ending after the month are billed in the next one.
+    The taken instants are kept in memory, about 150 bytes per call.
+
+    Attributes:
+        **subscribers (int):** Number of subscribers (source phone numbers)
+
+        **calls_per_subscriber (int):** Number of calls of each subscriber
+
+        **mean_duration (int):** Mean duration of the calls, in seconds
+
+        **duration (str):** Distribution of the durations: exponential, lognormal or uniform
+
+        **max_duration (int):** Longest call, in seconds
+
+        **midnight_ratio (float):** Fraction of the calls that cross midnight
+
+        **period (date):** First day of the month of the calls
+
+        **first_id (int):** The id_call of the first call
+
+        **seed (int):** Seed of the random generator
+    """
+
+    def __init__(self, subscribers=100, calls_per_subscriber=50, mean_duration=180,
+                 duration='exponential', max_duration=4 * 3600, midnight_ratio=0.05,
+                 period=date(2018, 7, 1), first_id=1, seed=0):
+        if duration not in DURATIONS:
+            raise ValueError("Invalid duration: {}. Must be one of {}".format(
+                duration, ', '.join(DURATIONS)))
+        if not 0 <= midnight_ratio <= 1:
+            raise ValueError("Invalid midnight_ratio: {}. Must be between 0 and 1"
+                             .format(midnight_ratio))
+        self.subscribers = subscribers
+        self.calls_per_subscriber = calls_per_subscriber
+        self.mean_duration = mean_duration
+        self.duration = duration
+        self.max_duration = max_duration
+        self.midnight_ratio = midnight_ratio
+        self.period = period
+        self.first_id = first_id
+        self.seed = seed
+
+    @property
+    def total_calls(self):
+        return self.subscribers * self.calls_per_subscriber
+
+    @property
+    def period_label(self):
+        """The period of the calls as the bills take it (mm/yyyy)"""
+        return self.period.strftime('%m/%Y')
+
+    def source_calls(self):
+        """The phone numbers of the subscribers"""
+        return ['99{:09d}'.format(index) for index in range(self.subscribers)]
+
+    def _duration(self, rand):
+        if self.duration == 'exponential':
+            seconds = rand.expovariate(1 / self.mean_duration)
+        elif self.duration == 'lognormal':
+            # Same mean, with a standard deviation of the mean
+            sigma = math.sqrt(math.log(2))
+            seconds = rand.lognormvariate(math.log(self.mean_duration) - sigma ** 2 / 2, sigma)
+        else:
+            seconds = rand.uniform(0, 2 * self.mean_duration)
+        return max(1, min(self.max_duration, int(seconds)))
+
+    def calls(self):
+        """The calls, ordered by id_call
+
+        Return:
+            **generator:** (id_call, source_call, destination_call, start, end) tuples,
+            with naive datetimes of the current time zone
+        """
+        rand = random.Random(self.seed)
+        first = datetime(self.period.year, self.period.month, 1)
+        day = 86400 * 10 ** 6
+        span = int((first + relativedelta(months=1) - first).total_seconds()) * 10 ** 6
+        sources = self.source_calls()
+        # Instants taken, in microseconds from the start of the month
+        starts, ends = set(), set()
+
+        for index in range(self.total_calls):
+            duration = self._duration(rand) * 10 ** 6
+            start = rand.randrange(span)
+            if rand.random() < self.midnight_ratio:
+                # Starts before the midnight of its day and ends after it
+                duration = max(duration, 2 * 10 ** 6)
+                start = start - start % day + day - rand.randrange(1, duration)
+            while start in starts:
+                start += 1
+            starts.add(start)
+            end = start + duration
+            while end in ends:
+                end += 1
+            ends.add(end)
+
+            yield (self.first_id + index, sources[index % self.subscribers],
+                   '9{:09d}'.format(rand.randrange(10 ** 9)),
+                   first + timedelta(microseconds=start), first + timedelta(microseconds=end))
+
+    def records(self):
+        """The call start and end records of the calls, as sent to the API
+
+        Return:
+            **generator:** dicts of the call records, the start record before the end one
+        """
+        for id_call, source_call, destination_call, start, end in self.calls():
+            yield {'id_call': id_call, 'type_call': 1, 'timestamp_call': start.isoformat(),
+                   'source_call': source_call, 'destination_call': destination_call}
+            yield {'id_call': id_call, 'type_call': 2, 'timestamp_call': end.isoformat()}
+
+
+def add_arguments(parser):
+    """The generator options of a command line"""
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--calls', type=int, default=50, help="Calls per subscriber")
+    parser.add_argument('--mean-duration', type=int, default=180, help="Seconds")
+    parser.add_argument('--duration', choices=DURATIONS, default='exponential',
+                        help="Distribution of the call durations")
+    parser.add_argument('--midnight-ratio', type=float, default=0.05,
+                        help="Fraction of the calls crossing midnight")
+    parser.add_argument('--period', default='07/2018', help="Month of the calls (MM/YYYY)")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def from_arguments(args, **options):
+    """The generator of the parsed command line options"""
+    return CDRGenerator(
+        subscribers=args.subscribers, calls_per_subscriber=args.calls,
+        mean_duration=args.mean_duration, duration=args.duration,
+        midnight_ratio=args.midnight_ratio,
+        period=datetime.strptime(args.period, '%m/%Y').date(), seed=args.seed, **options
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write seeded synthetic call records as NDJSON")
+    add_arguments(parser)
+    for record in from_arguments(parser.parse_args()).records():
+        sys.stdout.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+    Benchmark suite over seeded synthetic call records (see ``benchmarks.cdr``),
+    run on a throwaway test database of the configured one
+
+        python -m benchmarks.suite --scale 10k [--output bench-10k.json]
+        python -m benchmarks.suite --scale 10k --save-baseline
+
+    The results are compared with the baseline of the scale (by default
+    ``benchmarks/baselines/<scale>.json``): a benchmark slower than its baseline
+    rate by more than the tolerance is a regression, and the suite exits with 1.
+    The baselines are kept per machine and database, save them where the suite runs.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+
+from benchmarks import cdr
+
+# (subscribers, calls per subscriber): 10 thousand, 1 million and 10 million call records
+SCALES = {
+    '10k': (100, 50),
+    '1m': (2000, 250),
+    '10m': (20000, 250),
+}
+BASELINES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+class Suite:
+    """Class responsible for running the benchmarks on the calls of a generator
+
+    Attributes:
+        **generator (CDRGenerator):** The calls of the benchmarks
+
+        **batch (int):** Call records per request of the ingestion
+
+        **bills (int):** Bills calculated and created, of the first subscribers
+    """
+
+    def __init__(self, generator, batch=1000, bills=100):
+        self.generator = generator
+        self.batch = batch
+        self.bills = bills
+        self.results = {}
+
+    def measure(self, name, unit, count, function):
+        """Run ``function`` once, keeping its rate of ``count`` units per second"""
+        started = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - started
+        self.results[name] = {'unit': unit, 'count': count, 'seconds': round(seconds, 6),
+                              'rate': round(count / seconds, 3)}
+        print("{:<24} {:>10} {:<8} {:10.3f} s {:14.1f} {}/s".format(
+            name, count, unit, seconds, count / seconds, unit))
+
+    def run_tariff(self):
+        from django.utils import timezone
+
+        from apps.phonebill.functions import CallBill
+
+        pairs = [(timezone.make_aware(start), timezone.make_aware(end))
+                 for _, _, _, start, end in self.generator.calls()]
+        self.measure('CallBill._get_price', 'calls', len(pairs),
+                     lambda: [CallBill._get_price(start, end) for start, end in pairs])
+        self.measure('CallBill._get_duration', 'calls', len(pairs),
+                     lambda: [CallBill._get_duration(start, end) for start, end in pairs])
+
+    def run_ingestion(self, client):
+        records = self.generator.records()
+
+        def ingest():
+            while True:
+                batch = [record for _, record in zip(range(self.batch), records)]
+                if not batch:
+                    return
+                response = client.post('/registercall/batch/', format='json', data=batch)
+                result = response.json()
+                if response.status_code != 201 or result['errors']:
+                    raise RuntimeError("Ingestion failed ({}): {}".format(
+                        response.status_code, result))
+
+        self.measure('RegisterCallViewSet.batch', 'records',
+                     2 * self.generator.total_calls, ingest)
+
+    def run_bills(self, client):
+        from apps.phonebill.cache import get_bill_cache
+        from apps.phonebill.functions import CallBill
+
+        period = self.generator.period_label
+        sources = self.generator.source_calls()[:self.bills]
+
+        def calculate():
+            for source_call in sources:
+                CallBill(source_call, period).calculate_bill()
+
+        def create():
+            for source_call in sources:
+                response = client.post('/phonebill/', format='json',
+                                       data={'source_call': source_call, 'period': period})
+                if response.status_code != 201:
+                    raise RuntimeError("Bill creation failed ({}): {}".format(
+                        response.status_code, response.data))
+
+        get_bill_cache().clear()
+        self.measure('CallBill.calculate_bill', 'bills', len(sources), calculate)
+        get_bill_cache().clear()
+        self.measure('PhoneBillViewSet.create', 'bills', len(sources), create)
+
+    def run(self):
+        """Run all the benchmarks on a new test database, dropped at the end"""
+        from django.contrib.auth.models import Permission, User
+        from django.test.utils import (setup_databases, setup_test_environment,
+                                       teardown_databases, teardown_test_environment)
+        from rest_framework.test import APIClient
+
+        self.run_tariff()
+
+        setup_test_environment(debug=False)
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            user = User.objects.create_user('benchmark')
+            user.user_permissions.add(Permission.objects.get(codename='add_registercall'))
+            client = APIClient()
+            client.force_authenticate(user)
+
+            self.run_ingestion(client)
+            self.run_bills(client)
+        finally:
+            teardown_databases(databases, verbosity=0)
+            teardown_test_environment()
+        return self.results
+
+
+def compare(results, baseline, tolerance):
+    """The benchmarks slower than their baseline rate by more than the tolerance
+
+    Args:
+        **results (dict):** The results of the suite
+
+        **baseline (dict):** The stored results of a previous run
+
+        **tolerance (float):** Accepted slowdown, e.g. 0.2 for 20%
+
+    Return:
+        **list:** (name, rate, baseline rate) of each regression
+    """
+    regressions = []
+    for name, result in sorted(baseline['results'].items()):
+        current = results['results'].get(name)
+        if current is None or current['rate'] < result['rate'] * (1 - tolerance):
+            regressions.append((name, current and current['rate'], result['rate']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    cdr.add_arguments(parser)
+    parser.set_defaults(subscribers=None, calls=None)
+    parser.add_argument('--batch', type=int, default=1000, help="Records per ingestion request")
+    parser.add_argument('--bills', type=int, default=100, help="Bills calculated and created")
+    parser.add_argument('--output', help="JSON results file (default: bench-<scale>.json)")
+    parser.add_argument('--baseline', help="Baseline file (default: benchmarks/baselines/"
+                                           "<scale>.json)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store the results as the baseline instead of comparing them")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    subscribers, calls = SCALES[args.scale]
+    args.subscribers = args.subscribers or subscribers
+    args.calls = args.calls or calls
+    output = args.output or 'bench-{}.json'.format(args.scale)
+    baseline_path = args.baseline or os.path.join(BASELINES_DIR, '{}.json'.format(args.scale))
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'systemcall.settings')
+    import django
+    from django.db import connection
+    django.setup()
+
+    generator = cdr.from_arguments(args)
+    print("{} subscribers, {} calls each ({} call records), seed {}".format(
+        generator.subscribers, generator.calls_per_subscriber, 2 * generator.total_calls,
+        generator.seed))
+
+    results = {
+        'scale': args.scale,
+        'generator': {key: str(value) for key, value in vars(generator).items()},
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'date': datetime.now().isoformat(),
+        'results': Suite(generator, batch=args.batch, bills=args.bills).run(),
+    }
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print("Baseline written to {}".format(baseline_path))
+        return
+
+    if not os.path.exists(baseline_path):
+        print("No baseline at {}, nothing to compare (see --save-baseline)".format(baseline_path))
+        return
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['generator'] != results['generator']:
+        sys.exit("The baseline {} was made with other calls: {}".format(
+            baseline_path, baseline['generator']))
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, rate, baseline_rate in regressions:
+        print("REGRESSION {}: {} per second, baseline {}".format(name, rate, baseline_rate),
+              file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+    print("No regression over {} (tolerance {:.0%})".format(baseline_path, args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
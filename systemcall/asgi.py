@@ -0,0 +1,16 @@
+"""
+ASGI config for systemcall project.
+
+Serves the asynchronous ingestion of the call records (apps/registercall/ingest.py),
+the other requests go to the WSGI application::
+
+    uvicorn systemcall.asgi:application
+"""
+
+from asgiref.wsgi import WsgiToAsgi
+
+# Sets up Django before the ingestion application is imported
+from .wsgi import application as wsgi_application
+from apps.registercall.ingest import IngestApp
+
+application = IngestApp(fallback=WsgiToAsgi(wsgi_application))
@@ -0,0 +1,145 @@
+"""
+    Histograms of the requests and of the named timing spans, exposed in the
+    Prometheus text format at /metrics (see ``RequestMetricsMiddleware``)
+
+    The histograms live in the process: each worker exposes its own, to be
+    scraped one by one (or summed by Prometheus).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.http import HttpResponse
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """Cumulative histogram of observations, by label values
+
+    Attributes:
+        **name (str):** Metric name
+
+        **documentation (str):** Help text of the metric
+
+        **labels (tuple):** Label names
+
+        **buckets (tuple):** Upper bounds of the buckets, ascending
+    """
+
+    def __init__(self, name, documentation, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Counts of each bucket (the last is +Inf), sum and count
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get(self, *label_values):
+        """The (sum, count) of the observations of the label values"""
+        with self._lock:
+            series = self._series.get(label_values)
+            return (series[1], series[2]) if series else (0, 0)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    @staticmethod
+    def _labels(names, values):
+        return ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                         .replace('"', r'\"').replace('\n', r'\n'))
+                        for name, value in zip(names, values))
+
+    def render(self):
+        """The histogram in the Prometheus text format
+
+        Return:
+            **list:** The lines of the metric
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = sorted((values, [list(counts), total, count])
+                            for values, (counts, total, count) in self._series.items())
+        for values, (counts, total, count) in series:
+            labels = self._labels(self.labels, values)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, ','.join(filter(None, (labels, 'le="{}"'.format(bound)))),
+                    cumulative
+                ))
+            suffix = '{{{}}}'.format(labels) if labels else ''
+            lines.append('{}_sum{} {}'.format(self.name, suffix, repr(float(total))))
+            lines.append('{}_count{} {}'.format(self.name, suffix, count))
+        return lines
+
+
+REQUEST_SECONDS = Histogram('systemcall_request_seconds', "Wall time of the requests",
+                            ('view', 'method', 'status'))
+REQUEST_DB_QUERIES = Histogram('systemcall_request_db_queries', "Database queries per request",
+                               ('view',), QUERIES_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('systemcall_request_db_seconds',
+                               "Time spent in the database per request", ('view',))
+RESPONSE_BYTES = Histogram('systemcall_response_bytes', "Size of the response bodies",
+                           ('view',), BYTES_BUCKETS)
+SPAN_SECONDS = Histogram('systemcall_span_seconds', "Wall time of the named timing spans",
+                         ('span',))
+
+HISTOGRAMS = (REQUEST_SECONDS, REQUEST_DB_QUERIES, REQUEST_DB_SECONDS, RESPONSE_BYTES,
+              SPAN_SECONDS)
+
+# The spans of the request being served by the thread, for the slow request log
+_request = threading.local()
+
+
+def start_request():
+    _request.spans = []
+
+
+def finish_request():
+    """The (name, seconds) spans timed during the request, in order"""
+    spans = getattr(_request, 'spans', None) or []
+    _request.spans = None
+    return spans
+
+
+@contextmanager
+def span(name):
+    """Time a named stage of the work, e.g. ``with span('bill.query'):``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.observe(elapsed, name)
+        spans = getattr(_request, 'spans', None)
+        if spans is not None:
+            spans.append((name, elapsed))
+
+
+def render():
+    """All the metrics in the Prometheus text format"""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,163 @@
+"""
+    Per request instrumentation: wall time, database queries and time, and
+    response size of each view, kept in the histograms of ``systemcall.metrics``.
+    The requests slower than ``METRICS['SLOW_REQUEST_MS']`` are logged with their SQL.
+
+    Pinning of the clients that wrote to the default database (see ``systemcall.routers``).
+"""
+import hashlib
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from . import metrics, routers
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """Database execute wrapper counting the queries and their time
+
+    Attributes:
+        **max_statements (int):** The SQL kept of the first statements, for the slow log
+    """
+
+    def __init__(self, max_statements=50):
+        self.max_statements = max_statements
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if len(self.statements) < self.max_statements:
+                self.statements.append((context['connection'].alias, sql, elapsed))
+
+
+class RequestMetricsMiddleware:
+    """Class responsible for measuring each request by view
+
+    The view is labeled with its URL name (e.g. ``PhoneBill-list``), the
+    requests that do not resolve to a view are labeled ``unresolved``. The
+    queries of a streamed body run after the view returns, they are not counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = getattr(settings, 'METRICS', {})
+        self.slow_request_ms = options.get('SLOW_REQUEST_MS', 500)
+        self.max_statements = options.get('SLOW_REQUEST_STATEMENTS', 50)
+
+    @staticmethod
+    def _view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.view_name or match._func_path
+
+    def __call__(self, request):
+        recorder = QueryRecorder(self.max_statements)
+        metrics.start_request()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+        spans = metrics.finish_request()
+
+        view = self._view_name(request)
+        metrics.REQUEST_SECONDS.observe(elapsed, view, request.method, str(response.status_code))
+        metrics.REQUEST_DB_QUERIES.observe(recorder.count, view)
+        metrics.REQUEST_DB_SECONDS.observe(recorder.seconds, view)
+        if response.streaming:
+            response.streaming_content = self._count_bytes(response.streaming_content, view)
+        else:
+            metrics.RESPONSE_BYTES.observe(len(response.content), view)
+
+        if elapsed * 1000 >= self.slow_request_ms:
+            self._log_slow(request, view, elapsed, recorder, spans)
+        return response
+
+    @staticmethod
+    def _count_bytes(content, view):
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            metrics.RESPONSE_BYTES.observe(size, view)
+
+    @staticmethod
+    def _log_slow(request, view, elapsed, recorder, spans):
+        lines = ["Slow request {} {} ({}): {:.1f} ms, {} queries in {:.1f} ms".format(
+            request.method, request.get_full_path(), view, elapsed * 1000, recorder.count,
+            recorder.seconds * 1000
+        )]
+        lines.extend("  span {}: {:.1f} ms".format(name, seconds * 1000)
+                     for name, seconds in spans)
+        lines.extend("  [{}] {:.1f} ms: {}".format(alias, seconds * 1000, sql)
+                     for alias, sql, seconds in recorder.statements)
+        if recorder.count > len(recorder.statements):
+            lines.append("  ... {} more queries".format(recorder.count - len(recorder.statements)))
+        logger.warning('\n'.join(lines))
+
+
+class ReplicaPinningMiddleware:
+    """Class responsible for reading the writes of a client back from the default
+    database, until the replicas have them
+
+    A request that writes pins its client for ``DATABASE_REPLICAS['PINNING_SECONDS']``:
+    by a cookie, and by its credentials (the Authorization header or the session
+    cookie) in the ``DATABASE_REPLICAS['PIN_CACHE']`` cache, for the API clients
+    that do not keep the cookies. The pinned clients do not read from the replicas.
+    """
+
+    cookie_name = 'replica_pin'
+    key_prefix = 'replica_pin:'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = getattr(settings, 'DATABASE_REPLICAS', {})
+        self.replicas = options.get('ALIASES', ())
+        self.pinning_seconds = options.get('PINNING_SECONDS', 5)
+        self.cache_alias = options.get('PIN_CACHE', 'default')
+
+    def _client_key(self, request):
+        """The cache key of the credentials of the client, None if it has none"""
+        credentials = (request.META.get('HTTP_AUTHORIZATION')
+                       or request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+        if not credentials:
+            return None
+        return self.key_prefix + hashlib.sha256(credentials.encode('utf-8')).hexdigest()
+
+    def __call__(self, request):
+        if not self.replicas:
+            return self.get_response(request)
+
+        key = self._client_key(request)
+        pinned = self.cookie_name in request.COOKIES or (
+            key is not None and bool(caches[self.cache_alias].get(key))
+        )
+        routers.start_request(pinned=pinned)
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = routers.start_request()
+        if wrote:
+            response.set_cookie(self.cookie_name, '1', max_age=self.pinning_seconds,
+                                httponly=True)
+            if key is not None:
+                caches[self.cache_alias].set(key, True, self.pinning_seconds)
+        return response
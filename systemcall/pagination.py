@@ -0,0 +1,46 @@
+"""
+    Pagination of the list endpoints: keyset (cursor) pages by default, and a
+    streaming NDJSON export of the whole list with ``?stream=ndjson``
+"""
+
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination, the pages are read with an index range scan instead of an OFFSET"""
+
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class NDJSONStreamMixin:
+    """Streams the whole list as NDJSON (one object per line) with ``?stream=ndjson``
+
+    The queryset is read in chunks with a server-side cursor and each row is written
+    as soon as it is serialized, so the memory does not grow with the list.
+    """
+
+    stream_query_param = 'stream'
+    stream_chunk_size = 2000
+
+    def _stream_rows(self, queryset):
+        encoder = JSONEncoder()
+        for row in queryset.iterator(chunk_size=self.stream_chunk_size):
+            yield encoder.encode(self.get_serializer(row).data) + '\n'
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_query_param) != 'ndjson':
+            return super(NDJSONStreamMixin, self).list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        ordering = getattr(self.pagination_class, 'ordering', None)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        # The rows are read after the view returns: keep the database chosen for the view
+        queryset = queryset.using(queryset.db)
+
+        return StreamingHttpResponse(self._stream_rows(queryset),
+                                     content_type='application/x-ndjson')
@@ -0,0 +1,108 @@
+"""
+    Routing of the read-only traffic to the read replicas of the default database
+
+    Only the reads inside a ``use_replica()`` block go to a replica: the read-only
+    list and retrieve reads, which tolerate the replication lag. What is written
+    or cached, like the bills computed by ``POST /phonebill/``, is read from the
+    default database. The replicas are used in turn, one for all the reads of a
+    block. Everything else, and all the writes, go to the default database.
+
+    Read your writes: a thread that writes is pinned to the default database, for
+    the rest of the request, and the client for the next
+    ``DATABASE_REPLICAS['PINNING_SECONDS']`` by a cookie and by its credentials
+    (see ``ReplicaPinningMiddleware``). A thread outside of a request stays pinned.
+"""
+import threading
+from contextlib import contextmanager
+from itertools import cycle
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_state = threading.local()
+
+
+def start_request(pinned=False):
+    """Reset the state of the thread for a new request
+
+    Return:
+        **bool:** True if the thread wrote to the default database since the last reset
+    """
+    wrote = getattr(_state, 'wrote', False)
+    _state.pinned = pinned
+    _state.wrote = False
+    _state.replica = None
+    _state.depth = 0
+    return wrote
+
+
+def pin():
+    """Send the reads of the thread to the default database, after a write"""
+    _state.pinned = True
+    _state.wrote = True
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+@contextmanager
+def use_replica():
+    """Send the reads of the block to a replica, unless the thread is pinned or
+    in a transaction of the default database
+
+    Also a decorator: ``@use_replica()``
+    """
+    depth = getattr(_state, 'depth', 0)
+    _state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _state.depth = depth
+        if not depth:
+            _state.replica = None
+
+
+class ReplicaRouter:
+    """Class responsible for choosing the database of the queries
+
+    Attributes:
+        **replicas (list):** The aliases of the replicas, ``DATABASE_REPLICAS['ALIASES']``
+    """
+
+    def __init__(self):
+        self.replicas = list(getattr(settings, 'DATABASE_REPLICAS', {}).get('ALIASES', ()))
+        self._replicas = cycle(self.replicas)
+        self._lock = threading.Lock()
+
+    def _next_replica(self):
+        with self._lock:
+            return next(self._replicas)
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not getattr(_state, 'depth', 0) or is_pinned():
+            return None
+        # The related objects are read from the database of the instance
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+
+        if getattr(_state, 'replica', None) is None:
+            _state.replica = self._next_replica()
+        return _state.replica
+
+    def db_for_write(self, model, **hints):
+        pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self.replicas}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas are migrated by the replication
+        return False if db in self.replicas else None
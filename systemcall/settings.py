@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'systemcall.middleware.RequestMetricsMiddleware',
+    'systemcall.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -99,6 +101,88 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database (see systemcall/routers.py), e.g.
+# DB_REPLICA_HOSTS=replica1.local,replica2.local:5433. The bill list and retrieve
+# reads go to them in turn, except for the clients that wrote in the last
+# PINNING_SECONDS. The clients are pinned by their credentials in the PIN_CACHE
+# alias of CACHES, which must be shared by the processes (not the local memory one)
+
+DATABASE_REPLICAS = {
+    'ALIASES': [],
+    'PINNING_SECONDS': config('DB_REPLICA_PINNING_SECONDS', default=5, cast=int),
+    'PIN_CACHE': config('DB_REPLICA_PIN_CACHE', default='default'),
+}
+replica_hosts = config('DB_REPLICA_HOSTS', default='').split(',')
+for index, replica_host in enumerate(filter(None, replica_hosts)):
+    replica_host, _, replica_port = replica_host.strip().partition(':')
+    replica = 'replica{}'.format(index + 1)
+    DATABASES[replica] = dict(DATABASES['default'], HOST=replica_host,
+                              PORT=replica_port or DATABASES['default']['PORT'],
+                              TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS['ALIASES'].append(replica)
+
+DATABASE_ROUTERS = ['systemcall.routers.ReplicaRouter']
+
+# Cache of the computed bills (see apps/phonebill/cache.py). The in-process cache
+# is not invalidated by the other processes, so it keeps the bills TIMEOUT seconds.
+# For a cache shared by the processes set BILL_CACHE_BACKEND to
+# 'apps.phonebill.cache.DjangoBillCache' and BILL_CACHE_ALIAS to a shared cache
+# (e.g. database or memcached based) of CACHES
+
+BILL_CACHE = {
+    'BACKEND': config('BILL_CACHE_BACKEND', default='apps.phonebill.cache.LocMemBillCache'),
+    'OPTIONS': {
+        'max_entries': config('BILL_CACHE_MAX_ENTRIES', default=1024, cast=int),
+        'timeout': config('BILL_CACHE_TIMEOUT', default=60, cast=int),
+        'alias': config('BILL_CACHE_ALIAS', default='default'),
+    },
+}
+
+# Columnar archive of the closed months (see apps/phonebill/archive.py), written by
+# the archive_month command. The bills of the archived months are read from it.
+# The directory must be shared by all the processes and persistent, e.g. a mounted
+# volume: not the ephemeral disk of a Heroku dyno
+
+BILL_ARCHIVE = {
+    'DIR': config('BILL_ARCHIVE_DIR', default=None),
+}
+
+# Tariff plans compiled in memory (see apps/phonebill/plans.py). A change made by
+# another process is seen within CHECK_INTERVAL seconds
+
+TARIFF_PLANS = {
+    'CHECK_INTERVAL': config('TARIFF_PLANS_CHECK_INTERVAL', default=60, cast=int),
+}
+
+# Cache of the open calls, to validate the call end records without a query
+# (see apps/registercall/cache.py). Only for deployments where one process
+# writes the call records
+
+OPEN_CALL_CACHE = {
+    'max_entries': config('OPEN_CALL_CACHE_MAX_ENTRIES', default=0, cast=int),
+}
+
+# Instrumentation of the requests (see systemcall/middleware.py), exposed at /metrics.
+# The requests slower than SLOW_REQUEST_MS are logged with their first SQL statements
+
+METRICS = {
+    'SLOW_REQUEST_MS': config('SLOW_REQUEST_MS', default=500, cast=int),
+    'SLOW_REQUEST_STATEMENTS': config('SLOW_REQUEST_STATEMENTS', default=50, cast=int),
+}
+
+# Asynchronous ingestion of the call records, served by systemcall.asgi
+# (see apps/registercall/ingest.py). The journal, a directory of each process, is
+# required: without it the records accepted and not written yet are lost if the
+# process dies, which INGEST_ALLOW_NO_JOURNAL accepts (e.g. for development)
+
+INGEST = {
+    'QUEUE_SIZE': config('INGEST_QUEUE_SIZE', default=100000, cast=int),
+    'BATCH_SIZE': config('INGEST_BATCH_SIZE', default=5000, cast=int),
+    'FLUSH_INTERVAL_MS': config('INGEST_FLUSH_INTERVAL_MS', default=50, cast=int),
+    'JOURNAL': config('INGEST_JOURNAL', default=None),
+    'ALLOW_NO_JOURNAL': config('INGEST_ALLOW_NO_JOURNAL', default=False, cast=bool),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -24,6 +24,7 @@ from rest_framework.authtoken.views import obtain_auth_token
 from apps.registercall.views import RegisterCallViewSet
 from apps.phonebill.views import PhoneBillViewSet
 from apps.phonebill.views import RegisterViewSet
+from systemcall.metrics import metrics_view
 
 schema_view = get_swagger_view(title='System Call')
 
@@ -36,5 +37,6 @@ urlpatterns = [
     url(r'^$', schema_view),
     path('', include(router.urls)),
     path('admin/', admin.site.urls),
-    path('api-token-auth/', obtain_auth_token)
+    path('api-token-auth/', obtain_auth_token),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -1,8 +1,53 @@
-from django.test import TestCase
-from rest_framework.test import APITestCase
-from apps.registercall.choices import CallTypes
-from datetime import datetime
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta
+from io import StringIO
+from random import Random
+from unittest import skipUnless
+from unittest.mock import patch
+
+from babel.numbers import format_currency
+from django.contrib.auth.models import Permission, User
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.forms.models import inlineformset_factory
+from django.http import HttpResponse
+from django.test import (RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from apps.phonebill.admin import DestinationRateFormSet
+from apps.phonebill.archive import get_archive
+from apps.phonebill.billing import BillingRun, bill_chunk, billed_subscribers
+from apps.phonebill.cache import DjangoBillCache, LocMemBillCache, get_bill_cache
+from apps.phonebill.currency import price_formatter
 from apps.phonebill.functions import CallBill
+from apps.phonebill.models import (DayTypes, DestinationRate, Holiday, PhoneBill, Registers,
+                                   RunningBill, SubscriberPlan, TariffPlan, TimeBand)
+from apps.phonebill.plans import (CompiledPlan, call_span, compile_rate, get_tariffs,
+                                  invalidate_tariffs, standard_plan)
+from apps.phonebill.serializer import PhoneBillSerializer
+from apps.phonebill.tariff import EPOCH
+from apps.registercall import partitions
+from apps.registercall.cache import OpenCallCache
+from apps.registercall.choices import CallTypes
+from apps.registercall.filters import normalize_phone
+from apps.registercall.functions import CallBatch
+from apps.registercall.ingest import IngestApp, IngestBuffer, Journal, QueueFull
+from apps.registercall.models import CompletedCall, OpenCall, RegisterCall
+from benchmarks.cdr import CDRGenerator
+from benchmarks.suite import compare
+from systemcall import metrics, routers
+from systemcall.middleware import ReplicaPinningMiddleware
 
 
 class RegisterCallTestCase(APITestCase):
@@ -215,6 +260,634 @@ class RegisterCallTestCase(APITestCase):
         )
 
 
+class CompletedCallTestCase(TestCase):
+    """Class test over the completed calls kept by the call records"""
+
+    def setUp(self):
+        super(CompletedCallTestCase, self).setUp()
+
+        self.start = RegisterCall(
+            type_call=CallTypes.START, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 21, 57, 13)),
+            source_call="99988526423", destination_call="9993468278"
+        )
+        self.start.save()
+        self.end = RegisterCall(
+            type_call=CallTypes.END, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 10, 56))
+        )
+
+    def test_complete_call(self):
+        """Test the call is priced when the call end record is saved"""
+        self.assertFalse(CompletedCall.objects.exists())
+
+        self.end.save()
+        call = CompletedCall.objects.get(id_call=78)
+        self.assertEquals(("99988526423", "9993468278", 823, 2, 54),
+                          (call.source_call, call.destination_call, call.duration_seconds,
+                           call.billable_minutes, call.price_cents))
+
+    def test_update_call(self):
+        """Test the call is priced again when the call start record changes"""
+        self.end.save()
+        self.start.timestamp_call = timezone.make_aware(datetime(2019, 1, 1, 21, 50, 13))
+        self.start.save()
+
+        self.assertEquals(117, CompletedCall.objects.get(id_call=78).price_cents)
+
+    def test_delete_call(self):
+        """Test the completed call is removed with its records"""
+        self.end.save()
+        self.end.delete()
+
+        self.assertFalse(CompletedCall.objects.exists())
+
+    def test_change_id_call(self):
+        """Test the completed call of the previous id_call is removed when it changes"""
+        RegisterCall(
+            type_call=CallTypes.START, id_call=79,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 0, 0)),
+            source_call="99988526424", destination_call="9993468278"
+        ).save()
+        self.end.save()
+        self.end.id_call = 79
+        self.end.save()
+
+        self.assertEquals([79], list(CompletedCall.objects.values_list('id_call', flat=True)))
+        self.assertEquals(0, RunningBill.objects.get(source_call='99988526423').calls)
+        self.assertTrue(OpenCall.objects.filter(id_call=78).exists())
+
+    def test_delete_queryset(self):
+        """Test a queryset delete removes the completed calls and opens the calls again"""
+        self.end.save()
+        RegisterCall.objects.filter(type_call=CallTypes.END).delete()
+
+        self.assertFalse(CompletedCall.objects.exists())
+        self.assertEquals(0, RunningBill.objects.get(source_call='99988526423').calls)
+        self.assertTrue(OpenCall.objects.filter(id_call=78).exists())
+
+
+class OpenCallTestCase(TestCase):
+    """Class test over the open calls validating the call end records"""
+
+    def setUp(self):
+        super(OpenCallTestCase, self).setUp()
+
+        self.start = RegisterCall(
+            type_call=CallTypes.START, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 21, 57, 13)),
+            source_call="99988526423", destination_call="9993468278"
+        )
+        self.start.save()
+        self.end = RegisterCall(
+            type_call=CallTypes.END, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 10, 56))
+        )
+
+    def assertEndError(self, message, end):
+        with self.assertRaises(ValidationError) as context:
+            end.full_clean(validate_unique=False)
+        self.assertIn(message, str(context.exception))
+
+    def test_open_close_call(self):
+        """Test the call is open by its start record and closed by its end record"""
+        open_call = OpenCall.objects.get(id_call=78)
+        self.assertEquals(("99988526423", "9993468278", self.start.timestamp_call),
+                          (open_call.source_call, open_call.destination_call,
+                           open_call.start_call))
+
+        self.end.save()
+        self.assertFalse(OpenCall.objects.exists())
+
+        self.end.delete()
+        self.assertTrue(OpenCall.objects.filter(id_call=78).exists())
+
+    def test_clean_end(self):
+        """Test the call end record is validated with one primary key lookup"""
+        with self.assertNumQueries(1):
+            self.end.full_clean(validate_unique=False)
+
+    def test_clean_end_cached(self):
+        """Test the call end record is validated without queries from the cache"""
+        # The test transaction is never committed
+        with patch('apps.registercall.models.get_open_call_cache',
+                   return_value=OpenCallCache(max_entries=10)), \
+                patch('apps.registercall.cache.transaction.on_commit',
+                      side_effect=lambda func: func()):
+            self.end.full_clean(validate_unique=False)
+            with self.assertNumQueries(0):
+                self.end.full_clean(validate_unique=False)
+
+    def test_end_errors(self):
+        """Test the call end records of ended, not started or too early calls"""
+        self.end.save()
+        self.assertEndError("Already exists a type END", RegisterCall(
+            type_call=CallTypes.END, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 11, 56))
+        ))
+        self.assertEndError("Does not exist a call start entry", RegisterCall(
+            type_call=CallTypes.END, id_call=79,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 11, 56))
+        ))
+
+        self.end.delete()
+        self.end.timestamp_call = timezone.make_aware(datetime(2019, 1, 1, 21, 50, 13))
+        self.assertEndError("timestamp", self.end)
+
+    def test_complete_calls(self):
+        """Test the calls of records loaded without the API are opened by complete_calls"""
+        OpenCall.objects.all().delete()
+        call_command('complete_calls', stdout=StringIO())
+
+        self.assertEquals([78], list(OpenCall.objects.values_list('id_call', flat=True)))
+
+
+class ListPaginationTestCase(APITestCase):
+    """Class test over the pagination and streaming of the lists"""
+
+    fixtures = ['call.json']
+
+    def setUp(self):
+        super(ListPaginationTestCase, self).setUp()
+        self.client.force_authenticate(User.objects.create_user('agent'))
+
+    def test_cursor_pages(self):
+        """Test the list is paginated by cursor, ordered by timestamp
+
+        Should return 200 OK and pages linked by the next cursor
+        """
+        timestamps = []
+        response = self.client.get('/registercall/', {'page_size': 4})
+        while True:
+            self.assertEquals(200, response.status_code)
+            page = response.json()
+            timestamps.extend(call['timestamp_call'] for call in page['results'])
+            if not page['next']:
+                break
+            response = self.client.get(page['next'])
+
+        self.assertEquals(RegisterCall.objects.count(), len(timestamps))
+        self.assertEquals(sorted(timestamps), timestamps)
+
+    def test_stream_ndjson(self):
+        """Test the whole list is streamed as NDJSON
+
+        Should return 200 OK and one call per line
+        """
+        response = self.client.get('/registercall/', {'stream': 'ndjson',
+                                                      'source_call': '99988526423'})
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('application/x-ndjson', response['Content-Type'])
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        calls = [json.loads(line) for line in lines]
+        self.assertEquals(RegisterCall.objects.filter(source_call='99988526423').count(),
+                          len(calls))
+        self.assertEquals(sorted(call['timestamp_call'] for call in calls),
+                          [call['timestamp_call'] for call in calls])
+
+
+class PhoneSearchTestCase(APITestCase):
+    """Class test over the phone number search of the call records"""
+
+    def setUp(self):
+        super(PhoneSearchTestCase, self).setUp()
+        numbers = [('99988526423', '6299990774'), ('62999907744', '99988526400'),
+                   ('1133334444', '99988526423')]
+        RegisterCall.objects.bulk_create([
+            RegisterCall(type_call=CallTypes.START, id_call=index + 1,
+                         timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 10, index)),
+                         source_call=source, destination_call=destination)
+            for index, (source, destination) in enumerate(numbers)
+        ])
+        self.client.force_authenticate(User.objects.create_user('agent'))
+
+    def search(self, search, match=None):
+        data = {'search': search}
+        if match:
+            data['match'] = match
+        response = self.client.get('/registercall/', data)
+        self.assertEquals(200, response.status_code)
+        return sorted(call['id_call'] for call in response.json()['results'])
+
+    def test_search(self):
+        """Test the exact, prefix and substring searches of the digits of the numbers
+
+        Should return 200 OK
+        """
+        self.assertEquals([1, 3], self.search('(99) 98852-6423', 'exact'))
+        self.assertEquals([1, 2, 3], self.search('99988526'))
+        self.assertEquals([1, 2], self.search('62 9999', 'prefix'))
+        self.assertEquals([1, 2], self.search('999-0774', 'contains'))
+        self.assertEquals([3], self.search('3333', 'contains'))
+        self.assertEquals([], self.search('phone'))
+        self.assertEquals(3, len(self.client.get('/registercall/', {'search': ' '})
+                                 .json()['results']))
+
+    def test_search_invalid(self):
+        """Test the search refuses an unknown match and a substring too short for the index
+
+        Should return 400 Bad Request
+        """
+        response = self.client.get('/registercall/', {'search': '999', 'match': 'regex'})
+        self.assertEquals(400, response.status_code)
+        response = self.client.get('/registercall/', {'search': '99', 'match': 'contains'})
+        self.assertEquals(400, response.status_code)
+
+    def test_normalize_phone(self):
+        """Test the digits of a number are kept, in order"""
+        self.assertEquals('99988526423', normalize_phone('+(99) 98852-6423'))
+        self.assertEquals('', normalize_phone(None))
+
+
+class RegisterCallBatchTestCase(APITestCase):
+    """Class test over the batch creation of calls"""
+
+    fixtures = ['call.json']
+
+    def setUp(self):
+        super(RegisterCallBatchTestCase, self).setUp()
+        # The tariff plans are compiled once per process, not by the counted requests
+        get_tariffs()
+
+        user = User.objects.create_user('switch')
+        user.user_permissions.add(Permission.objects.get(codename='add_registercall'))
+        self.client.force_authenticate(user)
+
+        self.records = [
+            {"id_call": 80, "type_call": 2, "timestamp_call": "2018-07-07 15:14:56"},
+            {"id_call": 80, "type_call": 1, "timestamp_call": "2018-07-07 15:07:13",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 70, "type_call": 2, "timestamp_call": "2016-02-28 14:00:00"},
+            {"id_call": 77, "type_call": 2, "timestamp_call": "2018-03-02 22:10:56"},
+            {"id_call": 81, "type_call": 2, "timestamp_call": "2018-07-08 10:00:00"},
+            {"id_call": 82, "type_call": 1, "timestamp_call": "2018-07-08 11:00:00"},
+            {"id_call": 83, "type_call": 1, "timestamp_call": "2018-07-08 12:00:00",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 83, "type_call": 2, "timestamp_call": "2018-07-08 12:01:00"},
+        ]
+
+    def assertBatchResult(self, response):
+        self.assertEquals(201, response.status_code)
+        result = response.json()
+        self.assertEquals(4, result['created'])
+        self.assertEquals(
+            {2: ['timestamp_call'], 3: ['id_call'], 4: ['id_call'],
+             5: ['destination_call', 'source_call']},
+            {error['index']: sorted(error['errors']) for error in result['errors']}
+        )
+        self.assertEquals(4, RegisterCall.objects.filter(id_call__in=(80, 83)).count())
+        self.assertEquals([(80, 99), (83, 36)], list(
+            CompletedCall.objects.order_by('id_call').values_list('id_call', 'price_cents')
+        ))
+
+    def test_create_batch(self):
+        """Test the API for create a batch of calls sent as a JSON array
+
+        Should return 201 CREATED and the errors of each invalid record
+        """
+        with self.assertNumQueries(10):
+            response = self.client.post('/registercall/batch/', format='json',
+                                        data=self.records)
+        self.assertBatchResult(response)
+
+    def test_create_ndjson_batch(self):
+        """Test the API for create a batch of calls sent as NDJSON
+
+        Should return 201 CREATED and the errors of each invalid record
+        """
+        body = '\n'.join(json.dumps(record) for record in self.records)
+        response = self.client.post('/registercall/batch/', data=body,
+                                    content_type='application/x-ndjson')
+        self.assertBatchResult(response)
+
+    def test_invalid_batch(self):
+        """Test the API for create a batch of calls without a list
+
+        Should return 400 BAD REQUEST
+        """
+        response = self.client.post('/registercall/batch/', format='json',
+                                    data=self.records[0])
+        self.assertEquals(400, response.status_code)
+
+
+class IngestTestCase(TransactionTestCase):
+    """Class test over the asynchronous ingestion of calls"""
+
+    fixtures = ['call.json']
+
+    def setUp(self):
+        super(IngestTestCase, self).setUp()
+
+        user = User.objects.create_user('switch')
+        user.user_permissions.add(Permission.objects.get(codename='add_registercall'))
+        self.token = Token.objects.create(user=user).key
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        self.records = [
+            {"id_call": 80, "type_call": 1, "timestamp_call": "2018-07-07 15:07:13",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 80, "type_call": 2, "timestamp_call": "2018-07-07 15:14:56"},
+            {"id_call": 81, "type_call": 2, "timestamp_call": "2018-07-08 10:00:00"},
+        ]
+
+    def post(self, app, records, token=None):
+        """Send the records as NDJSON to the ASGI application
+
+        Return:
+            **tuple:** (status, response data)
+        """
+        messages = []
+        body = '\n'.join(json.dumps(record) for record in records).encode()
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        headers = [(b'content-type', b'application/x-ndjson')]
+        if token:
+            headers.append((b'authorization', 'Token {}'.format(token).encode()))
+        self.loop.run_until_complete(app({'type': 'http', 'method': 'POST', 'headers': headers,
+                                          'path': '/registercall/ingest/'}, receive, send))
+        return messages[0]['status'], json.loads(messages[1]['body'].decode())
+
+    def test_ingest(self):
+        """Test the records are acknowledged and then written in batches
+
+        Should return 202 ACCEPTED
+        """
+        app = IngestApp(buffer=IngestBuffer(batch_size=2, flush_interval=0.01))
+        self.assertEquals((401, {'detail': "Authentication credentials were not provided."}),
+                          self.post(app, self.records))
+        self.assertEquals((202, {'accepted': 3}), self.post(app, self.records, self.token))
+        self.loop.run_until_complete(app.buffer.stop())
+
+        self.assertEquals(2, RegisterCall.objects.filter(id_call=80).count())
+        self.assertEquals(99, CompletedCall.objects.get(id_call=80).price_cents)
+        self.assertEquals({'queued': 0, 'replaying': False, 'queue_size': 100000, 'accepted': 3,
+                           'created': 2, 'rejected': 1, 'batches': 2}, app.buffer.stats())
+
+    def test_full_queue(self):
+        """Test the records are refused when the queue is full
+
+        Should return 429 TOO MANY REQUESTS
+        """
+        app = IngestApp(buffer=IngestBuffer(queue_size=2))
+        status, _ = self.post(app, self.records, self.token)
+        self.assertEquals(429, status)
+        self.loop.run_until_complete(app.buffer.stop())
+        self.assertFalse(RegisterCall.objects.filter(id_call=80).exists())
+
+    def test_journal_replay(self):
+        """Test the records left in the journal by a crash are written on start up"""
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, '000000000001.ndjson'), 'w') as journal:
+                journal.write(''.join(json.dumps(record) + '\n' for record in self.records))
+                journal.write('{"id_call": 82, "type_')
+
+            buffer = IngestBuffer(journal=Journal(directory))
+
+            async def restart():
+                buffer.start()
+                await buffer.stop()
+
+            self.loop.run_until_complete(restart())
+
+            self.assertEquals(['000000000002.ndjson'], os.listdir(directory))
+        self.assertEquals(2, RegisterCall.objects.filter(id_call=80).count())
+
+    def test_journal_replay_bounded(self):
+        """Test the records left in the journal are queued within the size of the queue,
+        and the new records are refused meanwhile
+        """
+        records = [record for id_call in range(90, 95) for record in (
+            {"id_call": id_call, "type_call": 1,
+             "timestamp_call": "2018-07-07 15:{}:13".format(id_call - 80),
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": id_call, "type_call": 2,
+             "timestamp_call": "2018-07-07 16:{}:56".format(id_call - 80)},
+        )]
+        queued = []
+
+        class Buffer(IngestBuffer):
+            def _enqueue(self, records):
+                super(Buffer, self)._enqueue(records)
+                queued.append(len(self._records))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, '000000000001.ndjson'), 'w') as journal:
+                journal.write(''.join(json.dumps(record) + '\n' for record in records))
+
+            buffer = Buffer(queue_size=4, batch_size=2, flush_interval=0.01,
+                            journal=Journal(directory))
+
+            async def restart():
+                buffer.start()
+                with self.assertRaises(QueueFull):
+                    await buffer.put(self.records)
+                await buffer.stop()
+
+            self.loop.run_until_complete(restart())
+
+        self.assertLessEqual(max(queued), 4)
+        self.assertEquals(10, RegisterCall.objects.filter(id_call__gte=90).count())
+
+    def test_journal_rotation_error(self):
+        """Test a segment that can not be opened refuses its records, and the journal
+        keeps writing to the current segment
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory, segment_size=1)
+            self.assertEquals(1, self.loop.run_until_complete(journal.append(self.records[:1])))
+            with patch('apps.registercall.ingest.open', side_effect=OSError, create=True):
+                with self.assertRaises(OSError):
+                    self.loop.run_until_complete(journal.append(self.records[1:2]))
+            self.assertEquals(2, self.loop.run_until_complete(journal.append(self.records[1:2])))
+            journal.close()
+
+            self.assertEquals(['000000000001.ndjson', '000000000002.ndjson'],
+                              sorted(os.listdir(directory)))
+            with open(os.path.join(directory, '000000000002.ndjson')) as segment:
+                self.assertEquals([self.records[1]], [json.loads(line) for line in segment])
+
+    def test_token_cache(self):
+        """Test the checked tokens are bounded and the unknown keys are checked again soon"""
+        app = IngestApp(buffer=IngestBuffer(batch_size=2, flush_interval=0.01))
+        app.max_tokens = 2
+        for key in ('bogus1', 'bogus2', 'bogus3'):
+            self.assertEquals(401, self.post(app, [], key)[0])
+        self.assertEquals(['bogus2', 'bogus3'], list(app._tokens))
+
+        self.post(app, self.records, self.token)
+        self.assertEquals(['bogus3', self.token], list(app._tokens))
+        self.assertLess(app._tokens['bogus3'][1], app._tokens[self.token][1])
+        self.loop.run_until_complete(app.buffer.stop())
+
+    def test_journal_required(self):
+        """Test the ingestion refuses to start without a journal, unless allowed"""
+        with self.settings(INGEST={'JOURNAL': None}):
+            with self.assertRaises(ImproperlyConfigured):
+                IngestBuffer.from_settings()
+        with self.settings(INGEST={'JOURNAL': None, 'ALLOW_NO_JOURNAL': True}):
+            self.assertIsNone(IngestBuffer.from_settings().journal)
+
+
+class CDRGeneratorTestCase(TestCase):
+    """Class test over the synthetic call records of the benchmarks"""
+
+    def setUp(self):
+        super(CDRGeneratorTestCase, self).setUp()
+
+        self.generator = CDRGenerator(subscribers=10, calls_per_subscriber=50,
+                                      midnight_ratio=0.5, seed=7)
+
+    def test_reproducible(self):
+        """Test the same seed makes the same calls, with unique timestamps"""
+        calls = list(self.generator.calls())
+        self.assertEquals(calls, list(self.generator.calls()))
+        self.assertEquals(500, len({start for _, _, _, start, _ in calls}))
+        self.assertEquals(500, len({end for _, _, _, _, end in calls}))
+        self.assertTrue(all(start < end for _, _, _, start, end in calls))
+
+        crossing = sum(start.date() != end.date() for _, _, _, start, end in calls)
+        self.assertTrue(0.45 < crossing / len(calls) < 0.6)
+
+    def test_records_accepted(self):
+        """Test all the generated call records are valid and completed"""
+        result = CallBatch(list(self.generator.records())).save()
+
+        self.assertEquals((1000, []), (result['created'], result['errors']))
+        self.assertEquals(500, CompletedCall.objects.count())
+
+    def test_compare(self):
+        """Test the regressions are the benchmarks slower than the baseline tolerance"""
+        baseline = {'results': {'price': {'rate': 100.0}, 'bill': {'rate': 10.0},
+                                'gone': {'rate': 1.0}}}
+        results = {'results': {'price': {'rate': 80.0}, 'bill': {'rate': 7.0}}}
+
+        self.assertEquals([('bill', 7.0, 10.0), ('gone', None, 1.0)],
+                          compare(results, baseline, 0.25))
+
+
+@skipUnless(connection.vendor == 'postgresql', "COPY requires PostgreSQL")
+class ImportCDRsTestCase(TestCase):
+    """Class test over the import_cdrs command"""
+
+    fixtures = ['call.json']
+
+    def test_import_ndjson(self):
+        """Test the import of valid, duplicated and invalid records"""
+        records = [
+            {"id_call": 90, "type_call": 1, "timestamp_call": "2018-07-07 15:07:13",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 90, "type_call": 2, "timestamp_call": "2018-07-07 15:14:56"},
+            {"id_call": 90, "type_call": 2, "timestamp_call": "2018-07-07 15:15:56"},
+            {"id_call": 91, "type_call": 2, "timestamp_call": "2018-07-07 16:00:00"},
+            {"id_call": 77, "type_call": 2, "timestamp_call": "2018-03-02 22:10:56"},
+            {"id_call": 92, "type_call": 1, "timestamp_call": "2018-99-99 00:00:00",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 93, "type_call": 1, "timestamp_call": "2018-02-30 10:00:00",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 2147483647, "type_call": 1, "timestamp_call": "2018-07-08T10:00:00Z",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+            {"id_call": 2147483648, "type_call": 1, "timestamp_call": "2018-07-08 11:00:00",
+             "source_call": "99988526423", "destination_call": "9993468278"},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as handle:
+            handle.write('\n'.join(json.dumps(record) for record in records))
+            handle.write('\nnot json\n')
+        self.addCleanup(os.remove, handle.name)
+
+        output = StringIO()
+        call_command('import_cdrs', handle.name, stdout=output)
+
+        self.assertIn('10 rows read, 2 starts and 1 ends imported, 7 rejected', output.getvalue())
+        self.assertEquals(2, RegisterCall.objects.filter(id_call=90).count())
+        self.assertTrue(RegisterCall.objects.filter(id_call=2147483647).exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "The partitions require PostgreSQL")
+class PartitionTestCase(TestCase):
+    """Class test over the monthly partitions of the call records"""
+
+    fixtures = ['call.json']
+
+    def test_month_partition(self):
+        """Test the records of a month are moved to its partition and read from it only"""
+        month = date(2017, 12, 1)
+        call_command('manage_partitions', ahead=0, stdout=StringIO())
+        self.assertTrue(partitions.create_partition(month))
+        self.assertFalse(partitions.create_partition(month))
+
+        start, end = partitions.month_bounds(month)
+        records = RegisterCall.objects.filter(timestamp_call__gte=start, timestamp_call__lt=end)
+        self.assertEquals(11, records.count())
+        plan = records.explain()
+        self.assertIn(partitions.partition_name(month), plan)
+        self.assertNotIn(partitions.DEFAULT_PARTITION, plan)
+
+    def test_unique_id_call(self):
+        """Test a (type_call, id_call) is unique over all the partitions"""
+        partitions.create_partition(date(2017, 12, 1))
+        record = RegisterCall.objects.filter(type_call=CallTypes.START,
+                                             timestamp_call__year=2017).first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            RegisterCall.objects.bulk_create([RegisterCall(
+                type_call=record.type_call, id_call=record.id_call,
+                timestamp_call=datetime(2019, 1, 1, tzinfo=timezone.utc),
+                source_call=record.source_call, destination_call=record.destination_call
+            )])
+
+    def test_detach_partition(self):
+        """Test an old month is archived and dropped, with its keys"""
+        partitions.create_partition(date(2017, 12, 1))
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command('manage_partitions', ahead=0, detach_before='01/2018',
+                         archive_dir=archive_dir, stdout=StringIO())
+            self.assertEquals([partitions.partition_name(date(2017, 12, 1)) + '.csv.gz'],
+                              os.listdir(archive_dir))
+        self.assertFalse(RegisterCall.objects.filter(timestamp_call__year=2017).exists())
+        # The keys of the dropped records are released
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM {}".format(partitions.GUARD_TABLE))
+            self.assertEquals(RegisterCall.objects.count(), cursor.fetchone()[0])
+
+
+@skipUnless(connection.vendor == 'postgresql', "The query plans are checked on PostgreSQL")
+class BillingIndexTestCase(TestCase):
+    """Class test over the query plan of the billing query"""
+
+    calls = 1500000
+
+    @classmethod
+    def setUpTestData(cls):
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO registercall_completedcall
+                    (id_call, source_call, destination_call, start_call, end_call,
+                     duration_seconds, billable_minutes, price_cents)
+                SELECT n, lpad((n % 100000)::text, 11, '9'), '9993468278',
+                       timestamp '2018-01-01' + n * interval '1 minute',
+                       timestamp '2018-01-01' + n * interval '1 minute' + interval '61 seconds',
+                       61, 1, 45
+                FROM generate_series(1, %(calls)s) AS n
+            """, {'calls': cls.calls})
+            cursor.execute("ANALYZE registercall_completedcall")
+
+    def test_billing_query_plan(self):
+        """Test the billing query is served by index scans only"""
+        bill = CallBill('99999900042', '03/2018')
+        self.assertTrue(bill.validate_params())
+
+        plan = bill._get_calls().explain()
+        self.assertIn('Index', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+
 class PhoneBillTestCase(TestCase):
     """Class test over Bill Resource"""
 
@@ -222,6 +895,7 @@ class PhoneBillTestCase(TestCase):
 
     def setUp(self):
         super(PhoneBillTestCase, self).setUp()
+        get_bill_cache().clear()
 
         self.phone_bill = {
             "source_call": "99988526423",
@@ -256,13 +930,935 @@ class PhoneBillTestCase(TestCase):
         self.assertEquals(200, response.status_code)
 
 
+class PhoneBillCreateTestCase(TestCase):
+    """Class test over the phone bill creation"""
+
+    fixtures = ['call.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('complete_calls', stdout=StringIO())
+
+    def setUp(self):
+        super(PhoneBillCreateTestCase, self).setUp()
+        get_bill_cache().clear()
+
+    def test_create_bill_lines(self):
+        """Test the bill and its records are written with a handful of statements
+
+        Should return 201 CREATED
+        """
+        with self.assertNumQueries(6):
+            response = self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                             'period': '12/2017'})
+        self.assertEquals(201, response.status_code)
+        self.assertEquals(5, Registers.objects.filter(phone_bill=response.json()['id']).count())
+
+    def test_duplicate_bill(self):
+        """Test a subscriber period is billed once
+
+        Should return 400 BAD REQUEST
+        """
+        response = self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                         'period': '12/2017'})
+        self.assertEquals(201, response.status_code)
+        response = self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                         'period': '12/2017'})
+        self.assertEquals(400, response.status_code)
+        self.assertIn('period', response.json())
+        self.assertEquals(1, PhoneBill.objects.count())
+        self.assertEquals('02/2019', PhoneBillSerializer().validate_period('2/2019'))
+
+    def test_bill_summary(self):
+        """Test the totals of a bill are read with one query
+
+        Should return 200 OK
+        """
+        response = self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                         'period': '12/2017'})
+        phone_bill = response.json()['id']
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/phonebill/{}/summary/'.format(phone_bill))
+        self.assertEquals(200, response.status_code)
+        self.assertEquals({'id': phone_bill, 'period': '12/2017', 'source_call': '99988526423',
+                           'calls': 5, 'total_minutes': 103, 'total_seconds': 6187,
+                           'total_duration': '1h43m7s', 'total_cents': 396,
+                           'total_price': 'R$ 3,96'}, response.json())
+
+        response = self.client.get('/registers/')
+        self.assertEquals({'destination_call': '9993468278', 'duration_call': '0h7m43s',
+                           'price_call': 'R$ 0,99', 'start_date_call': '2017-12-12',
+                           'start_time_call': '15:07:13', 'phone_bill': phone_bill},
+                          response.json()['results'][0])
+
+        self.assertEquals(404, self.client.get('/phonebill/0/summary/').status_code)
+
+    def test_formatted_bill_line(self):
+        """Test a record is accepted with the formatted price and duration
+
+        Should return 201 CREATED
+        """
+        phone_bill = PhoneBill.objects.create(source_call='99988526423', period='12/2017')
+        response = self.client.post('/registers/', data={
+            'destination_call': '9993468278', 'duration_call': '1h13m43s',
+            'price_call': 'R$ 1.001,35', 'start_date_call': '2017-12-12',
+            'start_time_call': '04:57:13', 'phone_bill': phone_bill.id
+        })
+        self.assertEquals(201, response.status_code)
+        self.assertEquals((4423, 100135), Registers.objects.values_list(
+            'duration_seconds', 'price_cents').get())
+
+    def test_negative_price(self):
+        """Test a formatted negative price is refused
+
+        Should return 400 BAD REQUEST
+        """
+        phone_bill = PhoneBill.objects.create(source_call='99988526423', period='12/2017')
+        for price in ('-R$ 5,00', 'R$ -5,00', '-500'):
+            response = self.client.post('/registers/', data={
+                'destination_call': '9993468278', 'duration_call': '0h1m0s',
+                'price_call': price, 'start_date_call': '2017-12-12',
+                'start_time_call': '04:57:13', 'phone_bill': phone_bill.id
+            })
+            self.assertEquals(400, response.status_code, price)
+            self.assertIn('price_call', response.json())
+        self.assertFalse(Registers.objects.exists())
+
+    def test_invalid_bill_line(self):
+        """Test an invalid record does not leave a half-written bill
+
+        Should return 400 BAD REQUEST
+        """
+        registers = CallBill('99988526423', '12/2017').calculate_bill()
+        registers[-1]['destination_call'] = None
+
+        with patch.object(CallBill, 'calculate_bill', return_value=registers):
+            response = self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                             'period': '12/2017'})
+        self.assertEquals(400, response.status_code)
+        self.assertFalse(PhoneBill.objects.exists())
+        self.assertFalse(Registers.objects.exists())
+
+
+class RequestMetricsTestCase(TestCase):
+    """Class test over the instrumentation of the requests"""
+
+    fixtures = ['call.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('complete_calls', stdout=StringIO())
+
+    def setUp(self):
+        super(RequestMetricsTestCase, self).setUp()
+        get_bill_cache().clear()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    def create_bill(self):
+        return self.client.post('/phonebill/', data={'source_call': '99988526423',
+                                                     'period': '12/2017'})
+
+    def test_request_metrics(self):
+        """Test the time, queries and response size of a bill creation are measured"""
+        response = self.create_bill()
+        self.assertEquals(201, response.status_code)
+
+        self.assertEquals(1, metrics.REQUEST_SECONDS.get('PhoneBill-list', 'POST', '201')[1])
+        self.assertEquals((6, 1), metrics.REQUEST_DB_QUERIES.get('PhoneBill-list'))
+        self.assertEquals((len(response.content), 1),
+                          metrics.RESPONSE_BYTES.get('PhoneBill-list'))
+        for name in ('bill.cache', 'bill.query', 'bill.formatting'):
+            self.assertEquals(1, metrics.SPAN_SECONDS.get(name)[1])
+
+    def test_metrics_endpoint(self):
+        """Test the histograms are exposed in the Prometheus text format
+
+        Should return 200 OK
+        """
+        self.create_bill()
+        response = self.client.get('/metrics')
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        body = response.content.decode()
+        self.assertIn('# TYPE systemcall_request_db_queries histogram', body)
+        self.assertIn('systemcall_request_db_queries_bucket{view="PhoneBill-list",le="5"} 0',
+                      body)
+        self.assertIn('systemcall_request_db_queries_bucket{view="PhoneBill-list",le="10"} 1',
+                      body)
+        self.assertIn('systemcall_request_db_queries_count{view="PhoneBill-list"} 1', body)
+        self.assertIn('systemcall_span_seconds_count{span="bill.query"} 1', body)
+
+    @override_settings(METRICS={'SLOW_REQUEST_MS': 0, 'SLOW_REQUEST_STATEMENTS': 2})
+    def test_slow_request_log(self):
+        """Test the slow requests are logged with their spans and SQL"""
+        with self.assertLogs('systemcall.middleware', 'WARNING') as logs:
+            self.create_bill()
+
+        log, = logs.output
+        self.assertIn('Slow request POST /phonebill/ (PhoneBill-list)', log)
+        self.assertIn('span bill.query', log)
+        self.assertIn('SELECT', log)
+        self.assertIn('... 4 more queries', log)
+
+
+@override_settings(DATABASE_REPLICAS={'ALIASES': ['replica1', 'replica2'], 'PINNING_SECONDS': 5})
+class ReplicaRouterTestCase(SimpleTestCase):
+    """Class test over the routing of the reads to the replicas"""
+
+    def setUp(self):
+        super(ReplicaRouterTestCase, self).setUp()
+        routers.start_request()
+        self.addCleanup(routers.start_request)
+        self.router = routers.ReplicaRouter()
+
+    def test_use_replica(self):
+        """Test the reads of a block go to one replica, in turn, and the others to default"""
+        self.assertIsNone(self.router.db_for_read(PhoneBill))
+        with routers.use_replica():
+            self.assertEquals('replica1', self.router.db_for_read(PhoneBill))
+            with routers.use_replica():
+                self.assertEquals('replica1', self.router.db_for_read(Registers))
+        with routers.use_replica():
+            self.assertEquals('replica2', self.router.db_for_read(PhoneBill))
+
+        bill = PhoneBill()
+        bill._state.db = 'replica1'
+        with routers.use_replica():
+            self.assertEquals('replica1', self.router.db_for_read(Registers, instance=bill))
+        register = Registers()
+        register._state.db = 'default'
+        self.assertTrue(self.router.allow_relation(bill, register))
+        self.assertFalse(self.router.allow_migrate('replica2', 'phonebill'))
+
+    def test_read_your_writes(self):
+        """Test a write pins the thread, and the client by a cookie, to the default database"""
+        self.assertEquals('default', self.router.db_for_write(PhoneBill))
+        with routers.use_replica():
+            self.assertIsNone(self.router.db_for_read(PhoneBill))
+
+        def view(request):
+            with routers.use_replica():
+                database = self.router.db_for_read(PhoneBill) or 'default'
+            if request.method == 'POST':
+                self.router.db_for_write(PhoneBill)
+            return HttpResponse(database)
+
+        middleware = ReplicaPinningMiddleware(view)
+        response = middleware(RequestFactory().get('/phonebill/'))
+        self.assertEquals((b'replica1', False),
+                          (response.content, 'replica_pin' in response.cookies))
+
+        response = middleware(RequestFactory().post('/phonebill/'))
+        self.assertEquals(5, response.cookies['replica_pin']['max-age'])
+
+        request = RequestFactory().get('/phonebill/')
+        request.COOKIES['replica_pin'] = '1'
+        self.assertEquals(b'default', middleware(request).content)
+
+    def test_pin_credentials(self):
+        """Test a client without cookies is pinned by its token"""
+        def view(request):
+            with routers.use_replica():
+                database = self.router.db_for_read(PhoneBill) or 'default'
+            if request.method == 'POST':
+                self.router.db_for_write(PhoneBill)
+            return HttpResponse(database)
+
+        middleware = ReplicaPinningMiddleware(view)
+        middleware(RequestFactory().post('/phonebill/', HTTP_AUTHORIZATION='Token writer'))
+        self.assertEquals(b'default', middleware(RequestFactory().get(
+            '/phonebill/', HTTP_AUTHORIZATION='Token writer')).content)
+        self.assertNotEquals(b'default', middleware(RequestFactory().get(
+            '/phonebill/', HTTP_AUTHORIZATION='Token reader')).content)
+
+
+@skipUnless(connection.vendor == 'sqlite', "The replica is a copy of the SQLite database")
+class ReplicaDatabaseTestCase(APITransactionTestCase):
+    """Class test over the reads of a replica, a second SQLite database copied from
+    the default one before the test writes, as a lagging replica
+
+    The writes are committed: the reads inside a transaction stay on the default database.
+    """
+
+    fixtures = ['call.json']
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReplicaDatabaseTestCase, cls).setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, 'replica.sqlite3')
+        connection.ensure_connection()
+        replica = sqlite3.connect(path)
+        connection.connection.backup(replica)
+        replica.close()
+
+        connections.databases['replica1'] = {'ENGINE': 'django.db.backends.sqlite3',
+                                             'NAME': path}
+        connections.ensure_defaults('replica1')
+        connections.prepare_test_settings('replica1')
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica1'].close()
+        del connections.databases['replica1']
+        delattr(connections._connections, 'replica1')
+        shutil.rmtree(cls.directory)
+        super(ReplicaDatabaseTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        super(ReplicaDatabaseTestCase, self).setUp()
+        call_command('complete_calls', stdout=StringIO())
+        get_bill_cache().clear()
+        self.addCleanup(routers.start_request)
+
+        writer = User.objects.create_user('writer')
+        self.writer = Token.objects.create(user=writer).key
+        reader = User.objects.create_user('reader')
+        self.reader = Token.objects.create(user=reader).key
+
+    @override_settings(DATABASE_REPLICAS={'ALIASES': ['replica1'], 'PINNING_SECONDS': 5},
+                       DATABASE_ROUTERS=['systemcall.routers.ReplicaRouter'])
+    def test_read_replica(self):
+        """Test the bill is computed from the default database and read back by its
+        writer, while the other clients read the replica
+        """
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.writer)
+        response = self.client.post('/phonebill/', {'source_call': '99988526423',
+                                                    'period': '12/2017'})
+        self.assertEquals(201, response.status_code)
+        self.assertEquals(5, len(response.data['bill']))
+        phone_bill = response.data['id']
+        # Pinned by the token, without the cookie
+        self.client.cookies.clear()
+        self.assertEquals(200, self.client.get('/phonebill/{}/'.format(phone_bill)).status_code)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.reader)
+        self.assertEquals(404, self.client.get('/phonebill/{}/'.format(phone_bill)).status_code)
+        self.assertEquals(0, PhoneBill.objects.using('replica1').count())
+
+
+class RunningBillTestCase(APITestCase):
+    """Class test over the running bills of the current month"""
+
+    def setUp(self):
+        super(RunningBillTestCase, self).setUp()
+
+        self.start = RegisterCall(
+            type_call=CallTypes.START, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 21, 57, 13)),
+            source_call="99988526423", destination_call="9993468278"
+        )
+        self.start.save()
+        self.end = RegisterCall(
+            type_call=CallTypes.END, id_call=78,
+            timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 10, 56))
+        )
+        self.end.save()
+
+    def running(self):
+        running = RunningBill.objects.get(source_call='99988526423', period='01/2019')
+        return (running.calls, running.billable_minutes, running.total_cents,
+                running.last_id_call)
+
+    def test_running_bill(self):
+        """Test the running bill follows the calls completed, changed and removed"""
+        self.assertEquals((1, 2, 54, 78), self.running())
+
+        RegisterCall(type_call=CallTypes.START, id_call=79, source_call="99988526423",
+                     destination_call="9993468278",
+                     timestamp_call=timezone.make_aware(datetime(2019, 1, 2, 10, 0))).save()
+        RegisterCall(type_call=CallTypes.END, id_call=79,
+                     timestamp_call=timezone.make_aware(datetime(2019, 1, 2, 10, 1, 30))).save()
+        self.assertEquals((2, 3, 99, 79), self.running())
+
+        self.start.timestamp_call = timezone.make_aware(datetime(2019, 1, 1, 21, 50, 13))
+        self.start.save()
+        self.assertEquals((2, 10, 162, 79), self.running())
+
+        self.end.delete()
+        self.assertEquals((1, 1, 45, 79), self.running())
+
+    def test_remove_latest_call(self):
+        """Test the running bill goes back to the previous call when the latest is removed"""
+        RegisterCall(type_call=CallTypes.START, id_call=79, source_call="99988526423",
+                     destination_call="9993468278",
+                     timestamp_call=timezone.make_aware(datetime(2019, 1, 2, 10, 0))).save()
+        end = RegisterCall(type_call=CallTypes.END, id_call=79,
+                           timestamp_call=timezone.make_aware(datetime(2019, 1, 2, 10, 1, 30)))
+        end.save()
+        end.delete()
+
+        self.assertEquals((1, 2, 54, 78), self.running())
+        call_command('reconcile_running_bills', period='01/2019', stdout=StringIO())
+
+        self.end.delete()
+        self.assertEquals((0, 0, 0, None), self.running())
+
+    def test_open_bill(self):
+        """Test the API for reading the bill of the current month with one query
+
+        Should return 200 OK
+        """
+        with patch('apps.phonebill.views.timezone.now',
+                   return_value=timezone.make_aware(datetime(2019, 1, 15))):
+            with self.assertNumQueries(1):
+                response = self.client.get('/phonebill/open/',
+                                           data={'source_call': '99988526423'})
+        self.assertEquals(200, response.status_code)
+        bill = response.json()
+        self.assertEquals(('01/2019', 1, 2, 54, 'R$ 0,54', 78),
+                          (bill['period'], bill['calls'], bill['billable_minutes'],
+                           bill['total_cents'], bill['total_price'], bill['last_id_call']))
+
+        response = self.client.get('/phonebill/open/', data={'source_call': '99988526423',
+                                                             'period': '2/2019'})
+        self.assertEquals(('02/2019', 0), (response.json()['period'], response.json()['calls']))
+
+    def test_invalid_open_bill(self):
+        """Test the API for reading the current bill without a subscriber or period
+
+        Should return 400 BAD REQUEST
+        """
+        self.assertEquals(400, self.client.get('/phonebill/open/').status_code)
+        self.assertEquals(400, self.client.get('/phonebill/open/', data={
+            'source_call': '99988526423', 'period': '13/2019'
+        }).status_code)
+
+    def test_reconcile(self):
+        """Test the running bills are checked and fixed against the completed calls"""
+        call_command('reconcile_running_bills', period='01/2019', stdout=StringIO())
+
+        RunningBill.objects.update(total_cents=1)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_running_bills', period='01/2019', stdout=StringIO())
+
+        call_command('reconcile_running_bills', period='01/2019', fix=True, stdout=StringIO())
+        self.assertEquals((1, 2, 54, 78), self.running())
+        call_command('reconcile_running_bills', period='01/2019', stdout=StringIO())
+
+
+class BillExportTestCase(APITestCase):
+    """Class test over the export of the bill lines of a period"""
+
+    def setUp(self):
+        super(BillExportTestCase, self).setUp()
+
+        calls = [
+            (1, '99988526423', '9993468278', datetime(2017, 12, 12, 15, 7, 13), 463, 99),
+            (2, '99988526400', '9993468278', datetime(2017, 12, 31, 23, 59), 120, 36),
+            (3, '99988526423', '9993468200', datetime(2017, 12, 1, 6, 0), 60, 45),
+            (4, '99988526423', '9993468278', datetime(2018, 1, 1, 10, 0), 60, 45),
+        ]
+        CompletedCall.objects.bulk_create([
+            CompletedCall(id_call=id_call, source_call=source, destination_call=destination,
+                          start_call=timezone.make_aware(start),
+                          end_call=timezone.make_aware(start + timedelta(seconds=seconds)),
+                          duration_seconds=seconds, billable_minutes=seconds // 60,
+                          price_cents=cents)
+            for id_call, source, destination, start, seconds, cents in calls
+        ])
+        self.expected = [
+            'id_call,source_call,destination_call,start_date_call,start_time_call,'
+            'duration_seconds,price_cents',
+            '3,99988526423,9993468200,2017-12-01,06:00:00,60,45',
+            '1,99988526423,9993468278,2017-12-12,15:07:13,463,99',
+            # Ends in the next period
+            '2,99988526400,9993468278,2017-12-31,23:59:00,120,36',
+            '4,99988526423,9993468278,2018-01-01,10:00:00,60,45',
+        ]
+        user = User.objects.create_user('finance')
+        user.user_permissions.add(Permission.objects.get(codename='view_phonebill'))
+        self.client.force_authenticate(user)
+
+    def test_export(self):
+        """Test the API streaming the lines of a period, by subscriber
+
+        Should return 200 OK
+        """
+        response = self.client.get('/phonebill/export/', data={'period': '12/2017'})
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEquals('attachment; filename="bills-2017-12.csv"',
+                          response['Content-Disposition'])
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEquals([self.expected[0]] + self.expected[1:3], lines)
+
+        response = self.client.get('/phonebill/export/', data={'period': '01/2018',
+                                                               'compress': 'gzip'})
+        self.assertEquals('application/gzip', response['Content-Type'])
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEquals([self.expected[0]] + self.expected[3:], lines)
+
+    def test_export_invalid(self):
+        """Test the API refuses an invalid period, and the users not allowed to view the bills
+
+        Should return 400 Bad Request and 403 Forbidden
+        """
+        response = self.client.get('/phonebill/export/', data={'period': '13/2017'})
+        self.assertEquals(400, response.status_code)
+
+        self.client.force_authenticate(User.objects.create_user('subscriber'))
+        response = self.client.get('/phonebill/export/', data={'period': '12/2017'})
+        self.assertEquals(403, response.status_code)
+
+    def test_export_command(self):
+        """Test the command writing the lines of a period, in chunks, to a gzip file"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bills.csv.gz')
+            out = StringIO()
+            call_command('export_bills', period='12/2017', gzip=True, output=path,
+                         chunk_size=1, stdout=out)
+            self.assertIn('2 lines written', out.getvalue())
+            with gzip.open(path, 'rt') as export_file:
+                self.assertEquals([self.expected[0]] + self.expected[1:3],
+                                  export_file.read().splitlines())
+
+        with self.assertRaises(CommandError):
+            call_command('export_bills', period='2017-12', stdout=StringIO())
+
+
+class CallArchiveTestCase(TestCase):
+    """Class test over the bills read from the columnar archive of a closed month"""
+
+    def setUp(self):
+        super(CallArchiveTestCase, self).setUp()
+        calls = [
+            (3, '99988526423', '9993468278', datetime(2017, 12, 12, 15, 7, 13), 463, 99),
+            (1, '99988526423', '9993468200', datetime(2017, 12, 1, 6, 0), 60, 45),
+            (2, '99988526400', '9993468278', datetime(2017, 12, 31, 23, 0), 120, 54),
+            (4, '99988526423', '9993468278', datetime(2018, 1, 1, 10, 0), 60, 45),
+        ]
+        CompletedCall.objects.bulk_create([
+            CompletedCall(id_call=id_call, source_call=source, destination_call=destination,
+                          start_call=timezone.make_aware(start),
+                          end_call=timezone.make_aware(start + timedelta(seconds=seconds)),
+                          duration_seconds=seconds, billable_minutes=seconds // 60,
+                          price_cents=cents)
+            for id_call, source, destination, start, seconds, cents in calls
+        ])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        get_bill_cache().clear()
+        self.addCleanup(get_bill_cache().clear)
+
+    def bill(self, source_call):
+        get_bill_cache().clear()
+        return CallBill(source_call, '12/2017').calculate_bill()
+
+    def test_archive(self):
+        """Test the bills of an archived month are the same, read without the database"""
+        sources = ('99988526423', '99988526400', '99988526499')
+        expected = {source: self.bill(source) for source in sources}
+        out = StringIO()
+        call_command('archive_month', period='12/2017', archive_dir=self.directory,
+                     chunk_size=2, stdout=out)
+        self.assertIn('3 calls of 2 subscribers', out.getvalue())
+
+        with override_settings(BILL_ARCHIVE={'DIR': self.directory}):
+            archive = get_archive(12, 2017)
+            self.assertEquals([1, 3], archive.subscriber('99988526423')['id_call'].tolist())
+            with self.assertNumQueries(0):
+                for source, bill in expected.items():
+                    self.assertEquals(bill, self.bill(source))
+            self.assertIsNone(get_archive(1, 2018))
+
+    def test_late_call(self):
+        """Test a call of an archived month completed later discards the archive, and is billed"""
+        call_command('archive_month', period='12/2017', archive_dir=self.directory,
+                     stdout=StringIO())
+        start = timezone.make_aware(datetime(2017, 12, 20, 10, 0))
+        with override_settings(BILL_ARCHIVE={'DIR': self.directory}):
+            self.assertIsNotNone(get_archive(12, 2017))
+            # The test transaction is never committed
+            with patch('apps.registercall.models.transaction.on_commit',
+                       side_effect=lambda func: func()):
+                CompletedCall.bulk_complete([(5, '99988526423', '9993468278', start,
+                                              start + timedelta(minutes=2))])
+            self.assertIsNone(get_archive(12, 2017))
+            self.assertFalse(os.listdir(self.directory))
+            self.assertEquals(3, len(self.bill('99988526423')))
+
+        call_command('archive_month', period='12/2017', archive_dir=self.directory,
+                     stdout=StringIO())
+        with override_settings(BILL_ARCHIVE={'DIR': self.directory}):
+            self.assertEquals(3, len(get_archive(12, 2017).subscriber('99988526423')))
+
+    def test_closed_month(self):
+        """Test only a closed month is archived"""
+        with self.assertRaises(CommandError):
+            call_command('archive_month', period=timezone.now().strftime('%m/%Y'),
+                         archive_dir=self.directory, stdout=StringIO())
+
+
+class PhoneBillQueriesTestCase(TestCase):
+    """Class test over the number of queries to read a phone bill"""
+
+    lines = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.phone_bill = PhoneBill.objects.create(source_call='99988526423', period='12/2017')
+        Registers.objects.bulk_create([
+            Registers(phone_bill=cls.phone_bill, destination_call='9993468278',
+                      duration_seconds=463 + index, price_cents=99,
+                      start_date_call=date(2017, 12, 12), start_time_call=time(15, 7, 13))
+            for index in range(cls.lines)
+        ])
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def test_bill_detail(self):
+        """Test the bill and its records are read with two queries
+
+        Should return 200 OK
+        """
+        with self.assertNumQueries(2):
+            response = self.client.get('/phonebill/{}/'.format(self.phone_bill.id))
+        self.assertEquals(200, response.status_code)
+
+        bill = response.json()['bill']
+        self.assertEquals(self.lines, len(bill))
+        self.assertEquals({'destination_call': '9993468278', 'duration_call': '0h7m43s',
+                           'price_call': 'R$ 0,99', 'start_date_call': '2017-12-12',
+                           'start_time_call': '15:07:13'}, bill[0])
+
+    def test_bill_list(self):
+        """Test the bills are listed with two queries
+
+        Should return 200 OK
+        """
+        PhoneBill.objects.create(source_call='99988526423', period='01/2018')
+        with self.assertNumQueries(2):
+            response = self.client.get('/phonebill/')
+        self.assertEquals([self.lines, 0], [len(bill['bill']) for bill in response.json()])
+
+    def test_register_str(self):
+        """Test the str of a record does not read its phone bill"""
+        registers = list(Registers.objects.all()[:10])
+        with self.assertNumQueries(0):
+            self.assertIn('phone_bill: {}'.format(self.phone_bill.id), str(registers[0]))
+            [str(register) for register in registers]
+
+    def test_admin_list(self):
+        """Test the admin list of the records does not read the phone bill of each one
+
+        Should return 200 OK
+        """
+        self.client.force_login(self.admin)
+        with self.assertNumQueries(5):
+            response = self.client.get('/admin/phonebill/registers/')
+        self.assertEquals(200, response.status_code)
+
+
+class BillingRunTestCase(TestCase):
+    """Class test over the month-end bill run"""
+
+    fixtures = ['call.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('complete_calls', stdout=StringIO())
+
+    def test_run_billing(self):
+        """Test every subscriber is billed once, resuming from the subscribers not billed"""
+        output = StringIO()
+        call_command('run_billing', period='12/2017', workers=1, stdout=output)
+        self.assertIn('12/2017: 1 subscribers billed', output.getvalue())
+
+        phone_bill = PhoneBill.objects.get()
+        self.assertEquals(('99988526423', '12/2017'), (phone_bill.source_call, phone_bill.period))
+        self.assertEquals([99, 36, 54, 135, 72],
+                          [line.price_cents for line in phone_bill.bill.order_by('id')])
+
+        run = BillingRun('12/2017')
+        self.assertTrue(run.validate_params())
+        self.assertEquals(0, run.run())
+        self.assertEquals(1, PhoneBill.objects.count())
+
+    def test_existing_bill(self):
+        """Test the subscribers billed through the API are not billed again"""
+        PhoneBill.objects.create(source_call='99988526423', period='12/2017')
+
+        run = BillingRun('12/2017')
+        self.assertTrue(run.validate_params())
+        self.assertEquals(0, run.run())
+        self.assertEquals(1, PhoneBill.objects.count())
+        self.assertEquals(0, bill_chunk('12/2017', ['99988526423']))
+
+    def test_bill_created_meanwhile(self):
+        """Test a chunk is written again without a bill created while it was computed"""
+        billed = billed_subscribers
+        checks = []
+
+        def billed_later(*args):
+            checks.append(args)
+            if len(checks) == 1:
+                PhoneBill.objects.create(source_call='99988526423', period='12/2017')
+                return set()
+            return billed(*args)
+
+        with patch('apps.phonebill.billing.billed_subscribers', side_effect=billed_later):
+            self.assertEquals(0, bill_chunk('12/2017', ['99988526423']))
+        self.assertEquals(2, len(checks))
+        self.assertFalse(PhoneBill.objects.get().bill.exists())
+
+    def test_invalid_period(self):
+        """Test a run for an invalid period"""
+        with self.assertRaises(CommandError):
+            call_command('run_billing', period='13/2017', stdout=StringIO())
+
+
+class ParallelBillingRunTestCase(TransactionTestCase):
+    """Class test over the month-end bill run in a pool of processes"""
+
+    def setUp(self):
+        super(ParallelBillingRunTestCase, self).setUp()
+        # The test database, created by now
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("The processes of the run need a database on disk")
+
+    def test_workers(self):
+        """Test the chunks billed by two processes bill every subscriber once"""
+        start = timezone.make_aware(datetime(2017, 12, 12, 10, 0, 0))
+        for id_call in range(1, 6):
+            source_call = '9998852640{}'.format(id_call)
+            RegisterCall(type_call=CallTypes.START, id_call=id_call, source_call=source_call,
+                         destination_call='9993468278',
+                         timestamp_call=start + timedelta(hours=id_call)).save()
+            RegisterCall(type_call=CallTypes.END, id_call=id_call,
+                         timestamp_call=start + timedelta(hours=id_call, minutes=2)).save()
+
+        run = BillingRun('12/2017', chunk_size=2, workers=2)
+        self.assertTrue(run.validate_params())
+        self.assertEquals(5, run.run())
+
+        self.assertEquals(['9998852640{}'.format(id_call) for id_call in range(1, 6)],
+                          list(PhoneBill.objects.order_by('source_call')
+                               .values_list('source_call', flat=True)))
+        self.assertEquals(5, Registers.objects.count())
+        run = BillingRun('12/2017', workers=2)
+        self.assertTrue(run.validate_params())
+        self.assertEquals(0, run.run())
+
+
+class TariffPlanTestCase(TestCase):
+    """Class test over the tariff plans compiled in memory"""
+
+    def setUp(self):
+        super(TariffPlanTestCase, self).setUp()
+        # The plans created by a test are rolled back
+        self.addCleanup(invalidate_tariffs)
+
+        weekday = [(DayTypes.WEEKDAY, time(8, 0), time(18, 0), 10),
+                   (DayTypes.WEEKDAY, time(18, 0), time(0, 0), 5)]
+        self.plan = CompiledPlan('Business', [
+            compile_rate('', 50, 2, weekday),
+            compile_rate('55', 70, 3, weekday + [(DayTypes.WEEKEND, time(0, 0), time(0, 0), 1)]),
+            compile_rate('5521', 90, 4, []),
+        ], holidays=[date(2019, 1, 1).toordinal()])
+
+    def price(self, destination_call, start, minutes, seconds=30):
+        start = timezone.make_aware(start)
+        return self.plan.price(destination_call, *call_span(
+            start, start + timedelta(minutes=minutes, seconds=seconds)
+        ))
+
+    def test_standard_plan(self):
+        """Test the standard plan prices as the minute-by-minute rules of PriceRates"""
+        rand, plan = Random(3), standard_plan()
+        for _ in range(300):
+            start = rand.randrange(0, 400 * 86400) * 10 ** 6
+            if rand.random() < 0.3:
+                # Minute ticks exactly on the 06:00 and 22:00 boundaries
+                start = start - start % (86400 * 10 ** 6) + 6 * 3600 * 10 ** 6 \
+                    - 60 * 10 ** 6 * rand.randrange(0, 5)
+            end = start + rand.choice([rand.randrange(0, 3 * 86400 * 10 ** 6),
+                                       60 * 10 ** 6 * rand.randrange(0, 1000) + 1])
+
+            minutes = BillableMinutesTest.loop_minutes(EPOCH + timedelta(microseconds=start),
+                                                       EPOCH + timedelta(microseconds=end))
+            self.assertEquals((minutes, 36 + 9 * minutes), tuple(plan.price(None, start, end)))
+
+    def test_band_boundary(self):
+        """Test a minute ending exactly on a band limit is charged the lowest rate"""
+        # Minutes ending at 17:59 (10), 18:00 (limit, 5) and 18:01 (5)
+        self.assertEquals((3, 50 + 20), tuple(self.price('11', datetime(2019, 1, 2, 17, 58), 3)))
+        # Minutes ending at 07:59 (2), 08:00 (limit, 2) and 08:01 (10)
+        self.assertEquals((3, 50 + 14), tuple(self.price('11', datetime(2019, 1, 2, 7, 58), 3)))
+        # Crossing midnight: 23:59 (5), 00:00 (limit, 2) and 00:01 (2)
+        self.assertEquals((3, 50 + 9), tuple(self.price('11', datetime(2019, 1, 2, 23, 58), 3)))
+
+    def test_destination_prefix(self):
+        """Test the rate of the longest prefix of the destination is applied"""
+        self.assertEquals(50 + 10, self.price('1199', datetime(2019, 1, 2, 12, 0), 1).cents)
+        self.assertEquals(70 + 10, self.price('5511', datetime(2019, 1, 2, 12, 0), 1).cents)
+        self.assertEquals(90 + 4, self.price('55219', datetime(2019, 1, 2, 12, 0), 1).cents)
+
+    def test_weekend_holiday(self):
+        """Test the weekends and holidays are priced with their own bands"""
+        # Saturday
+        self.assertEquals(70 + 1, self.price('5511', datetime(2019, 1, 5, 12, 0), 1).cents)
+        # Holiday, without bands
+        self.assertEquals(70 + 3, self.price('5511', datetime(2019, 1, 1, 12, 0), 1).cents)
+        # Weekday
+        self.assertEquals(70 + 10, self.price('5511', datetime(2019, 1, 2, 12, 0), 1).cents)
+
+    def test_subscriber_plan(self):
+        """Test the calls of a subscriber are priced with its plan, reloaded when it changes"""
+        plan = TariffPlan.objects.create(name='Business')
+        rate = DestinationRate.objects.create(plan=plan, standing_charge_cents=50, minute_cents=2)
+        band = TimeBand.objects.create(rate=rate, day_type=DayTypes.WEEKDAY, start=time(8, 0),
+                                       end=time(18, 0), minute_cents=10)
+        Holiday.objects.create(plan=plan, date=date(2019, 1, 2))
+        SubscriberPlan.objects.create(source_call='99988526423', plan=plan)
+
+        start, end = call_span(timezone.make_aware(datetime(2019, 1, 3, 12, 0)),
+                               timezone.make_aware(datetime(2019, 1, 3, 12, 2, 30)))
+        tariffs = get_tariffs()
+        with self.assertNumQueries(0):
+            self.assertEquals(50 + 20, tariffs.price('99988526423', '11', start, end).cents)
+            self.assertEquals(36 + 18, tariffs.price('99988526400', '11', start, end).cents)
+            # Holiday
+            self.assertEquals(50 + 4, tariffs.price('99988526423', '11', start - 86400 * 10 ** 6,
+                                                    end - 86400 * 10 ** 6).cents)
+
+        band.minute_cents = 20
+        band.save()
+        self.assertEquals(50 + 40, get_tariffs().price('99988526423', '11', start, end).cents)
+
+    def test_completed_call_plan(self):
+        """Test the completed calls are priced with the plan of their subscriber"""
+        plan = TariffPlan.objects.create(name='Flat')
+        DestinationRate.objects.create(plan=plan, standing_charge_cents=10, minute_cents=1)
+        SubscriberPlan.objects.create(source_call='99988526423', plan=plan)
+
+        RegisterCall(type_call=CallTypes.START, id_call=78,
+                     timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 21, 57, 13)),
+                     source_call="99988526423", destination_call="9993468278").save()
+        RegisterCall(type_call=CallTypes.END, id_call=78,
+                     timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 22, 10, 56))).save()
+
+        call = CompletedCall.objects.get(id_call=78)
+        self.assertEquals((13, 10 + 13), (call.billable_minutes, call.price_cents))
+
+    def test_queryset_changes(self):
+        """Test the plans are reloaded after the queryset updates and deletes of their items"""
+        plan = TariffPlan.objects.create(name='Flat')
+        DestinationRate.objects.create(plan=plan, standing_charge_cents=10, minute_cents=1)
+        SubscriberPlan.objects.create(source_call='99988526423', plan=plan)
+        start, end = call_span(timezone.make_aware(datetime(2019, 1, 3, 12, 0)),
+                               timezone.make_aware(datetime(2019, 1, 3, 12, 2, 30)))
+        self.assertEquals(10 + 2, get_tariffs().price('99988526423', '11', start, end).cents)
+
+        DestinationRate.objects.filter(plan=plan).update(minute_cents=3)
+        self.assertEquals(10 + 6, get_tariffs().price('99988526423', '11', start, end).cents)
+
+        SubscriberPlan.objects.filter(source_call='99988526423').delete()
+        self.assertEquals(36 + 18, get_tariffs().price('99988526423', '11', start, end).cents)
+
+    def test_destination_without_rate(self):
+        """Test a call start whose destination has no rate in the plan is rejected"""
+        plan = TariffPlan.objects.create(name='Local')
+        DestinationRate.objects.create(plan=plan, prefix='999', standing_charge_cents=10)
+        SubscriberPlan.objects.create(source_call='99988526423', plan=plan)
+
+        start = RegisterCall(type_call=CallTypes.START, id_call=78,
+                             timestamp_call=timezone.make_aware(datetime(2019, 1, 1, 21, 57)),
+                             source_call="99988526423", destination_call="1133468278")
+        with self.assertRaises(ValidationError) as raised:
+            start.save()
+        self.assertIn('destination_call', raised.exception.message_dict)
+
+        result = CallBatch([{'type_call': CallTypes.START, 'id_call': 78,
+                             'timestamp_call': '2019-01-01T21:57:00Z',
+                             'source_call': '99988526423', 'destination_call': '1133468278'}
+                            ]).save()
+        self.assertEquals(0, result['created'])
+        self.assertIn('destination_call', result['errors'][0]['errors'])
+
+    def test_catch_all_rate(self):
+        """Test the admin requires a rate with an empty prefix in each plan"""
+        formset_class = inlineformset_factory(TariffPlan, DestinationRate,
+                                              formset=DestinationRateFormSet,
+                                              fields=('prefix', 'standing_charge_cents'))
+        data = {'rates-TOTAL_FORMS': '1', 'rates-INITIAL_FORMS': '0',
+                'rates-0-prefix': '999', 'rates-0-standing_charge_cents': '10'}
+        plan = TariffPlan.objects.create(name='Local')
+        self.assertFalse(formset_class(data, instance=plan).is_valid())
+
+        data['rates-0-prefix'] = ''
+        self.assertTrue(formset_class(data, instance=plan).is_valid())
+
+    @staticmethod
+    def loop_price(plan, destination_call, start, end):
+        """Reference implementation: the rate of each minute tick, one by one"""
+        minute, day = 60 * 10 ** 6, 86400 * 10 ** 6
+        rate = plan.rates.lookup(destination_call)
+        minutes, cents, position = 0, rate.standing_charge_cents, start + minute
+        while position < end:
+            schedule = rate.schedules[plan._day_type(position // day)]
+            offset = position % day
+            index = bisect_right(schedule.bounds, offset)
+            minute_cents = schedule.rates[index]
+            if not offset:
+                minute_cents = min(minute_cents, rate.schedules[
+                    plan._day_type(position // day - 1)].rates[-1])
+            elif index and schedule.bounds[index - 1] == offset:
+                minute_cents = min(minute_cents, schedule.rates[index - 1])
+            minutes += 1 if minute_cents else 0
+            cents += minute_cents
+            position += minute
+        return minutes, cents
+
+    def random_calls(self, rand, count, days):
+        start = int((datetime(2018, 12, 1) - EPOCH).total_seconds()) * 10 ** 6
+        calls = []
+        for _ in range(count):
+            call_start = start + rand.randrange(0, 60 * 86400) * 10 ** 6 \
+                + rand.choice((0, 0, 1, 999999))
+            if rand.random() < 0.3:
+                # Minute ticks exactly on midnight and the 08:00 and 18:00 limits
+                call_start = call_start - call_start % (86400 * 10 ** 6) \
+                    + rand.choice((0, 8, 18)) * 3600 * 10 ** 6 - 60 * 10 ** 6 * rand.randrange(3)
+            calls.append((rand.choice(('11', '5511', '55219')), call_start,
+                          call_start + rand.randrange(0, days * 86400 * 10 ** 6)))
+        return calls
+
+    def test_long_calls(self):
+        """Test the calls of weeks, across weekends and holidays, as priced tick by tick"""
+        plan = CompiledPlan('Business', [
+            self.plan.rates.lookup(prefix) for prefix in ('11', '5511', '55219')
+        ], holidays=[date(2018, 12, 31).toordinal(), date(2019, 1, 1).toordinal(),
+                     date(2019, 1, 25).toordinal()])
+        for destination_call, start, end in self.random_calls(Random(7), 40, 45):
+            self.assertEquals(self.loop_price(plan, destination_call, start, end),
+                              tuple(plan.price(destination_call, start, end)))
+
+    def test_price_calls(self):
+        """Test a batch of calls is priced as the calls one by one"""
+        calls = self.random_calls(Random(11), 400, 3) + self.random_calls(Random(12), 20, 40)
+        destinations, starts, ends = zip(*calls)
+        for plan in (self.plan, standard_plan()):
+            priced = plan.price_calls(destinations, starts, ends)
+            self.assertEquals([tuple(plan.price(*call)) for call in calls],
+                              list(zip(priced.minutes.tolist(), priced.cents.tolist())))
+
+
 class BillCallRateTest(TestCase):
     """Class test over BillCall"""
 
     fixtures = ['call.json']
 
+    @classmethod
+    def setUpTestData(cls):
+        call_command('complete_calls', stdout=StringIO())
+
     def setUp(self):
         super(BillCallRateTest, self).setUp()
+        get_bill_cache().clear()
 
     def test_duration(self):
         """Test the duration of a call"""
@@ -282,3 +1878,194 @@ class BillCallRateTest(TestCase):
                                     datetime(2019, 1, 1, 22, 10, 56))
         self.assertEquals("R$ 0,54", price)
 
+    def test_price_format(self):
+        """Test the precompiled price format is the same of Babel"""
+        for cents in list(range(0, 20000, 3)) + [123456, 100000000, 123456789012]:
+            self.assertEquals(
+                format_currency(cents / 100, 'R$', '¤¤ ###,###,##0.00', locale='pt'),
+                price_formatter.format_cents(cents)
+            )
+        self.assertEquals("R$ 1,00", price_formatter.format(1.005))
+
+    def test_calculate_bill(self):
+        """Test the bill of a closed period"""
+        with self.assertNumQueries(1):
+            bill = CallBill('99988526423', '12/2017').calculate_bill()
+        self.assertEquals(
+            [(463, 99), (180, 36), (823, 54), (4423, 135), (298, 72)],
+            [(call['duration_seconds'], call['price_cents']) for call in bill]
+        )
+
+        bill = CallBill('99988526423', '03/2018').calculate_bill()
+        self.assertEquals([('9993468278', 87223, 8694)],
+                          [(call['destination_call'], call['duration_seconds'],
+                            call['price_cents']) for call in bill])
+
+        bill = CallBill('99988526423', '01/2018').calculate_bill()
+        self.assertIn('error', bill[0])
+
+
+class BillCacheTestCase(TestCase):
+    """Class test over the bill cache"""
+
+    fixtures = ['call.json']
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('complete_calls', stdout=StringIO())
+
+    def setUp(self):
+        super(BillCacheTestCase, self).setUp()
+        get_bill_cache().clear()
+
+    def test_lru_eviction(self):
+        """Test the least recently used bill is evicted"""
+        bill_cache = LocMemBillCache(max_entries=2)
+        bill_cache.set('99988526423', 1, 2019, [{'price_call': 'R$ 0,36'}])
+        bill_cache.set('99988526423', 2, 2019, [])
+        bill_cache.get('99988526423', 1, 2019)
+        bill_cache.set('99988526423', 3, 2019, [])
+
+        self.assertIsNone(bill_cache.get('99988526423', 2, 2019))
+        self.assertEquals([{'price_call': 'R$ 0,36'}], bill_cache.get('99988526423', 1, 2019))
+        self.assertEquals({'backend': 'LocMemBillCache', 'hits': 2, 'misses': 1,
+                           'evictions': 1, 'invalidations': 0, 'entries': 2,
+                           'max_entries': 2}, bill_cache.stats())
+
+    def test_cached_bill(self):
+        """Test a closed period is read once"""
+        CallBill('99988526423', '12/2017').calculate_bill()
+        with self.assertNumQueries(0):
+            bill = CallBill('99988526423', '12/2017').calculate_bill()
+        self.assertEquals(5, len(bill))
+
+    def test_timeout(self):
+        """Test a bill is kept by the in-process cache for its timeout only"""
+        bill_cache = LocMemBillCache(timeout=60)
+        with patch('apps.phonebill.cache.time.monotonic', return_value=1000):
+            bill_cache.set('99988526423', 1, 2019, [{'price_call': 'R$ 0,36'}])
+        with patch('apps.phonebill.cache.time.monotonic', return_value=1059):
+            self.assertIsNotNone(bill_cache.get('99988526423', 1, 2019))
+        with patch('apps.phonebill.cache.time.monotonic', return_value=1060):
+            self.assertIsNone(bill_cache.get('99988526423', 1, 2019))
+        self.assertEquals(0, bill_cache.stats()['entries'])
+
+    def test_invalidated_while_computed(self):
+        """Test a bill invalidated while it was computed is not cached"""
+        for bill_cache in (LocMemBillCache(max_entries=1), DjangoBillCache()):
+            generation = bill_cache.generation('99988526423', 1, 2019)
+            bill_cache.invalidate('99988526423', 1, 2019)
+            bill_cache.set('99988526423', 1, 2019, [{'price_call': 'R$ 0,36'}], generation)
+            self.assertIsNone(bill_cache.get('99988526423', 1, 2019))
+
+            # Still stale once the invalidation is out of the kept generations
+            generation = bill_cache.generation('99988526423', 1, 2019)
+            bill_cache.invalidate('99988526423', 1, 2019)
+            bill_cache.invalidate('99988526423', 2, 2019)
+            bill_cache.set('99988526423', 1, 2019, [{'price_call': 'R$ 0,36'}], generation)
+            self.assertIsNone(bill_cache.get('99988526423', 1, 2019))
+
+            generation = bill_cache.generation('99988526423', 1, 2019)
+            bill_cache.set('99988526423', 1, 2019, [{'price_call': 'R$ 0,36'}], generation)
+            self.assertEquals([{'price_call': 'R$ 0,36'}],
+                              bill_cache.get('99988526423', 1, 2019))
+            bill_cache.clear()
+
+    def test_period_not_found(self):
+        """Test a period without calls is not cached"""
+        bill = CallBill('99988526423', '06/2016').calculate_bill()
+        self.assertIn('error', bill[0])
+        self.assertIsNone(get_bill_cache().get('99988526423', 6, 2016))
+
+
+class BillCacheInvalidationTestCase(TransactionTestCase):
+    """Class test over the invalidation of the bill cache, once the calls are committed"""
+
+    fixtures = ['call.json']
+
+    def setUp(self):
+        super(BillCacheInvalidationTestCase, self).setUp()
+        call_command('complete_calls', stdout=StringIO())
+        get_bill_cache().clear()
+
+    def test_late_call(self):
+        """Test a call ending in the period invalidates the cached bill"""
+        self.assertEquals(5, len(CallBill('99988526423', '12/2017').calculate_bill()))
+        self.assertEquals(1, len(CallBill('99988526423', '03/2018').calculate_bill()))
+
+        start = timezone.make_aware(datetime(2017, 12, 30, 10, 0, 0))
+        RegisterCall(type_call=CallTypes.START, id_call=95, timestamp_call=start,
+                     source_call="99988526423", destination_call="9993468278").save()
+        RegisterCall(type_call=CallTypes.END, id_call=95,
+                     timestamp_call=start + timedelta(minutes=5)).save()
+
+        self.assertEquals(6, len(CallBill('99988526423', '12/2017').calculate_bill()))
+        with self.assertNumQueries(0):
+            CallBill('99988526423', '03/2018').calculate_bill()
+
+
+class BillableMinutesTest(TestCase):
+    """Class test over the billable minutes of the standard plan"""
+
+    @staticmethod
+    def loop_minutes(start, end):
+        """Reference implementation: the former minute-by-minute loop"""
+        minutes = 0
+        while start < end:
+            start = start + timedelta(minutes=1)
+            if start < end and time(6, 0, 0) < start.time() < time(22, 0, 0):
+                minutes += 1
+        return minutes
+
+    @staticmethod
+    def billable_minutes(start, end):
+        return standard_plan().price(None, *call_span(start, end)).minutes
+
+    def assertSameMinutes(self, start, end):
+        self.assertEquals(self.loop_minutes(start, end), self.billable_minutes(start, end),
+                          "{} -> {}".format(start, end))
+
+    def test_band_edges(self):
+        """Test calls starting, crossing and ending on the band limits"""
+        for hour in (5, 6, 21, 22):
+            for second in (-1, 0, 1):
+                start = datetime(2019, 1, 1, hour, 0, 0) + timedelta(seconds=second)
+                for duration in (0, 1, 59, 60, 61, 119, 120, 121, 3600, 7261):
+                    self.assertSameMinutes(start, start + timedelta(seconds=duration))
+
+    def test_midnight(self):
+        """Test calls crossing midnight"""
+        start = datetime(2019, 1, 1, 23, 59, 30)
+        self.assertSameMinutes(start, datetime(2019, 1, 2, 0, 0, 30))
+        self.assertSameMinutes(start, datetime(2019, 1, 2, 6, 3, 30))
+        self.assertSameMinutes(datetime(2018, 2, 28, 21, 57, 13),
+                               datetime(2018, 3, 1, 22, 10, 56))
+
+    def test_invalid_interval(self):
+        """Test calls ending before they start"""
+        self.assertEquals(0, self.billable_minutes(datetime(2019, 1, 1, 12, 0, 0),
+                                                   datetime(2019, 1, 1, 11, 0, 0)))
+
+    def test_random_calls(self):
+        """Test random calls, from seconds to several days, against the former loop"""
+        rand = Random(20190528)
+        for _ in range(300):
+            start = datetime(2019, 1, 1) + timedelta(
+                seconds=rand.randrange(366 * 86400), microseconds=rand.choice((0, 1, 999999))
+            )
+            duration = rand.choice((rand.randrange(3600), rand.randrange(86400),
+                                    rand.randrange(5 * 86400)))
+            self.assertSameMinutes(start, start + timedelta(seconds=duration))
+
+    def test_call_pricing(self):
+        """Test the prices and durations of the calls against the former loop"""
+        rand = Random(20190529)
+        for _ in range(200):
+            start = datetime(2019, 4, 1) + timedelta(seconds=rand.randrange(30 * 86400))
+            end = start + timedelta(seconds=rand.randrange(2 * 86400))
+
+            minutes = self.loop_minutes(start, end)
+            self.assertEquals(price_formatter.format_cents(36 + 9 * minutes),
+                              CallBill._get_price(start, end))
+            self.assertEquals(CallBill._format_duration((end - start).total_seconds()),
+                              CallBill._get_duration(start, end))